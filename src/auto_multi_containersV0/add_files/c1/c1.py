@@ -19,6 +19,7 @@ from .utils.utils_img import unnormalize_vqgan, normalize_img  # Meta functions
 from .utils.models_64x64 import Generator, Discriminator
 from .utils.loadmodels import load_generator_discriminator
 from .utils.utils_hidden import load_hidden
+from .utils.utils_engine import WatermarkEngine, set_threads
 
 
 class Content:
@@ -54,15 +55,45 @@ class Content:
             "numb_bits": 48,
             "redundancy": 1,
             "decoder_depth": 8,
-            "decoder_channels": 64
+            "decoder_channels": 64,
+            # Inference engine mode (C1_ENGINE=0 for the plain eager path): preallocated
+            # latent/key buffers, fused normalisation, inference mode, threads sized to the
+            # container (C1_THREADS), channels_last convolutions (C1_CHANNELS_LAST=0 to turn
+            # off) and optionally C1_COMPILE=trace (TorchScript) or compile (torch.compile)
+            "engine": os.environ.get("C1_ENGINE", "1") == "1",
+            "channels_last": os.environ.get("C1_CHANNELS_LAST", "1") == "1",
+            "compile": os.environ.get("C1_COMPILE", "none"),
+            "num_threads": int(os.environ.get("C1_THREADS", 0)) or None,
+            "max_batch": 64
         }
         #######################################
 
+        #######################################
+        # Threads, before any torch work starts
+        if self.config["engine"]:
+            print(">>> Torch threads:", set_threads(self.config["num_threads"]))
+        #######################################
+
         #######################################
         # Load models, hidden decoder and key
         self._load_models()
         #######################################
 
+        #######################################
+        # Build the inference engine
+        self.engine = None
+        if self.config["engine"]:
+            self.engine = WatermarkEngine(
+                self.generator, self.msg_decoder, self.config["key"], self.device,
+                latent_dim=self.config["latent_dim"],
+                max_batch=self.config["max_batch"],
+                channels_last=self.config["channels_last"],
+                compile_mode=self.config["compile"]
+            )
+            print(">>> Inference engine ready (compile: {}, channels_last: {})".format(
+                self.config["compile"], self.config["channels_last"]))
+        #######################################
+
     def _load_models(self):
         print("current directory",os.getcwd())
         """Load generator, hidden model and key"""
@@ -107,13 +138,15 @@ class Content:
         self.config["key_str"] = key_str
         #######################################
 
-    def run(self):
-        """Generate watermarked images and decode the watermark"""
+    def _generate(self, batch_size):
+        """Generate ``batch_size`` watermarked images and decode their watermark"""
+        if self.engine is not None:
+            return self.engine.generate(batch_size)
 
         #######################################
         # Latent vector z
         z = torch.tensor(
-            np.random.normal(0, 1, (self.config["batch_size"], self.config["latent_dim"])),
+            np.random.normal(0, 1, (batch_size, self.config["latent_dim"])),
             dtype=torch.float32,
             device=self.device
         )
@@ -127,16 +160,27 @@ class Content:
 
         #######################################
         # Watermark Decoding
-        keys = self.config["key"].repeat(self.config["batch_size"], 1)
+        keys = self.config["key"].repeat(batch_size, 1)
         transform = transforms.Compose([unnormalize_vqgan, normalize_img])
         decoded = self.msg_decoder(transform(fake_imgs))
         diff = (~torch.logical_xor(decoded > 0, keys > 0))
         bit_accs = torch.sum(diff, dim=-1) / diff.shape[-1]
         print(">>> Inference completed.")
         #######################################
+        return fake_imgs, bit_accs
+
+    def run(self):
+        """Generate watermarked images and decode the watermark"""
+        fake_imgs, bit_accs = self._generate(self.config["batch_size"])
 
         #######################################
         # Retrieve image for visualization
         img_ori = (fake_imgs[0].detach().cpu() + 1) / 2.0
         return img_ori, bit_accs.mean().item()
         #######################################
+
+    def run_batch(self, inputs):
+        """One (image, bit accuracy) per input, all generated in a single forward pass"""
+        fake_imgs, bit_accs = self._generate(len(inputs))
+        imgs = (fake_imgs.detach().cpu() + 1) / 2.0
+        return [(imgs[i], bit_accs[i].item()) for i in range(len(inputs))]
@@ -0,0 +1,134 @@
+# utils_engine.py
+
+" Librairies "
+import os
+import threading
+import torch
+import torch.nn as nn
+
+#########################################
+# Inference engine for the watermarked GAN: generator and hidden decoder run as one
+# pipeline, under torch.inference_mode, on preallocated latent and key buffers, with the
+# image normalisation between them folded into one per-channel affine.
+#########################################
+
+# unnormalize_vqgan then normalize_img (utils_img): x * 0.5 + 0.5, then (x - mean) / std
+IMG_MEAN = (0.485, 0.456, 0.406)
+IMG_STD = (0.229, 0.224, 0.225)
+
+COMPILE_MODES = ("none", "trace", "compile")
+
+
+def container_cpus():
+    """CPUs this container may use: its cgroup CPU quota, else its CPU affinity"""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            return max(int(int(quota) / int(period)), 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def set_threads(num_threads=None):
+    """Size torch's intra-op pool to the container (one inference at a time: no inter-op pool)"""
+    num_threads = num_threads or container_cpus()
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # only possible before any inter-op work started
+        pass
+    return num_threads
+
+
+def fused_normalization(device):
+    """(scale, shift) such that x * scale + shift == normalize_img(unnormalize_vqgan(x))"""
+    mean = torch.tensor(IMG_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(IMG_STD, device=device).view(1, 3, 1, 1)
+    return 0.5 / std, (0.5 - mean) / std
+
+
+class WatermarkPipeline(nn.Module):
+    """Latents -> (generated images, decoded watermark logits)"""
+
+    def __init__(self, generator, msg_decoder, device, channels_last=False):
+        super(WatermarkPipeline, self).__init__()
+        self.generator = generator
+        self.msg_decoder = msg_decoder
+        scale, shift = fused_normalization(device)
+        self.register_buffer("scale", scale)
+        self.register_buffer("shift", shift)
+        self.channels_last = channels_last
+
+    def forward(self, z):
+        imgs = self.generator(z)
+        x = torch.addcmul(self.shift, imgs, self.scale)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return imgs, self.msg_decoder(x)
+
+
+class WatermarkEngine:
+    def __init__(self, generator, msg_decoder, key, device, latent_dim=100, max_batch=64,
+                 channels_last=False, compile_mode="none"):
+        """
+        Inference-optimised generate-and-decode.
+        key: watermark key, float tensor [1, num_bits] of 0/1
+        max_batch: largest batch the latent and key buffers are preallocated for (grown if exceeded)
+        channels_last: NHWC memory format for the convolutions (often faster on CPU)
+        compile_mode: "none", "trace" (TorchScript trace, frozen) or "compile" (torch.compile)
+        """
+        if compile_mode not in COMPILE_MODES:
+            raise ValueError(f"Unknown compile mode {compile_mode!r} (expected one of {COMPILE_MODES})")
+        self.device = device
+        self.latent_dim = latent_dim
+        self.key_bits = (key > 0).reshape(1, -1)
+        self._lock = threading.Lock()
+        self._allocate(max_batch)
+
+        generator.eval()
+        msg_decoder.eval()
+        if channels_last:
+            generator = generator.to(memory_format=torch.channels_last)
+            try:
+                msg_decoder = msg_decoder.to(memory_format=torch.channels_last)
+            except (RuntimeError, TypeError):
+                # a TorchScript decoder may not convert; its input still comes in NHWC
+                pass
+        pipeline = WatermarkPipeline(generator, msg_decoder, device, channels_last).eval()
+        self.compile_mode = compile_mode
+        self.pipeline = self._build(pipeline, compile_mode)
+
+    def _allocate(self, max_batch):
+        self.max_batch = max_batch
+        self._z = torch.empty(max_batch, self.latent_dim, device=self.device)
+        self._keys = self.key_bits.expand(max_batch, -1)
+
+    def _build(self, pipeline, compile_mode):
+        if compile_mode == "trace":
+            with torch.no_grad():
+                example = torch.randn(2, self.latent_dim, device=self.device)
+                traced = torch.jit.trace(pipeline, example, check_trace=False)
+                return torch.jit.freeze(traced)
+        if compile_mode == "compile":
+            return torch.compile(pipeline, dynamic=True)
+        return pipeline
+
+    def generate(self, batch_size):
+        """
+        (images in [-1, 1] [B, 3, 64, 64], bit accuracy of each image [B])
+        Calls from several inference workers take turns: they share the latent buffer.
+        """
+        with self._lock, torch.inference_mode():
+            if batch_size > self.max_batch:
+                self._allocate(batch_size)
+            z = self._z[:batch_size].normal_()
+            imgs, decoded = self.pipeline(z)
+            matches = (decoded > 0) == self._keys[:batch_size]
+            bit_accs = matches.float().mean(dim=-1)
+        return imgs, bit_accs
@@ -12,6 +12,24 @@ if [[ "$1" == "--build" ]]; then
     cp ./tools/node.py ./modules/node.py
     cp ./tools/receiveMessageHandler.py ./modules/receiveMessageHandler.py
     cp ./tools/sendMessageHandler.py ./modules/sendMessageHandler.py
+    cp ./tools/connectionPool.py ./modules/connectionPool.py
+    cp ./tools/asyncNode.py ./modules/asyncNode.py
+    cp ./tools/pendingStore.py ./modules/pendingStore.py
+    cp ./tools/workerPool.py ./modules/workerPool.py
+    cp ./tools/frameHeader.py ./modules/frameHeader.py
+    cp ./tools/codecRegistry.py ./modules/codecRegistry.py
+    cp ./tools/payloadCompression.py ./modules/payloadCompression.py
+    cp ./tools/chunkStream.py ./modules/chunkStream.py
+    cp ./tools/shmTransport.py ./modules/shmTransport.py
+    cp ./tools/metrics.py ./modules/metrics.py
+    cp ./tools/clockSync.py ./modules/clockSync.py
+    cp ./tools/logPipeline.py ./modules/logPipeline.py
+    cp ./tools/routingPolicy.py ./modules/routingPolicy.py
+    cp ./tools/flowControl.py ./modules/flowControl.py
+    cp ./tools/healthCheck.py ./modules/healthCheck.py
+    cp ./tools/circuitBreaker.py ./modules/circuitBreaker.py
+    cp ./tools/microBatcher.py ./modules/microBatcher.py
+    cp ./tools/inferenceWorker.py ./modules/inferenceWorker.py
     cd modules
     # Launch using docker compose (single host)
     docker compose -p firstset up --remove-orphans --build  
@@ -42,6 +60,24 @@ elif [[ "$1" == "--multi" ]]; then
         cp ../tools/node.py ${module}/node.py
         cp ../tools/receiveMessageHandler.py ${module}/receiveMessageHandler.py
         cp ../tools/sendMessageHandler.py ${module}/sendMessageHandler.py
+        cp ../tools/connectionPool.py ${module}/connectionPool.py
+        cp ../tools/asyncNode.py ${module}/asyncNode.py
+        cp ../tools/pendingStore.py ${module}/pendingStore.py
+        cp ../tools/workerPool.py ${module}/workerPool.py
+        cp ../tools/frameHeader.py ${module}/frameHeader.py
+        cp ../tools/codecRegistry.py ${module}/codecRegistry.py
+        cp ../tools/payloadCompression.py ${module}/payloadCompression.py
+        cp ../tools/chunkStream.py ${module}/chunkStream.py
+        cp ../tools/shmTransport.py ${module}/shmTransport.py
+        cp ../tools/metrics.py ${module}/metrics.py
+        cp ../tools/clockSync.py ${module}/clockSync.py
+        cp ../tools/logPipeline.py ${module}/logPipeline.py
+        cp ../tools/routingPolicy.py ${module}/routingPolicy.py
+        cp ../tools/flowControl.py ${module}/flowControl.py
+        cp ../tools/healthCheck.py ${module}/healthCheck.py
+        cp ../tools/circuitBreaker.py ${module}/circuitBreaker.py
+        cp ../tools/microBatcher.py ${module}/microBatcher.py
+        cp ../tools/inferenceWorker.py ${module}/inferenceWorker.py
         # The Dockerfile is assumed to be at ./<module>/Dockerfile.<module> and the build context is that module's directory.
         if [ -f "./${module}/Dockerfile.${module}" ]; then
             docker build -t demo_${module}:latest -f "./${module}/Dockerfile.${module}" "./${module}" || { echo "Error building image for ${module}"; exit 1; }
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+####################################################################################################
+# Benchmark: c1 watermarked GAN inference, eager Content.run() path vs the inference engine, on CPU
+#
+#   python benchmarks/bench_c1_engine.py
+#   python benchmarks/bench_c1_engine.py --batch 1 8 32 --seconds 5 --threads 4 --compile
+#
+# Builds c1's Generator and HiddenDecoder (48 bits, depth 8, 64 channels, scripted like the
+# whitened checkpoint c1 loads) with random weights, so no weight file is needed, and reports
+# generated-and-decoded images per second for each batch size:
+#   eager            what Content.run() did: NumPy latents copied to torch, the two Normalize
+#                    transforms rebuilt per call, keys.repeat(), autograd bookkeeping on
+#   engine           WatermarkEngine: preallocated buffers, fused normalisation, inference_mode
+#   engine NHWC      same, channels_last
+#   engine trace     same, TorchScript-traced and frozen generator+decoder
+#   engine compile   same, torch.compile (with --compile; the first calls compile)
+####################################################################################################
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "add_files", "c1", "utils"))
+import numpy as np
+import torch
+from models_64x64 import Generator, LATENT_DIM
+from utils_model import get_hidden_decoder
+from utils_engine import WatermarkEngine, IMG_MEAN, IMG_STD, set_threads
+
+NUM_BITS = 48
+
+
+def normalize(mean, std):
+    try:
+        from torchvision import transforms
+        return transforms.Normalize(mean=mean, std=std)
+    except ImportError:
+        mean_t, std_t = torch.tensor(mean).view(1, 3, 1, 1), torch.tensor(std).view(1, 3, 1, 1)
+        return lambda x: (x - mean_t) / std_t
+
+
+def build_models():
+    generator = Generator().eval()
+    decoder = torch.jit.script(get_hidden_decoder(NUM_BITS, redundancy=1, num_blocks=8, channels=64).eval())
+    for model in (generator, decoder):
+        for param in model.parameters():
+            param.requires_grad = False
+    key = torch.randint(0, 2, (1, NUM_BITS), dtype=torch.float32)
+    return generator, decoder, key
+
+
+def eager_step(generator, decoder, key):
+    # Content.run() before the engine, for one batch
+    def step(batch_size):
+        z = torch.tensor(np.random.normal(0, 1, (batch_size, LATENT_DIM)), dtype=torch.float32)
+        imgs = generator(z)
+        keys = key.repeat(batch_size, 1)
+        unnormalize_vqgan = normalize([-1, -1, -1], [1 / 0.5, 1 / 0.5, 1 / 0.5])
+        normalize_img = normalize(list(IMG_MEAN), list(IMG_STD))
+        decoded = decoder(normalize_img(unnormalize_vqgan(imgs)))
+        diff = (~torch.logical_xor(decoded > 0, keys > 0))
+        return imgs, torch.sum(diff, dim=-1) / diff.shape[-1]
+    return step
+
+
+def images_per_second(step, batch_size, seconds, warmup):
+    for _ in range(warmup):
+        step(batch_size)
+    images, start = 0, time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        step(batch_size)
+        images += batch_size
+    return images / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="c1 eager vs inference engine, images/sec on CPU")
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 8, 32], help="Batch sizes")
+    parser.add_argument("--seconds", type=float, default=3.0, help="Measuring time per case")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls per case")
+    parser.add_argument("--threads", type=int, default=None, help="Torch threads (default: the container's CPUs)")
+    parser.add_argument("--compile", action="store_true", help="Also time torch.compile (slow to warm up)")
+    args = parser.parse_args()
+
+    threads = set_threads(args.threads)
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    generator, decoder, key = build_models()
+
+    variants = [("eager", eager_step(generator, decoder, key))]
+    for label, channels_last, compile_mode in (
+        ("engine", False, "none"),
+        ("engine NHWC", True, "none"),
+        ("engine trace", False, "trace"),
+    ) + ((("engine compile", False, "compile"),) if args.compile else ()):
+        # each engine converts its own copy of the models
+        gen, dec, _ = build_models()
+        gen.load_state_dict(generator.state_dict())
+        dec.load_state_dict(decoder.state_dict())
+        engine = WatermarkEngine(gen, dec, key, device, latent_dim=LATENT_DIM, max_batch=max(args.batch),
+                                 channels_last=channels_last, compile_mode=compile_mode)
+        variants.append((label, engine.generate))
+
+    print(f"torch {torch.__version__}, {threads} thread(s)")
+    print(f"{'variant':<16}" + "".join(f"{f'batch {b} img/s':>16}" for b in args.batch))
+    for label, step in variants:
+        rates = [images_per_second(step, b, args.seconds, args.warmup) for b in args.batch]
+        print(f"{label:<16}" + "".join(f"{rate:>16.1f}" for rate in rates))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+####################################################################################################
+# Microbenchmark: typed codec vs pickle on the payloads the c1 module (watermarked GAN) sends
+#
+#   python benchmarks/bench_codec.py
+#   python benchmarks/bench_codec.py --batch 64 --repeat 2000
+#
+# c1's Content.run() returns (image tensor [3, 64, 64] float32, bit accuracy float), sent as
+# {'var1': ..., 'container_creds_xxx': (name, role)}. NumPy arrays stand in for the tensors when
+# torch is not installed. Encode and decode are timed separately, through codecRegistry and
+# ReceiveMessageHandler.decode_frame (what the receiver runs), over bytearray buffers.
+####################################################################################################
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+import numpy as np
+import codecRegistry
+from receiveMessageHandler import ReceiveMessageHandler
+
+CREDS = ("c1", "default_role")
+
+
+def tensor(shape):
+    arr = np.random.rand(*shape).astype(np.float32)
+    try:
+        import torch
+        return torch.from_numpy(arr)
+    except ImportError:
+        return arr
+
+
+def payloads(batch):
+    return {
+        "control": {"cmd": "start", "step": 3, "container_creds_xxx": CREDS},
+        "c1 image": {"var1": (tensor((3, 64, 64)), 0.979), "container_creds_xxx": CREDS},
+        f"c1 batch x{batch}": {"var1": (tensor((batch, 3, 64, 64)), 0.979), "container_creds_xxx": CREDS},
+        "64 latents": {f"z{i}": tensor((1, 100)) for i in range(64)} | {"container_creds_xxx": CREDS},
+    }
+
+
+def bench(payload, codec_id, zero_copy, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        used, segments = codecRegistry.encode(payload, codec_id, zero_copy)
+    encode_s = (time.perf_counter() - start) / repeat
+
+    header = {"codec": used, "sent-ts": None}
+    content = bytes(memoryview(segments[0]).cast("B"))
+    start = time.perf_counter()
+    for _ in range(repeat):
+        # the receiver allocates one bytearray per out-of-band buffer
+        buffers = [bytearray(memoryview(buf).cast("B")) for buf in segments[1:]]
+        ReceiveMessageHandler.decode_frame(header, content, buffers)
+    decode_s = (time.perf_counter() - start) / repeat
+    size = sum(memoryview(s).nbytes for s in segments)
+    return used, size, encode_s, decode_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Typed codec vs pickle microbenchmark")
+    parser.add_argument("--batch", type=int, default=16, help="Batch size of the batched c1 payload")
+    parser.add_argument("--repeat", type=int, default=500, help="Encode/decode iterations per case")
+    args = parser.parse_args()
+
+    variants = [
+        ("pickle", codecRegistry.PICKLE, False),
+        ("pickle-5 oob", codecRegistry.PICKLE, True),
+        ("typed", codecRegistry.TYPED, False),
+        ("typed oob", codecRegistry.TYPED, True),
+    ]
+    print(f"{'payload':<16} {'codec':<13} {'bytes':>10} {'encode us':>10} {'decode us':>10} {'total us':>10}")
+    for name, payload in payloads(args.batch).items():
+        for label, codec_id, zero_copy in variants:
+            used, size, enc, dec = bench(payload, codec_id, zero_copy, args.repeat)
+            if used != codec_id:
+                label += " (fell back)"
+            print(f"{name:<16} {label:<13} {size:>10} {enc * 1e6:>10.1f} {dec * 1e6:>10.1f} {(enc + dec) * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+####################################################################################################
+# Microbenchmark: receive throughput of ReceiveMessageHandler for 1 KB, 1 MB and 100 MB frames
+#
+#   python benchmarks/bench_recv_buffer.py
+#   python benchmarks/bench_recv_buffer.py --sizes 1024 1048576 --zero-copy
+#   python benchmarks/bench_recv_buffer.py --sizes 64 1024 --binary-header
+#
+# A sender thread writes pre-encoded frames on a loopback TCP connection; the receiver drives
+# recv_all_messages() the way Node._handle_client does (select() until readable, one frame per
+# call). Only the receive path is timed: frames are encoded once, before the clock starts.
+####################################################################################################
+import argparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sendMessageHandler import SendMessageHandler
+from receiveMessageHandler import ReceiveMessageHandler
+
+DEFAULT_SIZES = [1024, 1024 ** 2, 100 * 1024 ** 2]
+
+
+def make_payload(size, zero_copy):
+    if zero_copy:
+        import numpy as np
+        data = np.random.randint(0, 255, size, dtype=np.uint8)
+    else:
+        data = os.urandom(size)
+    return {"var1": data, "container_creds_xxx": ("bench", "bench_role")}
+
+
+def run(size, count, zero_copy, binary_header=False):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+
+    payload = make_payload(size, zero_copy)
+    frame = SendMessageHandler.encode_frame(payload, zero_copy=zero_copy, binary=binary_header)
+
+    def sender():
+        sock = socket.create_connection(server.getsockname())
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handler = SendMessageHandler(sock, server.getsockname())
+        for _ in range(count):
+            handler.send_frame(frame)
+        sock.close()
+
+    threading.Thread(target=sender, daemon=True).start()
+    conn, addr = server.accept()
+    handler = ReceiveMessageHandler(conn, addr)
+
+    received = 0
+    start = time.perf_counter()
+    while received < count:
+        messages = handler.recv_all_messages()
+        if messages:
+            received += 1
+        elif handler.closed:
+            break
+        else:
+            select.select([conn], [], [], 1.0)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    server.close()
+    return received, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ReceiveMessageHandler throughput microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Frame payload sizes in bytes")
+    parser.add_argument("--budget", type=int, default=1024 ** 3,
+                        help="Approximate bytes transferred per size (sets the frame count)")
+    parser.add_argument("--zero-copy", action="store_true",
+                        help="Send NumPy arrays as out-of-band buffers (requires numpy)")
+    parser.add_argument("--binary-header", action="store_true",
+                        help="Use the fixed binary frame header instead of the JSON one")
+    args = parser.parse_args()
+
+    print(f"{'frame size':>12} {'frames':>8} {'seconds':>9} {'MB/s':>10} {'frames/s':>11}")
+    for size in args.sizes:
+        count = max(3, min(100000, args.budget // size))
+        received, elapsed = run(size, count, args.zero_copy, args.binary_header)
+        mb_s = received * size / elapsed / 1024 ** 2
+        print(f"{size:>12} {received:>8} {elapsed:>9.3f} {mb_s:>10.1f} {received / elapsed:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
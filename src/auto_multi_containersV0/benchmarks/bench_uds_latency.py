@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+####################################################################################################
+# Microbenchmark: round-trip latency of small frames over loopback TCP vs a Unix domain socket
+#
+#   python benchmarks/bench_uds_latency.py
+#   python benchmarks/bench_uds_latency.py --sizes 64 4096 --count 20000 --binary-header
+#
+# A ping-pong between two threads: the client writes one frame with SendMessageHandler, the echo
+# side receives it with ReceiveMessageHandler (select() until readable, as Node._handle_client
+# does) and writes it back. This is the path control messages take between co-located modules;
+# only the transport differs. Percentiles are per round trip.
+####################################################################################################
+import argparse
+import os
+import select
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+from sendMessageHandler import SendMessageHandler
+from receiveMessageHandler import ReceiveMessageHandler
+
+DEFAULT_SIZES = [16, 1024, 64 * 1024]
+
+
+def listener(kind, path):
+    if kind == "uds":
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    return server
+
+
+def connect(kind, address):
+    if kind == "uds":
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+    else:
+        sock = socket.create_connection(address)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def receive_one(handler, sock):
+    while True:
+        messages = handler.recv_all_messages()
+        if messages:
+            return messages
+        if handler.closed:
+            return None
+        select.select([sock], [], [], 1.0)
+
+
+def run(kind, size, count, binary_header):
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    server = listener(kind, path)
+    frame = SendMessageHandler.encode_frame(
+        {"var1": os.urandom(size), "container_creds_xxx": ("bench", "bench_role")}, binary=binary_header
+    )
+
+    def echo():
+        conn, _ = server.accept()
+        if kind == "tcp":
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        receiver = ReceiveMessageHandler(conn, ("bench", 0))
+        sender = SendMessageHandler(conn, ("bench", 0))
+        while receive_one(receiver, conn) is not None:
+            sender.send_frame(frame)
+        conn.close()
+
+    threading.Thread(target=echo, daemon=True).start()
+    sock = connect(kind, path if kind == "uds" else server.getsockname())
+    sender = SendMessageHandler(sock, ("bench", 0))
+    receiver = ReceiveMessageHandler(sock, ("bench", 0))
+
+    rtts = []
+    for i in range(count + count // 10):
+        start = time.perf_counter()
+        sender.send_frame(frame)
+        receive_one(receiver, sock)
+        if i >= count // 10:
+            # the first 10% only warm up
+            rtts.append(time.perf_counter() - start)
+    sock.close()
+    server.close()
+    if kind == "uds":
+        os.unlink(path)
+    rtts.sort()
+    return statistics.median(rtts), rtts[int(len(rtts) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TCP loopback vs Unix domain socket latency")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Payload sizes in bytes")
+    parser.add_argument("--count", type=int, default=5000, help="Round trips per case")
+    parser.add_argument("--binary-header", action="store_true", help="Use the fixed binary frame header")
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'transport':<10} {'p50 us':>10} {'p99 us':>10}")
+    for size in args.sizes:
+        for kind in ("tcp", "uds"):
+            p50, p99 = run(kind, size, args.count, args.binary_header)
+            print(f"{size:>8} {kind:<10} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import logging
+import mmap
+import struct
+import tempfile
+from collections import OrderedDict
+import frameHeader
+import metrics
+
+####################################################################################################
+# Chunked streaming of large frames. A frame of chunk_threshold bytes or more is not written in
+# one go: its segments (content, then out-of-band buffers) are cut into chunks of at most
+# chunk_size bytes, each sent as its own binary frame:
+#
+#   flags FLAG_CHUNK, seq = stream id, no content, one buffer = the chunk's data
+#   EXT_CHUNK      : segment index and offset the data belongs at
+#   EXT_CHUNK_OPEN : first chunk only, the binary header of the whole frame
+#
+# The sender interleaves the chunks of its open streams with the small frames queued behind
+# them, so one large payload no longer holds the connection. The receiver learns the segment
+# lengths from the first chunk, allocates them once (in memory, or in a memory-mapped temporary
+# file from spill_bytes up) and receives every chunk straight into place; the frame is decoded
+# once its last byte arrived, arrays being rebuilt over those segments. Stream state lives with
+# the connection: if it is reopened, the sender starts its open streams over.
+# Receivers advertise support in their Consul service Meta (META_KEY).
+####################################################################################################
+
+META_KEY = "chunks"
+VERSION = "1"
+
+_POSITION = struct.Struct("!HQ")
+
+
+def peer_supports(meta : dict) -> bool:
+    return VERSION in (meta or {}).get(META_KEY, "").split(",")
+
+
+class OutboundStream:
+    """
+    Sender side of one chunked frame: hands out its chunks in order and can
+    start over when the connection it was going out on was reopened.
+    """
+    def __init__(self, task : dict, frame : tuple, chunk_size : int, raw_nbytes : int, wire_nbytes : int):
+        self.task = task
+        self.header = bytes(frame[0])
+        self.segments = [memoryview(segment).cast("B") for segment in frame[1:]]
+        self.raw_nbytes = raw_nbytes
+        self.wire_nbytes = wire_nbytes
+        # (segment index, offset, length) of every chunk; zero-length segments have none
+        self._ranges = [
+            (index, offset, min(chunk_size, len(segment) - offset))
+            for index, segment in enumerate(self.segments)
+            for offset in range(0, len(segment), chunk_size)
+        ]
+        self._next = 0
+        # Connection generation the stream is bound to (see ConnectionPool.send)
+        self.generation = None
+        self.restarts = 0
+
+
+    @property
+    def done(self) -> bool:
+        return self._next == len(self._ranges)
+
+
+    @property
+    def last(self) -> bool:
+        return self._next == len(self._ranges) - 1
+
+
+    def next_chunk(self) -> tuple:
+        index, offset, length = self._ranges[self._next]
+        extensions = {frameHeader.EXT_CHUNK: _POSITION.pack(index, offset)}
+        if self._next == 0:
+            extensions[frameHeader.EXT_CHUNK_OPEN] = self.header
+        self._next += 1
+        header = frameHeader.render_binary(
+            0, [length], self.task['created_at'], seq=self.task['seq'], trace_id=self.task['trace_id'],
+            flags=frameHeader.FLAG_CHUNK, extensions=extensions,
+        )
+        return header, self.segments[index][offset:offset + length]
+
+
+    def restart(self):
+        self._next = 0
+        self.generation = None
+        self.restarts += 1
+
+
+class ChunkAssembler:
+    def __init__(self, spill_bytes : int = 64 * 1024 * 1024, spill_dir : str = None, max_streams : int = 16):
+        """
+        Receiver side: reassembles the chunked frames of one connection.
+        :param spill_bytes: Frames this large or larger are reassembled in a memory-mapped
+                            temporary file instead of memory. None never spills.
+        :param spill_dir: Directory of those files (the system temporary directory by default).
+        :param max_streams: Chunked frames that may be in progress at once; more are dropped.
+        """
+        self.spill_bytes = spill_bytes
+        self.spill_dir = spill_dir
+        self.max_streams = max_streams
+        self._streams = {}      # { stream id : {'header', 'segments', 'remaining'} }
+        self._dropped = OrderedDict()   # ids of the last frames dropped, whose later chunks are skipped
+
+
+    def _allocate(self, lengths : list) -> list:
+        total = sum(lengths)
+        if self.spill_bytes is None or total < self.spill_bytes:
+            return [bytearray(n) for n in lengths]
+        with tempfile.TemporaryFile(dir=self.spill_dir) as f:
+            f.truncate(total)
+            # the mapping outlives the (already unlinked) file
+            region = memoryview(mmap.mmap(f.fileno(), total))
+        segments, offset = [], 0
+        for n in lengths:
+            segments.append(region[offset:offset + n])
+            offset += n
+        return segments
+
+
+    def _open(self, stream_id : int, header_bytes : bytes):
+        if stream_id not in self._streams and len(self._streams) >= self.max_streams:
+            raise ValueError(f"more than {self.max_streams} chunked frames in progress")
+        header, n = frameHeader.parse_fixed(header_bytes[:frameHeader.FIXED.size])
+        header = frameHeader.parse_variable(header, header_bytes[frameHeader.FIXED.size:][:n])
+        lengths = [header["content-length"], *header["buffers"]]
+        self._streams[stream_id] = {
+            'header': header,
+            'segments': self._allocate(lengths),
+            'remaining': sum(lengths),
+        }
+
+
+    def receive(self, header : dict):
+        """
+        Destination of the data of the chunk announced by ``header``: a slice of the
+        frame being reassembled, or a scratch buffer for a chunk that is dropped.
+        The chunk that gets a frame dropped is flagged "frame_dropped": the frame
+        ends there for the receiver (credits), its later chunks are skipped quietly.
+        """
+        if len(header["buffers"]) != 1:
+            raise ValueError("Malformed chunk header.")
+        length = header["buffers"][0]
+        stream_id = header["seq"]
+        try:
+            ext = header["ext"]
+            if frameHeader.EXT_CHUNK_OPEN in ext:
+                self._open(stream_id, ext[frameHeader.EXT_CHUNK_OPEN])
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                raise ValueError("chunk of a frame whose first chunk was not received")
+            index, offset = _POSITION.unpack(ext[frameHeader.EXT_CHUNK])
+            segment = stream['segments'][index]
+            if offset + length > len(segment):
+                raise ValueError("chunk past the end of its segment")
+            return memoryview(segment)[offset:offset + length]
+        except (ValueError, KeyError, IndexError, struct.error, OSError) as e:
+            self._streams.pop(stream_id, None)
+            header["dropped"] = True
+            if stream_id not in self._dropped:
+                self._dropped[stream_id] = None
+                if len(self._dropped) > 4 * self.max_streams:
+                    self._dropped.popitem(last=False)
+                header["frame_dropped"] = True
+                logging.error(f"[SERVER] Dropped chunked frame {stream_id}: {e}")
+                metrics.FRAMES_DROPPED.inc()
+            return bytearray(length)
+
+
+    def complete(self, header : dict):
+        """
+        Account for the chunk just received. Returns (frame header, content, buffers)
+        once the whole frame is there, None otherwise.
+        """
+        if header.get("dropped"):
+            return None
+        stream = self._streams[header["seq"]]
+        stream['remaining'] -= header["buffers"][0]
+        if stream['remaining'] > 0:
+            return None
+        del self._streams[header["seq"]]
+        content, *buffers = stream['segments']
+        return stream['header'], content, buffers
+
+
+    def stats(self) -> dict:
+        return {
+            'in_progress': len(self._streams),
+            'bytes_missing': sum(s['remaining'] for s in self._streams.values()),
+        }
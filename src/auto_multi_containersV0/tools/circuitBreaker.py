@@ -0,0 +1,98 @@
+import random
+import threading
+import time
+
+####################################################################################################
+# Per-peer circuit breaker for the delivery loops.
+#
+# A peer that is registered in Consul but does not answer would otherwise cost a delivery loop
+# (and a dispatch worker stuck in connect for up to the connect timeout) on every retry pass.
+# After ``threshold`` consecutive failed deliveries its breaker opens: nothing is attempted
+# toward it and the payloads for it wait in the pending store, held once for the peer. Once
+# the back-off has elapsed the breaker is half-open and the next delivery loop is the probe:
+# its first frame written closes the breaker again, a failure reopens it for twice as long
+# (up to max_backoff). Delays get jitter so peers that failed together are not all retried
+# in the same instant.
+####################################################################################################
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, threshold : int = 3, backoff : float = 5.0, max_backoff : float = 120.0):
+        """
+        :param threshold: Consecutive failures that open the breaker.
+        :param backoff: Seconds the breaker stays open the first time, doubled at each
+                        failed probe, up to ``max_backoff``.
+        """
+        self.threshold = max(int(threshold), 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CLOSED
+        self.failures = 0       # consecutive failed deliveries
+        self.opened = 0         # times it opened
+        self.last_success = None
+        self.last_failure = None
+        self._streak = 0        # consecutive openings without a success, sets the back-off
+        self._retry_at = None
+        self._lock = threading.Lock()
+
+
+    def allow(self) -> bool:
+        """
+        Whether a delivery may be attempted now; turns an open breaker whose
+        back-off has elapsed half-open.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() < self._retry_at:
+                    return False
+                self.state = HALF_OPEN
+            return True
+
+
+    def success(self) -> bool:
+        """
+        A frame was written to the peer. Returns whether this closed the breaker.
+        """
+        with self._lock:
+            self.last_success = time.time()
+            self.failures = 0
+            if self.state == CLOSED:
+                return False
+            self.state = CLOSED
+            self._streak = 0
+            return True
+
+
+    def failure(self) -> float:
+        """
+        A delivery to the peer failed. Returns the back-off in seconds if this
+        (re)opened the breaker, else None.
+        """
+        with self._lock:
+            self.last_failure = time.time()
+            self.failures += 1
+            if self.state == OPEN or (self.state == CLOSED and self.failures < self.threshold):
+                return None
+            self._streak += 1
+            delay = min(self.backoff * 2 ** (self._streak - 1), self.max_backoff)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            self._retry_at = time.monotonic() + delay
+            self.state = OPEN
+            self.opened += 1
+            return delay
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opened': self.opened,
+                'retry_in': max(self._retry_at - time.monotonic(), 0.0) if self.state == OPEN else None,
+                'last_success': self.last_success,
+                'last_failure': self.last_failure,
+            }
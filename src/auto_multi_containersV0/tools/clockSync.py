@@ -0,0 +1,140 @@
+import math
+import struct
+import time
+from collections import deque
+import frameHeader
+
+####################################################################################################
+# Clock-offset estimation between nodes, NTP style, so that one-way latencies measured across
+# hosts (receive time minus the sender's "sent-ts") are not dominated by clock skew.
+#
+# The sender of a stream periodically writes a PING on it (a binary header flagged FLAG_CONTROL,
+# no content, an EXT_CLOCK extension) holding its send time t1. The receiver writes back on the
+# same stream a PONG holding t1, its receive time t2 and its send time t3, and the sender notes
+# the arrival time t4:
+#
+#   offset = ((t2 - t1) + (t3 - t4)) / 2      receiver clock minus sender clock
+#   rtt    = (t4 - t1) - (t3 - t2)            round trip, less the receiver's turnaround
+#
+# As in NTP's clock filter, the offset kept is that of the lowest-RTT sample among the recent
+# ones: the one that queued least, so whose paths were the most symmetric. Each PING also
+# carries the sender's current estimate, so the receiver can correct the frames that follow on
+# that stream: one-way latency = receive time - offset - sent-ts. Only peers advertising META_KEY
+# in their Consul service Meta are pinged.
+####################################################################################################
+
+META_KEY = "clock"
+VERSION = "1"
+
+PING = 1
+PONG = 2
+# kind, t1, then t2 and t3 in a PONG, or the sender's offset and RTT estimates in a PING (NaN if none)
+_CLOCK = struct.Struct("!Bddd")
+
+
+def peer_supports(meta : dict) -> bool:
+    return VERSION in (meta or {}).get(META_KEY, "").split(",")
+
+
+def _frame(kind : int, t1 : float, a : float, b : float) -> tuple:
+    header = frameHeader.render_binary(
+        0, [], t1, flags=frameHeader.FLAG_CONTROL,
+        extensions={frameHeader.EXT_CLOCK: _CLOCK.pack(kind, t1, a, b)},
+    )
+    return (header,)
+
+
+def parse(header : dict) -> tuple:
+    """
+    (kind, t1, a, b) of a clock control frame, or None for another control frame.
+    """
+    value = header.get("ext", {}).get(frameHeader.EXT_CLOCK)
+    if value is None or len(value) != _CLOCK.size:
+        return None
+    return _CLOCK.unpack(value)
+
+
+def _or_nan(value):
+    return math.nan if value is None else value
+
+
+class ClockEstimate:
+    """
+    Sender side: offset and RTT of one peer, from the PING/PONG exchanges on the stream to it.
+    """
+    # Samples the offset is picked from
+    WINDOW = 8
+
+    def __init__(self):
+        self.offset = None      # seconds, peer clock minus ours
+        self.rtt = None         # seconds, smoothed like TCP's SRTT
+        self.last_rtt = None
+        self.exchanges = 0
+        self._samples = deque(maxlen=self.WINDOW)   # (rtt, offset)
+        self._t1 = None
+        # Scheduling, kept by Node: stream generation and time (monotonic) of the last attempt
+        self.generation = None
+        self.attempted_at = None
+
+
+    def ping(self) -> tuple:
+        """
+        A new PING frame; the exchange it starts supersedes any earlier one.
+        """
+        self._t1 = time.time()
+        return _frame(PING, self._t1, _or_nan(self.offset), _or_nan(self.rtt))
+
+
+    def is_reply(self, header : dict) -> bool:
+        message = parse(header)
+        return message is not None and message[0] == PONG and message[1] == self._t1
+
+
+    def update(self, header : dict, t4 : float) -> tuple:
+        """
+        Fold in the PONG answering the last ping(), received at ``t4``.
+        Returns this sample's (rtt, offset).
+        """
+        _, t1, t2, t3 = parse(header)
+        rtt = max((t4 - t1) - (t3 - t2), 0.0)
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        self._samples.append((rtt, offset))
+        self.last_rtt = rtt
+        self.rtt = rtt if self.rtt is None else self.rtt + (rtt - self.rtt) / 8
+        self.offset = min(self._samples)[1]
+        self.exchanges += 1
+        return rtt, offset
+
+
+    def stats(self) -> dict:
+        return {
+            'offset_s': self.offset,
+            'rtt_s': self.rtt,
+            'last_rtt_s': self.last_rtt,
+            'exchanges': self.exchanges,
+        }
+
+
+class PeerClock:
+    """
+    Receiver side, one per inbound stream: answers the sender's PINGs and keeps the
+    estimate they carry, to correct the latency of the frames that follow.
+    """
+    def __init__(self):
+        self.offset = None      # seconds, our clock minus the sender's
+        self.rtt = None
+
+
+    def reply(self, header : dict, received : float = None) -> tuple:
+        """
+        PONG frame answering the PING ``header`` (received at ``received``),
+        or None when it is not a PING.
+        """
+        t2 = received if received is not None else time.time()
+        message = parse(header)
+        if message is None or message[0] != PING:
+            return None
+        _, t1, offset, rtt = message
+        self.offset = None if math.isnan(offset) else offset
+        self.rtt = None if math.isnan(rtt) else rtt
+        return _frame(PONG, t1, t2, time.time())
@@ -0,0 +1,265 @@
+import functools
+import io
+import json
+import logging
+import pickle
+import sys
+import numpy as np
+
+####################################################################################################
+# Payload codecs, chosen per frame: the header carries the codec id ("codec" in the JSON header,
+# the codec byte of the binary one; absent means pickle). A codec turns the payload into
+# (content, *buffers) segments and back; buffers travel out of band after the content.
+#
+#   0 pickle : pickle.dumps, or protocol 5 with out-of-band arrays in zero-copy mode
+#   1 typed  : tagged JSON tree + raw buffers for ndarray / torch.Tensor / bytes / NumPy scalars.
+#              Never executes code on decode. Payloads it cannot represent fall back to pickle.
+#
+# Receivers list the codecs they accept in their Consul service Meta (META_KEY); peers that
+# advertise nothing are legacy and get pickle.
+####################################################################################################
+
+PICKLE = 0
+TYPED = 1
+
+META_KEY = "codecs"
+
+_json_encoder = json.JSONEncoder(separators=(",", ":"))
+_dtype = functools.lru_cache(maxsize=None)(np.dtype)
+
+
+class _ZeroCopyPickler(pickle.Pickler):
+    """
+    Protocol 5 pickler that routes CPU torch tensors through NumPy, so their data
+    leaves as a PickleBuffer (out-of-band) instead of an in-band torch.save copy.
+    torch is looked up in sys.modules only: it is never imported here.
+    """
+    def reducer_override(self, obj):
+        torch = sys.modules.get("torch")
+        if torch is not None and isinstance(obj, torch.Tensor):
+            if (obj.device.type == "cpu" and obj.layout == torch.strided
+                    and not obj.requires_grad and obj.is_contiguous()):
+                try:
+                    return torch.from_numpy, (obj.numpy(),)
+                except (TypeError, RuntimeError):
+                    # dtype without a NumPy equivalent (bfloat16...): default reduction
+                    pass
+        return NotImplemented
+
+
+class PickleCodec:
+    codec_id = PICKLE
+    name = "pickle"
+
+    def encode(self, obj, zero_copy : bool = False) -> tuple:
+        if zero_copy:
+            pickle_buffers = []
+            out = io.BytesIO()
+            _ZeroCopyPickler(out, protocol=5, buffer_callback=pickle_buffers.append).dump(obj)
+            return (out.getbuffer(), *(buf.raw() for buf in pickle_buffers))
+        return (pickle.dumps(obj),)
+
+
+    def decode(self, content, buffers=None):
+        return pickle.loads(content, buffers=buffers or ())
+
+
+class TypedCodec:
+    """
+    Node of the tree: JSON scalars and lists as is, anything else a one-key dict
+    {tag: args}. Built-in tags: "D" dict with str keys, "d" other dicts as
+    [key, value] pairs, "t" tuple, "a" ndarray, "T" torch tensor, "g" NumPy
+    scalar, "b" bytes, "y" bytearray. register_type() adds more.
+    """
+    codec_id = TYPED
+    name = "typed"
+
+    def __init__(self):
+        self._encoders = {}     # { type : (tag, encode) }
+        self._decoders = {}     # { tag : decode }
+        self.register_type(np.ndarray, "a", self._encode_ndarray, self._decode_ndarray)
+        self.register_type(bytes, "b", self._encode_bytes, lambda args, buffers: bytes(buffers[args]))
+        self.register_type(bytearray, "y", self._encode_bytes, lambda args, buffers: buffers[args])
+        self._decoders["g"] = self._decode_scalar
+        self._decoders["T"] = self._decode_tensor
+
+
+    def register_type(self, cls, tag : str, encode, decode):
+        """
+        Teach the codec an exact type (subclasses are not matched).
+        :param encode: (obj, add_buffer) -> JSON-able args; add_buffer(buffer) returns its index.
+        :param decode: (args, buffers) -> obj.
+        """
+        self._encoders[cls] = (tag, encode)
+        self._decoders[tag] = decode
+
+
+    # --- encoding ---
+
+    def encode(self, obj, zero_copy : bool = False) -> tuple:
+        """
+        Raises TypeError for payloads holding a type the codec cannot represent.
+        Without zero_copy the buffers are copied, so the payload may change after this call.
+        """
+        buffers = []
+
+        def add_buffer(buf) -> int:
+            buffers.append(buf)
+            return len(buffers) - 1
+
+        tree = self._encode(obj, add_buffer)
+        if not zero_copy:
+            buffers = [bytes(buf) for buf in buffers]
+        return (_json_encoder.encode(tree).encode("utf-8"), *buffers)
+
+
+    def _encode(self, obj, add_buffer):
+        t = type(obj)
+        if obj is None or t is str or t is int or t is float or t is bool:
+            return obj
+        if t is np.ndarray:
+            return {"a": self._encode_ndarray(obj, add_buffer)}
+        if t is list:
+            return [self._encode(x, add_buffer) for x in obj]
+        if t is tuple:
+            return {"t": [self._encode(x, add_buffer) for x in obj]}
+        if t is dict:
+            if all(type(k) is str for k in obj):
+                return {"D": {k: self._encode(v, add_buffer) for k, v in obj.items()}}
+            return {"d": [[self._encode(k, add_buffer), self._encode(v, add_buffer)] for k, v in obj.items()]}
+        handler = self._encoders.get(t)
+        if handler is not None:
+            tag, encode = handler
+            return {tag: encode(obj, add_buffer)}
+        if isinstance(obj, np.generic) and not obj.dtype.hasobject and obj.dtype.fields is None:
+            return {"g": [add_buffer(pickle.PickleBuffer(np.ascontiguousarray(obj)).raw()), obj.dtype.str]}
+        torch = sys.modules.get("torch")
+        if torch is not None and isinstance(obj, torch.Tensor):
+            return {"T": self._encode_tensor(obj, torch, add_buffer)}
+        raise TypeError(f"typed codec cannot encode {t.__name__}")
+
+
+    @staticmethod
+    def _encode_ndarray(arr, add_buffer):
+        if arr.dtype.hasobject or arr.dtype.fields is not None:
+            raise TypeError(f"typed codec cannot encode arrays of dtype {arr.dtype}")
+        if not arr.flags.c_contiguous:
+            arr = np.ascontiguousarray(arr)
+        return [add_buffer(pickle.PickleBuffer(arr).raw()), arr.dtype.str, list(arr.shape)]
+
+
+    def _encode_tensor(self, tensor, torch, add_buffer):
+        if tensor.device.type != "cpu" or tensor.layout != torch.strided or tensor.requires_grad:
+            raise TypeError("typed codec only encodes CPU, strided tensors without grad")
+        try:
+            arr = tensor.contiguous().numpy()
+        except (TypeError, RuntimeError):
+            raise TypeError(f"typed codec cannot encode tensors of dtype {tensor.dtype}")
+        return self._encode_ndarray(arr, add_buffer)
+
+
+    @staticmethod
+    def _encode_bytes(obj, add_buffer):
+        return add_buffer(memoryview(obj))
+
+
+    # --- decoding ---
+
+    def decode(self, content, buffers=None):
+        tree = json.loads(bytes(content))
+        return self._decode(tree, buffers or [])
+
+
+    def _decode(self, node, buffers):
+        t = type(node)
+        if t is list:
+            return [self._decode(x, buffers) for x in node]
+        if t is not dict:
+            return node
+        (tag, args), = node.items()
+        if tag == "D":
+            return {k: self._decode(v, buffers) for k, v in args.items()}
+        if tag == "t":
+            return tuple(self._decode(x, buffers) for x in args)
+        if tag == "d":
+            return {self._decode(k, buffers): self._decode(v, buffers) for k, v in args}
+        decode = self._decoders.get(tag)
+        if decode is None:
+            raise ValueError(f"typed codec: unknown tag {tag!r}")
+        return decode(args, buffers)
+
+
+    @staticmethod
+    def _decode_ndarray(args, buffers):
+        index, dtype, shape = args
+        # Over the receive buffer itself: no copy, and writable since it is a bytearray
+        return np.ndarray(shape, _dtype(dtype), buffers[index])
+
+
+    @staticmethod
+    def _decode_scalar(args, buffers):
+        index, dtype = args
+        return np.ndarray((), _dtype(dtype), buffers[index])[()]
+
+
+    def _decode_tensor(self, args, buffers):
+        import torch
+        return torch.from_numpy(self._decode_ndarray(args, buffers))
+
+
+_codecs = {}
+
+
+def register(codec):
+    _codecs[codec.codec_id] = codec
+
+
+def get(codec_id : int):
+    try:
+        return _codecs[codec_id]
+    except KeyError:
+        raise ValueError(f"Unknown codec id {codec_id}.")
+
+
+def by_name(name : str):
+    for codec in _codecs.values():
+        if codec.name == name:
+            return codec
+    raise ValueError(f"Unknown codec {name!r}.")
+
+
+def accepted(meta : dict) -> set:
+    """
+    Codec ids a peer accepts, from its Consul service Meta (legacy peers: pickle only).
+    """
+    names = (meta or {}).get(META_KEY)
+    if not names:
+        return {PICKLE}
+    return {c.codec_id for c in _codecs.values() if c.name in names.split(",")}
+
+
+def advertise(allow_pickle : bool = True) -> str:
+    return ",".join(c.name for c in _codecs.values() if allow_pickle or c.codec_id != PICKLE)
+
+
+def encode(obj, codec_id : int = PICKLE, zero_copy : bool = False) -> tuple:
+    """
+    Encode with ``codec_id``, falling back to pickle for payloads it cannot represent.
+    Returns (codec id used, segments).
+    """
+    if codec_id != PICKLE:
+        try:
+            return codec_id, get(codec_id).encode(obj, zero_copy)
+        except TypeError as e:
+            logging.debug(f"[CODEC] {e}; falling back to pickle")
+    return PICKLE, _codecs[PICKLE].encode(obj, zero_copy)
+
+
+def decode(codec_id : int, content, buffers=None, allow_pickle : bool = True):
+    if codec_id == PICKLE and not allow_pickle:
+        raise ValueError("Refused a pickle frame (allow_pickle is off).")
+    return get(codec_id).decode(content, buffers)
+
+
+register(PickleCodec())
+register(TypedCodec())
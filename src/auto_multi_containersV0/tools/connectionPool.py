@@ -0,0 +1,369 @@
+import socket
+import select
+import threading
+import logging
+import time
+import frameHeader
+from sendMessageHandler import SendMessageHandler
+
+
+class StreamReset(ConnectionError):
+    """
+    The stream a chunked frame was going out on has been reopened (or must be):
+    the peer lost the chunks already sent, so the frame has to start over.
+    """
+
+
+class PeerConnection:
+    def __init__(self, svc_id, addr):
+        """
+        One long-lived stream to a peer, reused for every frame sent to it.
+        :param svc_id: Consul service ID of the peer (the pool key).
+        :param addr: (host, port) the stream is (or will be) connected to.
+        """
+        self.svc_id = svc_id
+        self.addr = addr
+        self.sock = None
+        self.handler = None
+        # Serialises writes so concurrent dispatch threads never interleave frames
+        self.lock = threading.Lock()
+        self.connected_at = None
+        self.last_used = time.time()
+        self.frames_sent = 0
+        self.opens = 0
+        self.reconnects = 0
+        # Pool-wide number of the current socket, to tell a reopened stream apart
+        self.generation = None
+        # Control frames received from the peer but not parsed yet, and whether it closed
+        self.replies = bytearray()
+        self.eof = False
+        # (is_reply, event, [reply]) of the request() waiting on this stream
+        self.waiter = None
+
+
+    def is_stale(self) -> bool:
+        """
+        The receiving side only writes back control frames, which the pool's reader
+        thread consumes, so a readable socket here means the peer sent FIN/RST (idle
+        eviction, container restart...); the reader flags the EOFs it sees first.
+        Checked before each send because the first sendall() on a half-closed socket
+        usually still succeeds.
+        """
+        if self.sock is None or self.eof:
+            return True
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return False
+            # non-blocking: the reader thread may have taken the bytes since the select()
+            return self.sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except BlockingIOError:
+            return False
+        except (OSError, ValueError):
+            return True
+
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.handler = None
+        self.connected_at = None
+        self.replies = bytearray()
+        self.eof = False
+
+
+class ConnectionPool:
+    def __init__(self, connect, idle_timeout : float = 60.0, max_retries : int = 1,
+                 greeting=None, on_reply=None):
+        """
+        :param connect: Callable (addr) -> connected socket or None, addr being
+                        (host, port) or the path of a Unix domain socket.
+        :param idle_timeout: Seconds a stream may stay unused before it is closed.
+        :param max_retries: Transparent reconnects attempted when a send fails.
+        :param greeting: Callable (svc_id) -> control frame to write first on every
+                         new stream to that peer, or None.
+        :param on_reply: Callable (svc_id, generation, header, receipt time) called by
+                         the reader thread for the control frames peers write back,
+                         other than the replies request() is waiting for.
+        """
+        self._connect = connect
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.greeting = greeting
+        self.on_reply = on_reply
+        self._conns = {}    # { svc_id : PeerConnection }
+        self._lock = threading.Lock()
+        self._counters = {
+            'connects': 0,
+            'reuses': 0,
+            'reconnects': 0,
+            'evictions': 0,
+            'failures': 0,
+        }
+        # Wakes the reader thread up when a stream is opened, to watch it too
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        threading.Thread(target=self._reaper, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+
+    def _get(self, svc_id, addr) -> PeerConnection:
+        with self._lock:
+            conn = self._conns.get(svc_id)
+            if conn is None:
+                conn = PeerConnection(svc_id, addr)
+                self._conns[svc_id] = conn
+            return conn
+
+
+    def _open(self, conn : PeerConnection, addr):
+        """
+        (Re)connect ``conn`` to ``addr``. Must be called with ``conn.lock`` held.
+        """
+        conn.close()
+        sock = self._connect(addr)
+        if sock is None:
+            raise ConnectionError(f"connect failed to {addr}")
+        if sock.family != getattr(socket, "AF_UNIX", None):
+            # Frames are written with one sendall each; don't let Nagle hold the tail segment
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        conn.sock = sock
+        conn.addr = addr
+        conn.handler = SendMessageHandler(sock, addr)
+        conn.connected_at = time.time()
+        with self._lock:
+            self._counters['connects'] += 1
+            conn.generation = self._counters['connects']
+            if conn.opens:
+                conn.reconnects += 1
+                self._counters['reconnects'] += 1
+        conn.opens += 1
+        greeting = self.greeting(conn.svc_id) if self.greeting is not None else None
+        if greeting is not None:
+            sock.sendall(b"".join(greeting))
+        self._wakeup_w.send(b"\0")
+
+
+    def send(self, svc_id, addr, frame : bytes, variables=(), generation : int = None) -> int:
+        """
+        Write one encoded frame to the peer over its pooled stream, opening or
+        re-opening the stream as needed. Raises if every attempt failed.
+        Returns the generation of the stream written to. With ``generation`` (the
+        chunks of a frame after the first), the frame is only written to that same
+        stream: StreamReset is raised instead of reconnecting.
+        """
+        conn = self._get(svc_id, addr)
+        with conn.lock:
+            if generation is not None and (conn.generation != generation or conn.addr != addr or conn.is_stale()):
+                raise StreamReset(f"stream to {svc_id} was reopened")
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if conn.addr != addr or conn.is_stale():
+                        self._open(conn, addr)
+                    else:
+                        with self._lock:
+                            self._counters['reuses'] += 1
+                    conn.handler.send_frame(frame, variables)
+                    conn.last_used = time.time()
+                    conn.frames_sent += 1
+                    return conn.generation
+                except OSError as e:
+                    conn.close()
+                    with self._lock:
+                        self._counters['failures'] += 1
+                    if generation is not None:
+                        raise StreamReset(f"send to {svc_id} at {addr} failed ({e})")
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(f"[POOL] send to {svc_id} at {addr} failed ({e}); reconnecting")
+
+
+    def generation(self, svc_id):
+        """
+        Generation of the open stream to ``svc_id``, or None when there is none.
+        """
+        with self._lock:
+            conn = self._conns.get(svc_id)
+        if conn is None or conn.sock is None:
+            return None
+        return conn.generation
+
+
+    def request(self, svc_id, make_frame, is_reply, timeout : float = 1.0):
+        """
+        Write the control frame returned by make_frame() on the open stream to
+        ``svc_id`` and wait for the peer's reply, the first control frame for which
+        is_reply(header) holds. The frame is built once the stream is ours, so that
+        timestamps it carries are taken just before it is written. Never opens a
+        stream. Returns (reply header, time.time() at receipt, stream generation),
+        or None when the stream is closed or no reply came within ``timeout``.
+        """
+        with self._lock:
+            conn = self._conns.get(svc_id)
+        if conn is None:
+            return None
+        waiter = (is_reply, threading.Event(), [])
+        with conn.lock:
+            if conn.is_stale():
+                return None
+            sock, generation = conn.sock, conn.generation
+            conn.waiter = waiter
+            try:
+                sock.sendall(b"".join(make_frame()))
+            except (OSError, ValueError):
+                conn.waiter = None
+                return None
+        # Wait outside the lock: frames keep going out to the peer meanwhile
+        waiter[1].wait(timeout)
+        conn.waiter = None
+        if not waiter[2] or conn.sock is not sock:
+            return None
+        header, received = waiter[2][0]
+        return header, received, generation
+
+
+    def _read_loop(self):
+        """
+        Background thread reading the control frames peers write back on every open
+        stream: replies to request(), handed to on_reply otherwise.
+        """
+        while True:
+            with self._lock:
+                conns = {c.sock: c for c in self._conns.values() if c.sock is not None and not c.eof}
+            try:
+                readable, _, _ = select.select([self._wakeup_r, *conns], [], [], 1.0)
+            except (OSError, ValueError):
+                # a stream was closed meanwhile: look again
+                time.sleep(0.01)
+                continue
+            for sock in readable:
+                if sock is self._wakeup_r:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                conn = conns[sock]
+                try:
+                    replies = self._read_replies(conn, sock)
+                except BlockingIOError:
+                    continue
+                except (OSError, ValueError) as e:
+                    if conn.sock is sock:
+                        # is_stale() reports it; the next send reopens the stream
+                        conn.eof = True
+                        if not isinstance(e, ConnectionError):
+                            logging.warning(f"[POOL] stream to {conn.svc_id} unusable: {e}")
+                    continue
+                for header, received in replies:
+                    self._dispatch(conn, header, received)
+
+
+    def _dispatch(self, conn : PeerConnection, header : dict, received : float):
+        waiter = conn.waiter
+        if waiter is not None and not waiter[2] and waiter[0](header):
+            waiter[2].append((header, received))
+            waiter[1].set()
+        elif self.on_reply is not None:
+            try:
+                self.on_reply(conn.svc_id, conn.generation, header, received)
+            except Exception:
+                logging.exception(f"[POOL] handling a control frame from {conn.svc_id} failed")
+
+
+    def _read_replies(self, conn : PeerConnection, sock : socket.socket) -> list:
+        """
+        Receive what ``sock`` has into conn.replies and return the complete control
+        frames in it, as [(header, receipt time)].
+        """
+        data = sock.recv(64 * 1024, socket.MSG_DONTWAIT)
+        received = time.time()
+        if not data:
+            raise ConnectionError("peer closed")
+        if conn.sock is not sock:
+            raise ConnectionError("stream reopened")
+        conn.replies += data
+        replies = []
+        while conn.replies:
+            if not frameHeader.is_binary(conn.replies[:2]):
+                conn.replies.clear()
+                raise ValueError("unexpected data from the receiving side")
+            header, used = frameHeader.parse_binary(conn.replies)
+            if header is None or len(conn.replies) < used + header["content-length"]:
+                break
+            del conn.replies[:used + header["content-length"]]
+            replies.append((header, received))
+        return replies
+
+
+    def discard(self, svc_id):
+        """
+        Close and forget the stream to ``svc_id`` (e.g. the peer left Consul).
+        """
+        with self._lock:
+            conn = self._conns.pop(svc_id, None)
+        if conn is not None:
+            with conn.lock:
+                conn.close()
+            logging.info(f"[POOL] discarded connection to {svc_id}")
+
+
+    def retain(self, svc_ids):
+        """
+        Discard every pooled stream whose peer is not in ``svc_ids``.
+        """
+        with self._lock:
+            gone = [svc_id for svc_id in self._conns if svc_id not in svc_ids]
+        for svc_id in gone:
+            self.discard(svc_id)
+
+
+    def _reaper(self):
+        """
+        Background thread closing streams that have been idle for too long.
+        A stream busy sending is skipped and looked at again on the next pass.
+        """
+        while True:
+            time.sleep(max(self.idle_timeout / 4, 1))
+            now = time.time()
+            with self._lock:
+                conns = list(self._conns.values())
+            for conn in conns:
+                if conn.sock is None or now - conn.last_used < self.idle_timeout:
+                    continue
+                if not conn.lock.acquire(blocking=False):
+                    continue
+                try:
+                    conn.close()
+                finally:
+                    conn.lock.release()
+                with self._lock:
+                    self._counters['evictions'] += 1
+                logging.info(f"[POOL] evicted idle connection to {conn.svc_id} at {conn.addr}")
+
+
+    def stats(self) -> dict:
+        """
+        Snapshot of the pool counters and of every pooled stream.
+        """
+        now = time.time()
+        with self._lock:
+            stats = dict(self._counters)
+            conns = list(self._conns.values())
+        stats['open'] = sum(1 for c in conns if c.sock is not None)
+        stats['peers'] = {
+            c.svc_id: {
+                'addr': c.addr,
+                'open': c.sock is not None,
+                'idle_s': now - c.last_used,
+                'frames_sent': c.frames_sent,
+                'reconnects': c.reconnects,
+            }
+            for c in conns
+        }
+        return stats
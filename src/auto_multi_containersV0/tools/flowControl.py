@@ -0,0 +1,280 @@
+import struct
+import threading
+import time
+import frameHeader
+
+####################################################################################################
+# Credit-based flow control between a sender and the receivers it streams frames to.
+#
+# A sender opening a stream to a peer advertising META_KEY writes a HELLO control frame first
+# (a binary header flagged FLAG_CONTROL with an EXT_CREDIT extension). From then on the receiver
+# writes back on the same stream GRANTs holding an absolute limit: the number of frames the
+# sender may have sent on this stream in total. The receiver sets it to the frames it has
+# consumed (their on_receive callbacks finished, or dropped) plus its free room: credit_window,
+# or less when the on_receive queue of that sender has fewer free slots. The sender counts what
+# it sent on the stream and stops starting new frames once it reached the limit; the frames
+# queued for the peer then wait in the sender's pending store, where send_data_to_peers()
+# applies the policy (block, drop or coalesce) instead of letting the backlog grow.
+#
+# GRANTs also report (EXT_CONSUMED) the frames consumed so far, so the sender knows how many of
+# those it sent are still being worked on at the peer (least_outstanding routing). A receiver
+# that runs out of work reports it at once, even when the grant would not raise the limit.
+#
+# Limits are absolute so a lost or reordered grant costs nothing but delay, and they are per
+# stream: a reopened stream starts over with INITIAL credits. A sender that heard nothing for
+# PROBE_AFTER seconds with no credit left may send one frame anyway (like TCP's persist timer),
+# so a lost grant or a miscount can never stall a peer for good.
+####################################################################################################
+
+META_KEY = "credits"
+VERSION = "1"
+
+HELLO = 1
+GRANT = 2
+# kind, then the frame limit of a GRANT (0 in a HELLO)
+_CREDIT = struct.Struct("!BQ")
+# frames consumed, in a GRANT
+_CONSUMED = struct.Struct("!Q")
+
+# Frames a sender may send on a new stream before the first grant
+INITIAL = 1
+PROBE_AFTER = 5.0
+
+POLICIES = ("block", "drop", "coalesce")
+
+
+def peer_supports(meta : dict) -> bool:
+    return VERSION in (meta or {}).get(META_KEY, "").split(",")
+
+
+def parse_policy(policy : str) -> str:
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown flow control policy {policy!r} (expected one of {', '.join(POLICIES)})")
+    return policy
+
+
+def _frame(kind : int, limit : int = 0, consumed : int = None) -> tuple:
+    extensions = {frameHeader.EXT_CREDIT: _CREDIT.pack(kind, limit)}
+    if consumed is not None:
+        extensions[frameHeader.EXT_CONSUMED] = _CONSUMED.pack(consumed)
+    header = frameHeader.render_binary(0, [], time.time(), flags=frameHeader.FLAG_CONTROL, extensions=extensions)
+    return (header,)
+
+
+def hello() -> tuple:
+    return _frame(HELLO)
+
+
+def parse(header : dict) -> tuple:
+    """
+    (kind, limit) of a credit control frame, or None for another control frame.
+    """
+    value = header.get("ext", {}).get(frameHeader.EXT_CREDIT)
+    if value is None or len(value) != _CREDIT.size:
+        return None
+    return _CREDIT.unpack(value)
+
+
+def consumed(header : dict) -> int:
+    """
+    Frames consumed on the stream that a GRANT reports, or None (from an older peer).
+    """
+    value = header.get("ext", {}).get(frameHeader.EXT_CONSUMED)
+    if value is None or len(value) != _CONSUMED.size:
+        return None
+    return _CONSUMED.unpack(value)[0]
+
+
+class CreditWindow:
+    """
+    Sender side, one per peer: the credits left on the current stream to it.
+    """
+    def __init__(self):
+        self.generation = None      # stream the counts below are for
+        self.limit = INITIAL
+        self.sent = 0
+        self.consumed = None        # frames the peer reported consumed (None: it does not report)
+        self.grants = 0
+        self.probes = 0
+        # Set by the sender when a delivery to the peer failed, until the next one succeeds
+        self.unreachable = False
+        self._granted_at = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def _sync(self, generation):
+        if generation != self.generation:
+            self.generation = generation
+            self.limit = INITIAL
+            self.sent = 0
+            if self.consumed is not None:
+                self.consumed = 0
+            self._granted_at = time.monotonic()
+
+
+    def available(self, generation) -> int:
+        """
+        Frames that may be started now on stream ``generation`` (None: no stream
+        yet, the next send opens one).
+        """
+        with self._lock:
+            self._sync(generation)
+            if self.sent >= self.limit and time.monotonic() - self._granted_at >= PROBE_AFTER:
+                return 1
+            return max(self.limit - self.sent, 0)
+
+
+    def in_flight(self, generation) -> int:
+        """
+        Frames sent on stream ``generation`` that the peer has not reported consumed
+        yet, or None if it does not report them.
+        """
+        with self._lock:
+            self._sync(generation)
+            if self.consumed is None:
+                return None
+            return max(self.sent - self.consumed, 0)
+
+
+    def spend(self, generation):
+        """
+        Account for a frame written on stream ``generation``.
+        """
+        with self._lock:
+            self._sync(generation)
+            self.unreachable = False
+            self.sent += 1
+            if self.sent > self.limit:
+                # a probe: wait PROBE_AFTER again before the next one
+                self.limit = self.sent
+                self._granted_at = time.monotonic()
+                self.probes += 1
+
+
+    def grant(self, generation, limit : int, consumed : int = None) -> bool:
+        """
+        Fold in a GRANT received on stream ``generation``, with the frames consumed
+        it reports. Returns whether it raised the limit.
+        """
+        with self._lock:
+            if self.generation is not None and generation is not None and generation < self.generation:
+                # from a stream that has been replaced since
+                return False
+            self._sync(generation)
+            if consumed is not None:
+                self.consumed = max(consumed, self.consumed or 0)
+            self._granted_at = time.monotonic()
+            self.grants += 1
+            if limit <= self.limit:
+                return False
+            self.limit = limit
+            return True
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'sent': self.sent,
+                'available': max(self.limit - self.sent, 0),
+                'in_flight': None if self.consumed is None else max(self.sent - self.consumed, 0),
+                'grants': self.grants,
+                'probes': self.probes,
+            }
+
+
+class CreditGrant:
+    def __init__(self, window : int, free=None, send=None):
+        """
+        Receiver side, one per inbound stream: grants the sender credits as its frames are consumed.
+        :param window: Frames the sender may have in flight at most.
+        :param free: Callable (sender key) -> free slots of the queue its frames go to,
+                     or None when they are not queued.
+        :param send: Callable (frame) writing a control frame back on the stream.
+        Nothing is granted until the sender's HELLO, so senders that do not read
+        grants never get any.
+        """
+        self.window = max(int(window), 1)
+        self.free = free
+        self.send = send
+        self.key = None
+        self.active = False
+        self.received = 0
+        self.consumed = 0
+        self.granted = 0
+        self.reported = 0       # consumed count sent in the last GRANT
+        self._lock = threading.Lock()
+
+
+    def _due_locked(self):
+        room = self.window
+        if self.free is not None and self.key is not None:
+            free = self.free(self.key)
+            if free is not None:
+                room = min(room, free)
+        # at least one frame in flight, or a sender that has none would never get a grant
+        limit = self.consumed + max(room, 1)
+        step = max(self.window // 4, 1)
+        idle = self.consumed >= self.received
+        if ((limit > self.granted and (limit - self.granted >= step or self.granted - self.consumed < step))
+                or (idle and self.consumed > self.reported)):
+            self.granted = max(limit, self.granted)
+            self.reported = self.consumed
+            return _frame(GRANT, self.granted, self.consumed)
+        return None
+
+
+    def _send(self, frame):
+        if frame is not None and self.send is not None:
+            self.send(frame)
+
+
+    def hello(self):
+        with self._lock:
+            self.active = True
+            self.granted = 0
+            frame = self._due_locked()
+        self._send(frame)
+
+
+    def consume(self):
+        """
+        A frame of this stream was consumed (processed or dropped).
+        """
+        with self._lock:
+            self.consumed += 1
+            frame = self._due_locked() if self.active else None
+        self._send(frame)
+
+
+    def drop(self):
+        """
+        A frame of this stream was dropped before reaching any callback.
+        """
+        with self._lock:
+            self.received += 1
+        self.consume()
+
+
+    def frame(self, key, jobs : int):
+        """
+        A frame of sender ``key`` was received, handing ``jobs`` callbacks to the queue.
+        Returns the callable each of them must call when done (None without jobs:
+        the frame is consumed already).
+        """
+        self.key = key
+        with self._lock:
+            self.received += 1
+        if jobs <= 0:
+            self.consume()
+            return None
+        left = [jobs]
+        lock = threading.Lock()
+
+        def done():
+            with lock:
+                left[0] -= 1
+                last = left[0] == 0
+            if last:
+                self.consume()
+        return done
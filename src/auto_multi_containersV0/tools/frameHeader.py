@@ -0,0 +1,155 @@
+import json
+import struct
+import sys
+
+####################################################################################################
+# Frame headers. Two formats share the wire, told apart by the first two bytes:
+#
+#   legacy JSON : >H length of the JSON header, then the JSON header
+#                 {"byteorder", "content-length", "sent-ts" [, "buffers", "codec", "compression", "deadline"]}
+#   binary v1   : fixed struct (network order), then nbufs x >Q buffer lengths, then ext_len
+#                 bytes of TLV extensions (>B type, >H length, value); unknown types are skipped
+#
+# Both are followed by the content and the out-of-band buffers. A JSON header would have to be
+# 0xA77A bytes (~42 KB) long to start with MAGIC, which the legacy sender never produces.
+# Receivers accept both; a sender only uses the binary header with peers advertising it in
+# their Consul service Meta, so mixed-version deployments keep working.
+####################################################################################################
+
+MAGIC = b"\xA7\x7A"
+VERSION = 1
+# magic, version, flags, codec, (pad), nbufs, ext_len, content-length, sent-ts, seq, trace id
+FIXED = struct.Struct("!2sBBBxHHQdQ16s")
+_BUFLEN = struct.Struct("!Q")
+_TLV = struct.Struct("!BH")
+LEGACY_PREFIX = 2
+
+# Consul service Meta entry listing the binary header versions a node can receive
+META_KEY = "frame_header"
+
+# Flags
+FLAG_CHUNK = 0x01       # one slice of a larger frame (see chunkStream); seq is the stream id
+FLAG_SHM = 0x02         # descriptor of a frame passed through shared memory (see shmTransport)
+FLAG_CONTROL = 0x04     # no payload: a message between the two nodes themselves (see clockSync, flowControl)
+
+# Extension types
+EXT_COMPRESSION = 1     # >B algorithm id, then >Q original length of each segment
+EXT_CHUNK = 2           # >H segment index, >Q offset in that segment of the chunk's data
+EXT_CHUNK_OPEN = 3      # binary header of the chunked frame, on its first chunk only
+EXT_SHM = 4             # >B name length, /dev/shm file name, binary header of the frame it holds
+EXT_CLOCK = 5           # >B kind, then three >d timestamps (see clockSync)
+EXT_CREDIT = 6          # >B kind, >Q frame limit (see flowControl)
+EXT_DEADLINE = 7        # >d time (sender clock) after which the frame is not worth decoding
+EXT_CONSUMED = 8        # >Q frames consumed so far on the stream, next to a credit grant (see flowControl)
+
+_DEADLINE = struct.Struct("!d")
+
+
+def is_binary(prefix) -> bool:
+    return bytes(prefix[:2]) == MAGIC
+
+
+def peer_supports_binary(meta : dict) -> bool:
+    return str(VERSION) in (meta or {}).get(META_KEY, "").split(",")
+
+
+def render_json(content_length : int, buffer_lengths, sent_ts : float, codec : int = 0,
+                compression : list = None, deadline : float = None) -> bytes:
+    header = {
+        "byteorder": sys.byteorder,
+        "content-length": content_length,
+        "sent-ts": sent_ts,
+    }
+    if buffer_lengths:
+        header["buffers"] = list(buffer_lengths)
+    if codec:
+        # only sent to peers advertising the codec, so legacy receivers never see it
+        header["codec"] = codec
+    if compression:
+        header["compression"] = compression
+    if deadline is not None:
+        header["deadline"] = deadline
+    header_bytes = json.dumps(header).encode("utf-8")
+    return struct.pack(">H", len(header_bytes)) + header_bytes
+
+
+def render_binary(content_length : int, buffer_lengths, sent_ts : float, seq : int = 0,
+                  trace_id : bytes = b"", codec : int = 0, flags : int = 0, extensions : dict = None,
+                  compression : list = None, deadline : float = None) -> bytes:
+    if compression:
+        algo_id, lengths = compression
+        extensions = dict(extensions or {})
+        extensions[EXT_COMPRESSION] = struct.pack(f"!B{len(lengths)}Q", algo_id, *lengths)
+    if deadline is not None:
+        extensions = dict(extensions or {})
+        extensions[EXT_DEADLINE] = _DEADLINE.pack(deadline)
+    ext = b"".join(
+        _TLV.pack(ext_type, len(value)) + value for ext_type, value in (extensions or {}).items()
+    )
+    return b"".join((
+        FIXED.pack(MAGIC, VERSION, flags, codec, len(buffer_lengths), len(ext),
+                   content_length, sent_ts, seq, trace_id),
+        *(_BUFLEN.pack(n) for n in buffer_lengths),
+        ext,
+    ))
+
+
+def parse_fixed(data) -> tuple:
+    """
+    Decode the FIXED.size first bytes of a binary header.
+    Returns (header, n): n more header bytes (buffer lengths, extensions) follow.
+    """
+    magic, version, flags, codec, nbufs, ext_len, content_length, sent_ts, seq, trace_id = FIXED.unpack(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported binary header version {version}.")
+    header = {
+        "version": version,
+        "flags": flags,
+        "codec": codec,
+        "content-length": content_length,
+        "sent-ts": sent_ts,
+        "seq": seq,
+        "trace-id": trace_id.hex(),
+        "nbufs": nbufs,
+        "ext-length": ext_len,
+    }
+    return header, nbufs * _BUFLEN.size + ext_len
+
+
+def parse_variable(header : dict, data) -> dict:
+    """
+    Complete ``header`` with the buffer lengths and extensions that follow the fixed part.
+    """
+    data = bytes(data)
+    nbufs = header.pop("nbufs")
+    ext_len = header.pop("ext-length")
+    header["buffers"] = [_BUFLEN.unpack_from(data, i * _BUFLEN.size)[0] for i in range(nbufs)]
+    ext = {}
+    pos = nbufs * _BUFLEN.size
+    end = pos + ext_len
+    while pos < end:
+        ext_type, length = _TLV.unpack_from(data, pos)
+        pos += _TLV.size
+        ext[ext_type] = data[pos:pos + length]
+        pos += length
+    header["ext"] = ext
+    if EXT_COMPRESSION in ext:
+        value = ext[EXT_COMPRESSION]
+        algo_id, *lengths = struct.unpack(f"!B{(len(value) - 1) // 8}Q", value)
+        header["compression"] = [algo_id, lengths]
+    if EXT_DEADLINE in ext and len(ext[EXT_DEADLINE]) == _DEADLINE.size:
+        header["deadline"] = _DEADLINE.unpack(ext[EXT_DEADLINE])[0]
+    return header
+
+
+def parse_binary(data) -> tuple:
+    """
+    Decode the complete binary header at the start of ``data``.
+    Returns (header, bytes used), or (None, 0) while ``data`` holds only part of it.
+    """
+    if len(data) < FIXED.size:
+        return None, 0
+    header, n = parse_fixed(data[:FIXED.size])
+    if len(data) < FIXED.size + n:
+        return None, 0
+    return parse_variable(header, data[FIXED.size:FIXED.size + n]), FIXED.size + n
@@ -0,0 +1,102 @@
+import json
+import logging
+import threading
+import requests
+
+####################################################################################################
+# Consul health checks that stay off the data port.
+#
+# A TCP check on the data port costs the node an accepted connection, a receive thread and two
+# log lines per probe, and only tells Consul that the port is open. Instead the node answers
+# GET /health on its side (metrics) port with its readiness, and Consul polls that (http_check).
+# A node without a side port pushes the same report to a Consul TTL check (TTLReporter).
+#
+# Consul keeps an instance whose check is "warning" (HTTP 429) registered and only deregisters
+# it after it has been "critical" (unreachable, or the TTL not refreshed) for a while, so a node
+# that is starting, not ready yet (model loading) or saturated reports "warning", not "critical".
+# Senders read the same status from their watches: anycast targets prefer "passing" instances,
+# and deliveries to an instance that is not "passing" wait in the sender's pending store.
+####################################################################################################
+
+MODES = ("http", "ttl", "tcp")
+
+PASSING = "passing"
+WARNING = "warning"
+CRITICAL = "critical"
+
+_SEVERITY = {PASSING: 0, WARNING: 1, CRITICAL: 2}
+
+# Queue fill ratio from which a node reports itself saturated
+SATURATED = 0.9
+
+# HTTP status of /health for each Consul check status
+HTTP_STATUS = {PASSING: 200, WARNING: 429}
+
+
+def http_check(address : str, port : int, interval : str = "5s", deregister_after : str = "10s") -> dict:
+    return {
+        "HTTP": f"http://{address}:{port}/health",
+        "Method": "GET",
+        "Interval": interval,
+        "Timeout": "1s",
+        "DeregisterCriticalServiceAfter": deregister_after,
+    }
+
+
+def ttl_check(ttl : str = "15s", deregister_after : str = "30s") -> dict:
+    return {
+        "TTL": ttl,
+        # until the first update; Consul would start it "critical"
+        "Status": WARNING,
+        "DeregisterCriticalServiceAfter": deregister_after,
+    }
+
+
+def entry_status(entry : dict) -> str:
+    """
+    Status of an instance in a /v1/health/service response: the worst of its
+    checks (node and service), passing when it has none.
+    """
+    statuses = [check.get("Status") for check in entry.get("Checks") or []]
+    statuses = [status if status in _SEVERITY else CRITICAL for status in statuses]
+    return max(statuses, key=_SEVERITY.get, default=PASSING)
+
+
+def queue_fill(executors : dict) -> dict:
+    """
+    Fill ratio (0 to 1) of each executor's queue, from Node.executor_stats(); for a
+    keyed executor, that of its fullest stripe (where a sender would block first).
+    """
+    fill = {}
+    for name, stats in executors.items():
+        queued = max(stats.get('per_stripe') or [stats['queued']])
+        fill[name] = queued / stats['max_queue'] if stats['max_queue'] else 0.0
+    return fill
+
+
+class TTLReporter:
+    def __init__(self, consul_url : str, service_id : str, report, interval : float = 5.0):
+        """
+        Background thread pushing report() -> (status, details) to the TTL check of
+        service ``service_id`` every ``interval`` seconds (well within its TTL).
+        """
+        self.url = f"{consul_url}/v1/agent/check/update/service:{service_id}"
+        self.report = report
+        self.interval = interval
+        self._stop = threading.Event()
+        threading.Thread(target=self._run, name="health-ttl", daemon=True).start()
+
+
+    def _run(self):
+        while True:
+            try:
+                status, details = self.report()
+                requests.put(self.url, json={"Status": status, "Output": json.dumps(details)}, timeout=2)
+            except Exception as e:
+                logging.warning(f"[HEALTH] TTL check update failed: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,96 @@
+import logging
+import queue
+import threading
+import time
+import metrics
+
+####################################################################################################
+# Long-lived inference workers for the generated apps.
+#
+# The on_receive callbacks only submit() what they received; ``workers`` threads (one by default,
+# so the model is never called concurrently) block on the input queue, call compute(item) and
+# hand each result to on_result(result, context), typically a submit to a single-threaded output
+# executor that does the send_data_to_peers(), so the model never waits on the network. With
+# latest_only a worker that takes an input skips to the newest one queued, the older ones being
+# superseded before they cost a model call.
+# The input queue is bounded: submit() blocks while it is full, which holds back the on_receive
+# callbacks and, through them, the senders.
+####################################################################################################
+
+
+class InferenceWorker:
+    def __init__(self, compute, on_result, workers : int = 1, max_queue : int = 64, latest_only : bool = False,
+                 name : str = "inference"):
+        """
+        :param compute: Callable (input) -> result, e.g. content.run.
+        :param on_result: Callable (result, context) called by the worker with each result
+                          and the context its input was submitted with.
+        :param workers: Worker threads; results may be out of order with more than one.
+        :param max_queue: Inputs that may wait before submit() blocks.
+        :param latest_only: Compute only the newest input queued when a worker is free.
+        """
+        self.compute = compute
+        self.on_result = on_result
+        self.latest_only = latest_only
+        self.name = name
+        self._inputs = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._counters = {
+            'submitted': 0,
+            'computed': 0,
+            'failed': 0,
+            'superseded': 0,
+        }
+        self.workers = max(int(workers), 1)
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True).start()
+
+
+    def submit(self, item, context=None):
+        with self._lock:
+            self._counters['submitted'] += 1
+        self._inputs.put((item, context))
+
+
+    def _take(self) -> tuple:
+        item, context = self._inputs.get()
+        if self.latest_only:
+            superseded = 0
+            while True:
+                try:
+                    item, context = self._inputs.get_nowait()
+                except queue.Empty:
+                    break
+                superseded += 1
+            if superseded:
+                with self._lock:
+                    self._counters['superseded'] += superseded
+        return item, context
+
+
+    def _run(self):
+        while True:
+            item, context = self._take()
+            started = time.perf_counter()
+            try:
+                result = self.compute(item)
+            except Exception:
+                logging.exception(f"[INFERENCE] {self.name}: compute failed")
+                with self._lock:
+                    self._counters['failed'] += 1
+                continue
+            metrics.INFERENCE_SECONDS.observe(time.perf_counter() - started, worker=self.name)
+            with self._lock:
+                self._counters['computed'] += 1
+            try:
+                self.on_result(result, context)
+            except Exception:
+                logging.exception(f"[INFERENCE] {self.name}: handing over a result failed")
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['queued'] = self._inputs.qsize()
+        stats['workers'] = self.workers
+        return stats
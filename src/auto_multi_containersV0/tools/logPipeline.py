@@ -0,0 +1,128 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+####################################################################################################
+# Logging off the message hot path.
+#
+# install() puts a QueueHandler on the root logger and moves the real handlers (container.log,
+# stdout) behind a QueueListener thread, so a log call on a receive or dispatch thread only
+# formats its message and enqueues it: file and console I/O happen elsewhere.
+#
+# The lines logged once per frame or per variable go through allow(category) first: it keeps
+# one in ``sample_every`` and at most ``max_per_second`` per category (token bucket), and tells
+# the next line that gets through how many were skipped. Payloads are logged with summarize()
+# (type, shape, dtype, size) instead of their repr, which for arrays and tensors cost more than
+# sending them.
+####################################################################################################
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+
+def install(handlers, level : int = logging.INFO):
+    """
+    Route the root logger through a queue to ``handlers``. Returns the QueueListener;
+    it is stopped (and the queue flushed) at interpreter exit.
+    """
+    formatter = logging.Formatter(FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    # The message is rendered on the calling thread (its arguments may change afterwards);
+    # the listener's handlers add the timestamp and level
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    logging.basicConfig(level=level, handlers=[queue_handler], format="%(message)s")
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class FrameLogLimiter:
+    def __init__(self, sample_every : int = 1, max_per_second : float = None):
+        """
+        :param sample_every: Keep one per-frame line in this many (1 keeps all).
+        :param max_per_second: Lines kept per second and category, None for no limit.
+        """
+        self.sample_every = max(int(sample_every or 1), 1)
+        self.max_per_second = max_per_second
+        self._lock = threading.Lock()
+        self._state = {}    # { category : [seen, skipped since last kept, tokens, refilled at] }
+
+
+    def allow(self, category : str):
+        """
+        Whether to log the next ``category`` line: None to skip it, else the number
+        of lines skipped since the last one kept (to mention in this one).
+        """
+        with self._lock:
+            state = self._state.get(category)
+            if state is None:
+                burst = self.max_per_second or 0
+                state = self._state[category] = [0, 0, burst, time.monotonic()]
+            state[0] += 1
+            keep = (state[0] - 1) % self.sample_every == 0
+            if keep and self.max_per_second is not None:
+                now = time.monotonic()
+                state[2] = min(state[2] + (now - state[3]) * self.max_per_second, self.max_per_second)
+                state[3] = now
+                keep = state[2] >= 1
+                if keep:
+                    state[2] -= 1
+            if not keep:
+                state[1] += 1
+                return None
+            skipped, state[1] = state[1], 0
+            return skipped
+
+
+_limiter = FrameLogLimiter()
+
+
+def configure(sample_every : int = 1, max_per_second : float = None):
+    """
+    Sampling and rate limit of the per-frame lines of this process.
+    """
+    global _limiter
+    _limiter = FrameLogLimiter(sample_every, max_per_second)
+
+
+def allow(category : str):
+    return _limiter.allow(category)
+
+
+def suppressed(skipped : int) -> str:
+    """
+    Suffix for a line logged after ``skipped`` others of its category were not.
+    """
+    return f" ({skipped} similar lines skipped)" if skipped else ""
+
+
+def summarize(value, max_repr : int = 80) -> str:
+    """
+    Short description of a payload value for the logs: type, shape, dtype and size
+    of arrays and tensors, length of containers, the repr of small scalars and strings.
+    """
+    shape = getattr(value, "shape", None)
+    dtype = getattr(value, "dtype", None)
+    if shape is not None and dtype is not None:
+        nbytes = getattr(value, "nbytes", None)
+        if nbytes is None and hasattr(value, "element_size"):
+            # torch.Tensor
+            nbytes = value.element_size() * value.numel()
+        device = str(getattr(value, "device", "cpu"))
+        return (f"{type(value).__name__}(shape={tuple(shape)}, dtype={dtype}, nbytes={nbytes}"
+                + (f", device={device})" if device != "cpu" else ")"))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f"{type(value).__name__}(nbytes={memoryview(value).nbytes})"
+    if isinstance(value, (list, tuple, dict, set)):
+        return f"{type(value).__name__}(len={len(value)})"
+    if isinstance(value, str) and len(value) > max_repr:
+        return f"str(len={len(value)}, {value[:max_repr]!r}...)"
+    text = repr(value)
+    if len(text) <= max_repr:
+        return text
+    return f"{type(value).__name__}({text[:max_repr]}...)"
@@ -0,0 +1,219 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+####################################################################################################
+# Prometheus metrics without the prometheus_client dependency. Instrumented code updates the
+# module-level metrics below; serve() exposes them, plus the families returned by collector
+# callables (evaluated at scrape time, for state a Node already keeps: pending store, executors,
+# connection pool, per-peer links), in the text exposition format on GET /metrics. The same
+# server answers GET /health for the node's Consul check (see healthCheck).
+####################################################################################################
+
+# Seconds, from sub-millisecond local work to multi-second transfers
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+
+    def render(self, collectors=()) -> str:
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception:
+                logging.exception("[METRICS] collector failed")
+                continue
+            for name, kind, help_text, samples in families:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = _Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name : str, help_text : str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}   # { label values : value }
+        REGISTRY.register(self)
+
+
+    def _key(self, labels : dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def render(self) -> list:
+        with self._lock:
+            values = dict(self._values)
+        return self._header() + [
+            f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name : str, help_text : str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+
+    def observe(self, value : float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket (non cumulative) counts, sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+
+    def render(self) -> list:
+        with self._lock:
+            values = {key: (list(s[0]), s[1], s[2]) for key, s in self._values.items()}
+        lines = self._header()
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+# --- Transport and processing metrics, updated where the work happens ---
+FRAMES_RECEIVED = Counter("autter_frames_received_total", "Frames decoded, per sender.", ("peer",))
+BYTES_RECEIVED = Counter("autter_bytes_received_total", "Payload bytes received (content and buffers, as on the wire), per sender.", ("peer",))
+FRAMES_DROPPED = Counter("autter_frames_dropped_total", "Frames received but not decoded (refused codec, corrupt data...).")
+FRAMES_EXPIRED = Counter("autter_frames_expired_total", "Frames received past their deadline and dropped undecoded.")
+DECODE_SECONDS = Histogram("autter_decode_seconds", "Time to decompress and decode a received frame.", ("codec",))
+ENCODE_SECONDS = Histogram("autter_encode_seconds", "Time to encode a payload, per codec.", ("codec",))
+FRAME_LATENCY_SECONDS = Histogram("autter_frame_latency_seconds", "From the sender's timestamp to decoded here, per sender; corrected=\"false\" until the sender's clock offset is known.", ("peer", "corrected"))
+DISPATCH_SECONDS = Histogram("autter_dispatch_seconds", "From send_data_to_peers() to the frame written to the peer, per peer.", ("peer",))
+THROTTLED = Counter("autter_flow_throttled_total", "Payloads for a peer out of credits, per peer and policy applied (block, drop, coalesce).", ("peer", "action"))
+CIRCUIT_OPENED = Counter("autter_circuit_opened_total", "Times deliveries to a peer were suspended after repeated failures, per peer.", ("peer",))
+ROUTED = Counter("autter_routed_total", "Payloads routed to one instance of an anycast target.", ("target", "peer"))
+CLOCK_OFFSET_SECONDS = Gauge("autter_clock_offset_seconds", "Estimated clock offset of each peer (its clock minus ours).", ("peer",))
+RTT_SECONDS = Histogram("autter_rtt_seconds", "Round-trip time of clock pings, per peer.", ("peer",))
+ON_RECEIVE_SECONDS = Histogram("autter_on_receive_seconds", "on_receive callback execution time, per sender.", ("peer",))
+BATCH_SIZE = Histogram("autter_batch_size", "Inputs per run_batch() call of a micro-batcher.", ("batcher",), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+INFERENCE_SECONDS = Histogram("autter_inference_seconds", "Content.run() execution time, per inference worker.", ("worker",))
+BATCH_SECONDS = Histogram("autter_batch_seconds", "run_batch() execution time, per micro-batcher.", ("batcher",))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    collectors = ()
+    health = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            status = 200
+            body = REGISTRY.render(self.collectors).encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif path == "/health" and self.health is not None:
+            status, details = self.health()
+            body = json.dumps(details).encode("utf-8")
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood container.log
+        pass
+
+
+def serve(port : int, collectors=(), host : str = "0.0.0.0", health=None):
+    """
+    Serve /metrics on ``port`` from a daemon thread, and /health when ``health``
+    (callable -> (HTTP status, JSON-able details)) is given. Returns the server,
+    or None (logged) if the port cannot be bound.
+    """
+    handler = type("MetricsHandler", (_Handler,), {
+        "collectors": tuple(collectors),
+        "health": staticmethod(health) if health is not None else None,
+    })
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logging.error(f"[METRICS] cannot serve /metrics on port {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"[METRICS] serving /metrics on {host}:{port}")
+    return server
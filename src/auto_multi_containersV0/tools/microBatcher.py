@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import metrics
+
+####################################################################################################
+# Dynamic micro-batching of inference inputs.
+#
+# Callers submit() single inputs and get a Future back. One worker thread owns the model calls:
+# it waits for a first input, then keeps gathering whatever else is queued until it holds
+# max_batch inputs or max_wait seconds have passed since the first one, and hands them all to
+# run_batch(inputs) -> outputs (same length and order). Each output resolves the Future of its
+# input. Under load batches fill up at once; when idle an input waits at most max_wait.
+# The queue is bounded: submit() blocks while it is full, so a slow model pushes back on the
+# on_receive callbacks and, through them, on the senders.
+####################################################################################################
+
+
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch : int = 8, max_wait : float = 0.005, max_queue : int = 256,
+                 name : str = "batcher"):
+        """
+        :param run_batch: Callable (list of inputs) -> list of outputs, one per input.
+        :param max_batch: Most inputs per run_batch() call.
+        :param max_wait: Seconds the first input of a batch may wait for others.
+        :param max_queue: Inputs that may wait before submit() blocks.
+        """
+        self.run_batch = run_batch
+        self.max_batch = max(int(max_batch), 1)
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._counters = {
+            'batches': 0,
+            'items': 0,
+            'failed': 0,
+        }
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+
+    def _gather(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+            items = [item for item, _ in batch]
+            started = time.perf_counter()
+            try:
+                results = list(self.run_batch(items))
+                if len(results) != len(items):
+                    raise ValueError(f"run_batch returned {len(results)} outputs for {len(items)} inputs")
+            except Exception as e:
+                logging.exception(f"[BATCH] {self.name}: batch of {len(items)} failed")
+                with self._lock:
+                    self._counters['failed'] += 1
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            metrics.BATCH_SIZE.observe(len(items), batcher=self.name)
+            metrics.BATCH_SECONDS.observe(time.perf_counter() - started, batcher=self.name)
+            with self._lock:
+                self._counters['batches'] += 1
+                self._counters['items'] += len(items)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+        stats['mean_batch'] = stats['items'] / stats['batches'] if stats['batches'] else 0.0
+        stats['queued'] = self._queue.qsize()
+        stats['max_batch'] = self.max_batch
+        return stats
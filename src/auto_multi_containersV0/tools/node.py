@@ -1,4 +1,5 @@
 import socket
+import select
 import threading
 import requests
 import sys
@@ -6,9 +7,26 @@ import time
 import numpy as np
 from receiveMessageHandler import ReceiveMessageHandler
 from sendMessageHandler import SendMessageHandler
+from connectionPool import ConnectionPool, StreamReset
+from pendingStore import PendingStore
+from workerPool import BoundedExecutor, KeyedExecutor
 import logging
 import os
 import subprocess
+import itertools
+import frameHeader
+import codecRegistry
+import payloadCompression
+import chunkStream
+import circuitBreaker
+import shmTransport
+import clockSync
+import logPipeline
+import routingPolicy
+import flowControl
+import healthCheck
+import metrics
+from collections import deque
 
 class Node:
     def __init__(self,
@@ -20,12 +38,64 @@ class Node:
                  consul_url : str = None,
                  target_roles : list = None,
                  on_receive = None,
+                 pool_idle_timeout : float = 60.0,
+                 zero_copy : bool = False,
+                 pending_max_age : float = 300.0,
+                 pending_max_bytes : int = 256 * 1024 * 1024,
+                 dispatch_workers : int = 8,
+                 dispatch_queue : int = 1024,
+                 callback_workers : int = 4,
+                 callback_queue : int = 256,
+                 binary_header : bool = True,
+                 codec : str = "typed",
+                 allow_pickle : bool = True,
+                 compression = None,
+                 compress_threshold : int = 64 * 1024,
+                 chunk_threshold : int = 4 * 1024 * 1024,
+                 chunk_size : int = 256 * 1024,
+                 max_streams : int = 4,
+                 chunk_spill_bytes : int = 64 * 1024 * 1024,
+                 chunk_spill_dir : str = None,
+                 shm_domain : str = None,
+                 shm_threshold : int = 8 * 1024 * 1024,
+                 uds_dir : str = None,
+                 host_id : str = None,
+                 metrics_port : int = None,
+                 clock_sync_interval : float = 10.0,
+                 log_sample_every : int = None,
+                 log_rate_limit : float = None,
+                 routing : dict = None,
+                 flow_policy = None,
+                 credit_window : int = 32,
+                 flow_timeout : float = 10.0,
+                 conflate : list = None,
+                 message_ttl : float = None,
+                 max_received : int = 64,
+                 health_check : str = None,
+                 readiness = None,
+                 breaker_threshold : int = 3,
+                 breaker_backoff : float = 5.0,
+                 breaker_max_backoff : float = 120.0,
                  ):
         
         if log_file_path :
             self._build_log_file(log_file_path)
+        # Per-frame log lines (variables sent and received, latencies): one in log_sample_every
+        # (LOG_SAMPLE_EVERY, 1 by default) and at most log_rate_limit per second and kind
+        # (LOG_RATE_LIMIT, 50 by default; 0 for no limit)
+        if log_sample_every is None:
+            log_sample_every = int(os.environ.get("LOG_SAMPLE_EVERY", 1))
+        if log_rate_limit is None:
+            log_rate_limit = float(os.environ.get("LOG_RATE_LIMIT", 50))
+        logPipeline.configure(log_sample_every, log_rate_limit or None)
 
-        self.target_roles = target_roles
+        self.target_roles = list(target_roles or [])
+        # How payloads are spread over the instances of each target:
+        # { target : "broadcast" | "round_robin" | "least_outstanding" | "hash:<payload key>" }
+        self._router = routingPolicy.Router(routing)
+        for target in routing or {}:
+            if target not in self.target_roles:
+                self.target_roles.append(target)
         self.consul_url = consul_url
         self.container_name = container_name
         assert isinstance(role, str)
@@ -43,19 +113,159 @@ class Node:
 
         # self.established_connection_peer = [] # list with the established connections
         self.received_data = {} # received data { 'sender' : {'args' : value ...} }
+        # Latest max_received variables per sender (None: all of them); apps naming each
+        # output anew would otherwise grow received_data by one entry per message
+        self.max_received = max_received
+        self._received_lock = threading.Lock()
         self.on_receive = on_receive
+        # Fixed worker threads instead of one new thread per delivery / per received variable.
+        # A full queue blocks the submitter: the socket reader for callbacks, so TCP pushes back.
+        self._dispatcher = BoundedExecutor("dispatch", workers=dispatch_workers, max_queue=dispatch_queue)
+        self._callbacks = KeyedExecutor("on_receive", workers=callback_workers, max_queue=callback_queue)
+        # Out-of-band (pickle protocol 5) framing for arrays/tensors; every peer must run this version
+        self.zero_copy = zero_copy
+        # Fixed binary frame header for peers advertising it (legacy JSON header otherwise)
+        self.binary_header = binary_header
+        self._seq = itertools.count(1)
+        # Preferred payload codec for peers accepting it (pickle otherwise, or when the
+        # payload holds types it cannot represent); allow_pickle=False refuses pickle frames
+        self._codec = codecRegistry.by_name(codec).codec_id
+        self.allow_pickle = allow_pickle
+        # Compression of payloads >= compress_threshold bytes for peers that can decompress it:
+        # "zlib", "lz4", "zstd" (optionally "name:level"), or {peer service name: spec, '*': default}
+        if not isinstance(compression, dict):
+            compression = {'*': compression}
+        self._compression = {name: payloadCompression.parse(spec) for name, spec in compression.items()}
+        self.compress_threshold = compress_threshold
+        # Frames of chunk_threshold bytes or more go out in chunk_size pieces, interleaved with
+        # the smaller frames queued behind them (at most max_streams at once per peer), to peers
+        # that can reassemble them; None sends every frame whole. Received chunked frames of
+        # chunk_spill_bytes or more are reassembled in a memory-mapped file in chunk_spill_dir.
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+        self.max_streams = max_streams
+        self.chunk_spill_bytes = chunk_spill_bytes
+        self.chunk_spill_dir = chunk_spill_dir
+        # Peers advertising the same shared-memory domain (containers sharing an IPC namespace,
+        # SHM_DOMAIN set by parser_compose in single-host mode) get frames of shm_threshold
+        # bytes or more through /dev/shm, with only a descriptor on the socket
+        self.shm_domain = shm_domain or os.environ.get("SHM_DOMAIN")
+        if self.shm_domain and not shmTransport.available():
+            logging.warning(f"[SHM] {shmTransport.SHM_DIR} is not writable; shared-memory transport disabled")
+            self.shm_domain = None
+        self.shm_threshold = shm_threshold
+        # Besides the TCP port, listen on a Unix domain socket in uds_dir (a volume shared by
+        # the containers of one host, UDS_DIR by default); peers reporting the same host_id
+        # (HOST_ID) and able to see the socket file connect to it instead of going through TCP/IP
+        self.uds_dir = uds_dir or os.environ.get("UDS_DIR")
+        self.host_id = host_id or os.environ.get("HOST_ID")
+        self.uds_path = None
+        if self.uds_dir and self.host_id:
+            self.uds_path = os.path.join(self.uds_dir, f"{container_name}-{socket.gethostname()}-{port}.sock")
+        # Per-peer link counters: { svc_id : {'frames', 'compressed_frames', 'chunked_frames', 'chunks',
+        # 'stream_restarts', 'shm_frames', 'raw_bytes', 'wire_bytes', 'compress_s'} }
+        self._links = {}
+        self._links_lock = threading.Lock()
 
+        # Prometheus /metrics endpoint (METRICS_PORT, 9100 by default; 0 disables it)
+        if metrics_port is None:
+            metrics_port = int(os.environ.get("METRICS_PORT", 9100))
+        self.metrics_port = metrics_port
+        self._metrics_server = None
+        # Consul check: "http" polls GET /health on the metrics port (the default when there
+        # is one), "ttl" has the node push the same report to Consul, "tcp" connects to the
+        # data port (HEALTH_CHECK). The node reports itself ready once built and while
+        # readiness() (-> bool or (bool, reason)) holds and set_ready() did not say otherwise;
+        # not ready or saturated queues turn the check to "warning".
+        if health_check is None:
+            health_check = os.environ.get("HEALTH_CHECK", "http" if metrics_port else "ttl")
+        if health_check not in healthCheck.MODES or (health_check == "http" and not metrics_port):
+            raise ValueError(f"Unknown or unusable health check {health_check!r} (expected one of "
+                             f"{', '.join(healthCheck.MODES)}; 'http' needs a metrics port)")
+        self.health_check = health_check
+        self.readiness = readiness
+        self._ready = (True, None)
+        self._started = False
+        self._started_at = time.time()
+        self._ttl_reporter = None
+        # NTP-style clock pings on each open stream, every clock_sync_interval seconds and
+        # right after it is (re)opened; None disables them (pings from peers are still answered)
+        self.clock_sync_interval = clock_sync_interval
+        self._clocks = {}   # { svc_id : clockSync.ClockEstimate }
+        # Credit-based flow control. As a receiver: let each sender have at most credit_window
+        # frames in flight (fewer when its on_receive queue has less room); None or 0 turns
+        # credits off. As a sender, toward peers granting credits: what send_data_to_peers()
+        # does with a payload for a peer whose queued frames use up its credits, "block" (for
+        # up to flow_timeout seconds, None for no limit), "drop" (skip that peer) or "coalesce"
+        # (the payloads queued for it and not started are replaced by the new one);
+        # FLOW_POLICY ("block" by default), or {peer service name: policy, '*': default}
+        self.credit_window = credit_window
+        if flow_policy is None:
+            flow_policy = os.environ.get("FLOW_POLICY", "block")
+        if not isinstance(flow_policy, dict):
+            flow_policy = {'*': flow_policy}
+        self._flow_policy = {name: flowControl.parse_policy(policy) for name, policy in flow_policy.items()}
+        self._flow_policy.setdefault('*', "block")
+        self.flow_timeout = flow_timeout
+        self._credits = {}  # { svc_id : flowControl.CreditWindow } of the peers granting credits
+        self._flow_cond = threading.Condition()
+        # Real-time streams: payloads made only of ``conflate`` variables are latest-wins (a
+        # newer one replaces those not sent yet to each peer), and payloads expire
+        # message_ttl seconds after send_data_to_peers(): senders no longer send them,
+        # receivers drop them before decoding. Both can also be set per payload.
+        self.conflate = frozenset(conflate or ())
+        self.message_ttl = message_ttl
+        # Per-peer circuit breakers: after breaker_threshold consecutive failed deliveries
+        # nothing is attempted toward a peer for breaker_backoff seconds (doubling after each
+        # failed probe, up to breaker_max_backoff, with jitter); its payloads are held meanwhile
+        # and anycast targets route around it
+        self.breaker_threshold = breaker_threshold
+        self.breaker_backoff = breaker_backoff
+        self.breaker_max_backoff = breaker_max_backoff
+        self._breakers = {}     # { svc_id : circuitBreaker.CircuitBreaker }
+
+        # /metrics and /health are up before registering, so Consul's first probe finds them
+        if self.metrics_port:
+            self._metrics_server = metrics.serve(self.metrics_port, [self._collect_metrics],
+                                                 health=self._health_response)
+        if self.health_check == "http" and self._metrics_server is None:
+            # nothing would answer Consul's probes and it would deregister a healthy node
+            logging.warning(f"[HEALTH] metrics port {self.metrics_port} unavailable; using a TTL check instead")
+            self.health_check = "ttl"
         # We strat the server on a different thread for it to always be able to listen without blocking the app
         self._register_to_consul()
+        if self.health_check == "ttl":
+            self._ttl_reporter = healthCheck.TTLReporter(self.consul_url, self.container_id, self.health)
         # logging.info(f"[DEBUG] This should be viwed only once per container !!!!")
         threading.Thread(target=self._start_server, daemon=True).start()
         time.sleep(1)
 
-        # --- Pending payload tasks ---
-        # Each task is {'payload': dict, 'sent_peers': set(), 'created_at': float}
-        self._pending = []
+        # --- One long-lived stream per peer, keyed by Consul service ID ---
+        self._pool = self._build_pool(pool_idle_timeout)
+
+        # --- Pending payload tasks, indexed by the peers still waiting for them ---
+        # Each task is {'payload': dict, 'contents': {codec id : segments},
+        # 'frames': {(binary header?, codec id, compression) : (frame, raw bytes, wire bytes)},
+        # 'packed': {(codec id, compression) : compressed segments and spec, or None},
+        # 'variables': tuple, 'nbytes': int, 'created_at': float, 'seq': int, 'trace_id': bytes,
+        # 'routes': {anycast target : svc_id it was routed to, or None}, 'conflate': latest-wins key
+        # or None [, 'deadline': time.time() after which it is dropped]}
+        # plus the 'id', 'targets' and 'delivered' the store keeps up to date
+        self._pending = PendingStore(max_age=pending_max_age, max_bytes=pending_max_bytes)
+        # Retry period for deliveries that failed, and back-off after a Consul error
         self._poll_interval = 5
-        threading.Thread(target=self._poller, daemon=True).start()
+
+        # --- Local peer table, kept current by Consul blocking queries ---
+        # { svc_id : {'name': str, 'address': str, 'port': int, 'tags': list, 'meta': dict} }
+        self._peers = {}
+        self._peers_lock = threading.Lock()
+        self._watched_services = {}   # { service name : watch token } of matching services
+        self._watch_wait = 55         # seconds Consul may hold a blocking query open
+        threading.Thread(target=self._watch_catalog, daemon=True).start()
+        threading.Thread(target=self._retry_pending, daemon=True).start()
+        if self.clock_sync_interval:
+            threading.Thread(target=self._sync_clocks, daemon=True).start()
+        self._started = True
 
 
     def _build_log_file(self, log_file_path):
@@ -72,19 +282,21 @@ class Node:
         with open(log_file_path, 'a'):
             os.utime(log_file_path, None)
 
-        # 3) Configure logging with both a FileHandler and StreamHandler
+        # 3) Configure logging with both a FileHandler and StreamHandler, written from a
+        #    listener thread so the receive and dispatch threads never block on them
         file_handler   = logging.FileHandler(log_file_path)
         console_handler = logging.StreamHandler(sys.stdout)
 
-        logging.basicConfig(
-            level=logging.INFO,
-            handlers=[file_handler, console_handler],
-            format="%(asctime)s - %(levelname)s - %(message)s",
-        )
+        logPipeline.install([file_handler, console_handler], level=logging.INFO)
 
         logging.info(f"Logging initialized. Log file is: {log_file_path}")
     
     
+    def _build_pool(self, idle_timeout : float):
+        return ConnectionPool(self._connect_to_addr, idle_timeout=idle_timeout,
+                              greeting=self._credit_hello, on_reply=self._on_reply)
+
+
     def _get_container_ip(self):
         """
         Return the Swarm VIP for this container’s service, so that clients
@@ -131,12 +343,8 @@ class Node:
             # Using HOST_IP if provided; otherwise, default to 127.0.0.1
             # "Address": os.environ.get("HOST_IP", "127.0.0.1")
             "Address": self.container_ip,
-            "Check": {
-                 "TCP": f"{self.container_ip}:{self.port}",
-                 "Interval": "5s",
-                 "Timeout": "1s",
-                 "DeregisterCriticalServiceAfter": "10s"
-             }
+            "Meta": self._service_meta(),
+            "Check": self._health_check_definition(),
         }
             # "Check" : {
             #     "TTL" : "10s",
@@ -154,6 +362,43 @@ class Node:
         except Exception as e:
             logging.error("Exception during registration: %s", e)
 
+    def _health_check_definition(self) -> dict:
+        if self.health_check == "http":
+            return healthCheck.http_check(self.container_ip, self.metrics_port)
+        if self.health_check == "ttl":
+            return healthCheck.ttl_check()
+        return {
+            "TCP": f"{self.container_ip}:{self.port}",
+            "Interval": "5s",
+            "Timeout": "1s",
+            "DeregisterCriticalServiceAfter": "10s"
+        }
+
+
+    def _service_meta(self) -> dict:
+        """
+        Consul service Meta: the wire features this node can receive.
+        """
+        meta = {}
+        if self.binary_header:
+            meta[frameHeader.META_KEY] = str(frameHeader.VERSION)
+        meta[codecRegistry.META_KEY] = codecRegistry.advertise(self.allow_pickle)
+        meta[payloadCompression.META_KEY] = ",".join(payloadCompression.available())
+        meta[chunkStream.META_KEY] = chunkStream.VERSION
+        meta[clockSync.META_KEY] = clockSync.VERSION
+        if self.credit_window:
+            meta[flowControl.META_KEY] = flowControl.VERSION
+        if self.shm_domain:
+            meta[shmTransport.META_KEY] = self.shm_domain
+        if self.uds_path:
+            meta["host_id"] = self.host_id
+            meta["uds"] = self.uds_path
+        if self.metrics_port:
+            # for Prometheus' Consul service discovery
+            meta["metrics_port"] = str(self.metrics_port)
+        return meta
+
+
     def _start_server(self):
         # self.register_to_consul()
         # server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -170,30 +415,58 @@ class Node:
         server_sock.listen(5)
         # print(f"[SERVER] Listening on {self.host}:{self.port}")
         logging.info(f"[SERVER] Listening on {self.host}:{self.port}")
+        if self.uds_path:
+            threading.Thread(target=self._start_uds_server, daemon=True).start()
         while True:
             conn, addr = server_sock.accept()
             # each established connection is lunched on a different thread
             threading.Thread(target=self._handle_client, args=(conn, addr), daemon=True).start()
+
+
+    def _bind_uds(self):
+        """
+        Listening Unix domain socket at uds_path (a stale file from a previous run is
+        replaced), or None if it cannot be created: same-host peers then use TCP.
+        """
+        try:
+            os.makedirs(self.uds_dir, exist_ok=True)
+            if os.path.exists(self.uds_path):
+                os.unlink(self.uds_path)
+            server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server_sock.bind(self.uds_path)
+            server_sock.listen(5)
+        except OSError as e:
+            logging.error(f"[SERVER] Unix socket {self.uds_path} unavailable ({e}); same-host peers will use TCP")
+            return None
+        logging.info(f"[SERVER] Listening on {self.uds_path}")
+        return server_sock
+
+
+    def _start_uds_server(self):
+        server_sock = self._bind_uds()
+        if server_sock is None:
+            return
+        while True:
+            conn, _ = server_sock.accept()
+            # Unix peers have no address: name the connection after the socket
+            threading.Thread(target=self._handle_client, args=(conn, ("unix", self.uds_path)), daemon=True).start()
     
 
     def _handle_client(self, conn: socket.socket, addr: str):
         # print(f"[SERVER] Connection from {addr}")
         logging.info(f"[SERVER] Connection from {addr}")
-        handler = ReceiveMessageHandler(conn, addr)
+        handler = ReceiveMessageHandler(conn, addr, self.allow_pickle, self._chunk_assembler(), self._credit_grant())
         try:
             while True:
                 # try:
                 messages = handler.recv_all_messages()
                 if messages:
-                    creds, latency = messages.pop(0)
-                    for variable_name, msg in messages:
-                        if variable_name=='container_creds_xxx':
-                            continue
-                        self._add_data(creds, variable_name, msg)
-                        # print(f"[SERVER] Received message {msg!r} with variable name {variable_name!r} from {addr}")
-                        logging.info(f"[SERVER] Received message {msg!r} with variable name {variable_name!r} from {addr}")
-                    logging.info(f"[LATENCY] from {creds} is : {latency} on port {addr[1]}")
-                time.sleep(0.1)
+                    self._process_messages(messages, addr, handler.credits)
+                else:
+                    if handler.closed:
+                        break
+                    # Sleep until more bytes arrive rather than for a fixed 0.1 s
+                    select.select([conn], [], [], 1.0)
                 # except BlockingIOError:
                 #     # No data ready yet.
                 #     time.sleep(0.1)
@@ -205,19 +478,63 @@ class Node:
             logging.info(f"[SERVER] Connection closed {addr}")
 
 
-    def _add_data(self, creds, variable_name, msg):
-        if creds in list(self.received_data.keys()) :
-            self.received_data[creds][str(variable_name)] = msg
-        else:
-            self.received_data[creds] = {str(variable_name) : msg}
+    def _process_messages(self, messages : list, addr, credits : flowControl.CreditGrant = None):
+        """
+        Store the variables of one received frame ([(creds, latency), (name, value), ...]).
+        With ``credits``, the frame counts as consumed once its on_receive calls are done.
+        """
+        creds, latency = messages.pop(0)
+        done = None
+        if credits is not None:
+            jobs = sum(1 for name, _ in messages if name != 'container_creds_xxx') if self.on_receive else 0
+            done = credits.frame(creds, jobs)
+        for variable_name, msg in messages:
+            if variable_name=='container_creds_xxx':
+                continue
+            self._add_data(creds, variable_name, msg, done)
+            # print(f"[SERVER] Received message {msg!r} with variable name {variable_name!r} from {addr}")
+            skipped = logPipeline.allow("received")
+            if skipped is not None:
+                logging.info(f"[SERVER] Received message {logPipeline.summarize(msg)} with variable name "
+                             f"{variable_name!r} from {addr}{logPipeline.suppressed(skipped)}")
+        skipped = logPipeline.allow("latency")
+        if skipped is not None:
+            logging.info(f"[LATENCY] from {creds} is : {latency} on port {addr[1]}{logPipeline.suppressed(skipped)}")
+
+
+    def _add_data(self, creds, variable_name, msg, done=None):
+        with self._received_lock:
+            variables = self.received_data.setdefault(creds, {})
+            # A variable received again becomes the newest; the oldest ones go past max_received
+            variables.pop(str(variable_name), None)
+            variables[str(variable_name)] = msg
+            if self.max_received:
+                while len(variables) > self.max_received:
+                    del variables[next(iter(variables))]
         
         if self.on_receive:
-            t = threading.Thread(
-                target=self.on_receive,
-                args=(creds, variable_name, msg, self),
-                daemon=True
-            )
-            t.start()
+            # Keyed by sender: its variables reach on_receive one at a time, in the order sent
+            self._callbacks.submit(creds, self._run_on_receive, creds, variable_name, msg, done)
+
+
+    def _run_on_receive(self, creds, variable_name, msg, done=None):
+        start = time.perf_counter()
+        try:
+            self.on_receive(creds, variable_name, msg, self)
+        finally:
+            peer = creds[0] if isinstance(creds, (tuple, list)) and creds else creds
+            metrics.ON_RECEIVE_SECONDS.observe(time.perf_counter() - start, peer=peer)
+            if done is not None:
+                done()
+
+
+    def _credit_grant(self):
+        """
+        Credit grants of a new inbound stream, or None with credits turned off.
+        """
+        if not self.credit_window:
+            return None
+        return flowControl.CreditGrant(self.credit_window, self._callbacks.free if self.on_receive else None)
 
 
     def _connect_to_one_peer(self, peer_host, peer_port):
@@ -239,73 +556,911 @@ class Node:
             return None
     
 
-    def send_data_to_peers(self, send_data: dict):
+    def _connect_unix(self, path : str):
+        """
+        Unix domain socket counterpart of _connect_to_one_peer.
+        """
+        client_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client_sock.settimeout(10)
+        try:
+            client_sock.connect(path)
+            logging.info(f"[CLIENT] Unix socket connect() to {path} succeeded")
+            return client_sock
+        except OSError as e:
+            client_sock.close()
+            logging.error(f"[CLIENT] Could not connect to {path}: {e}")
+            return None
+
+
+    def _connect_to_addr(self, addr):
         """
-        Enqueue a new payload for delivery. A single poller will ensure it reaches
-        all matching peers exactly once, including late joiners.
+        Connect to a peer address as returned by _peer_addr(): a Unix socket path or (host, port).
+        """
+        if isinstance(addr, str):
+            return self._connect_unix(addr)
+        return self._connect_to_one_peer(*addr)
+
+
+    def _peer_addr(self, peer : dict):
+        """
+        Address to reach ``peer`` at: its Unix domain socket when it runs on this
+        host and the socket file is visible from here, its TCP endpoint otherwise.
+        """
+        meta = peer['meta'] or {}
+        path = meta.get("uds")
+        if self.uds_path and path and meta.get("host_id") == self.host_id and os.path.exists(path):
+            return path
+        return (peer['address'], peer['port'])
+
+
+    def send_data_to_peers(self, send_data: dict, trace_id: bytes = None, conflate=None, ttl: float = None):
+        """
+        Enqueue a new payload for delivery and send it at once to the known peers.
+        Peers discovered while it is still pending receive it as soon as Consul
+        reports them. The payload is retired once every current target has it;
+        one nobody could receive yet waits for the first peer, up to pending_max_age.
+        In zero_copy mode the frame references the payload's arrays instead of
+        copying them, so they must not be modified in place after this call.
+        The same holds for peers that do not accept the node's codec: their
+        pickle copy is made from the payload when they are first served.
+        trace_id (16 bytes, random by default) and a per-node sequence number
+        travel in the binary header.
+        conflate: key making the payload latest-wins: it replaces, for each peer, the
+        payloads with the same key not sent to it yet (by default, payloads made only
+        of the node's ``conflate`` variables are keyed by their variable names).
+        ttl: seconds after which the payload is not worth delivering (message_ttl by
+        default); receivers check the deadline before decoding it.
         """
         payload = send_data.copy()
         payload['container_creds_xxx'] = (self.container_name, self.role)
+        if conflate is None and send_data and self.conflate.issuperset(send_data):
+            conflate = tuple(sorted(send_data))
+        if ttl is None:
+            ttl = self.message_ttl
+        # Known peers get it right away (one instance per anycast target); late joiners
+        # get it from their watch event. Peers out of credits get the flow control policy
+        # first, which may block here; a latest-wins payload needs none: it only ever
+        # has one copy queued per peer
+        peers = self._peer_snapshot()
+        targets, routes = self._router.route(payload, peers, self._outstanding, self._preferred)
+        coalesce, dropped = set(), set()
+        if conflate is None:
+            coalesce, dropped = self._apply_flow_policy(targets, routes, peers)
+        if dropped and not targets:
+            # every target was out of credits under "drop": nothing to keep it for
+            return
+        # Serialise once here; every peer is sent the same immutable content,
+        # behind a header rendered once per wire format (see _frame_for)
+        start = time.perf_counter()
+        codec, content = codecRegistry.encode(payload, self._codec, zero_copy=self.zero_copy)
+        metrics.ENCODE_SECONDS.observe(time.perf_counter() - start, codec=codecRegistry.get(codec).name)
         task = {
             'payload': payload,
-            'sent_peers': set(),
+            'contents': {codec: content},
+            'frames': {},
+            'packed': {},
+            'variables': tuple(payload),
+            'nbytes': sum(memoryview(segment).nbytes for segment in content),
             'created_at': time.time(),
+            'seq': next(self._seq),
+            'trace_id': trace_id or os.urandom(16),
+            'routes': routes,
+            'conflate': conflate,
         }
-        self._pending.append(task)
+        if ttl is not None:
+            task['deadline'] = task['created_at'] + ttl
+        for target, svc_id in routes.items():
+            if svc_id is not None:
+                metrics.ROUTED.inc(target=target, peer=peers[svc_id]['name'])
+        self._pending.add(task, targets)
+        if conflate is not None:
+            for svc_id in targets:
+                self._pending.supersede(task, svc_id, conflate)
+        for svc_id in coalesce:
+            superseded = self._pending.supersede(task, svc_id)
+            if superseded:
+                logging.info(f"[FLOW] {superseded} queued payload(s) for {svc_id} replaced by payload {task['seq']}")
+        for svc_id in targets:
+            self._kick(svc_id)
+
+
+    def _backlogged(self, svc_id) -> bool:
+        """
+        Whether the payloads queued for ``svc_id`` already use up the credits it granted.
+        A peer the last delivery failed to reach, or whose check is not passing, grants
+        nothing: its payloads wait in the pending store as before (pending_max_age,
+        pending_max_bytes).
+        """
+        window = self._credits.get(svc_id)
+        if window is None or window.unreachable or not self._passing(svc_id):
+            return False
+        return self._pending.pending_for(svc_id) >= window.available(self._pool.generation(svc_id))
+
 
-    def _poller(self):
+    def _apply_flow_policy(self, targets : set, routes : dict, peers : dict) -> tuple:
         """
-        Single background thread polling Consul and dispatching all pending tasks
-        to any new peers not yet sent.
+        Flow control policy of the targets of a new payload that are out of credits:
+        wait until they have some again ("block"), leave them out, with their route,
+        ("drop"), or keep them ("coalesce"). Returns (peers to coalesce, peers dropped).
         """
+        coalesce, dropped = set(), set()
+        for svc_id in list(targets):
+            if not self._backlogged(svc_id):
+                continue
+            name = peers[svc_id]['name']
+            policy = self._flow_policy.get(name, self._flow_policy['*'])
+            metrics.THROTTLED.inc(peer=name, action=policy)
+            if policy == "drop":
+                targets.discard(svc_id)
+                dropped.add(svc_id)
+                for target in [t for t, routed in routes.items() if routed == svc_id]:
+                    del routes[target]
+                skipped = logPipeline.allow("flow")
+                if skipped is not None:
+                    logging.info(f"[FLOW] {name} ({svc_id}) is out of credits; payload not sent to it"
+                                 f"{logPipeline.suppressed(skipped)}")
+            elif policy == "coalesce":
+                coalesce.add(svc_id)
+            else:
+                self._wait_for_credit(svc_id, name)
+        return coalesce, dropped
+
+
+    def _wait_for_credit(self, svc_id, name : str):
+        deadline = None if self.flow_timeout is None else time.monotonic() + self.flow_timeout
+        with self._flow_cond:
+            while self._backlogged(svc_id):
+                with self._peers_lock:
+                    if svc_id not in self._peers:
+                        return
+                if deadline is not None and time.monotonic() >= deadline:
+                    logging.warning(f"[FLOW] {name} ({svc_id}) granted no credit for {self.flow_timeout} s; "
+                                    f"queueing the payload anyway")
+                    return
+                # woken up by grants, deliveries and peer changes; polled as a fallback
+                timeout = 0.5 if deadline is None else min(deadline - time.monotonic(), 0.5)
+                self._flow_cond.wait(max(timeout, 0))
+
+
+    def _delivery_failed(self, svc_id):
+        """
+        A delivery loop gave up on ``svc_id`` (_retry_pending restarts it once
+        its circuit breaker allows).
+        """
+        self._pending.end_drain(svc_id)
+        breaker = self._breakers.get(svc_id)
+        if breaker is not None:
+            delay = breaker.failure()
+            if delay is not None:
+                metrics.CIRCUIT_OPENED.inc(peer=self._peer_label(svc_id))
+                logging.warning(f"[CLIENT] {self._peer_label(svc_id)} ({svc_id}) unreachable after "
+                                f"{breaker.failures} attempt(s); holding its deliveries for {delay:.1f}s")
+        window = self._credits.get(svc_id)
+        if window is not None:
+            window.unreachable = True
+            self._flow_changed()
+
+
+    def _flow_changed(self):
+        with self._flow_cond:
+            self._flow_cond.notify_all()
+
+
+    def _credit_hello(self, svc_id):
+        """
+        Control frame opening every new stream to ``svc_id`` (see ConnectionPool).
+        """
+        return flowControl.hello() if svc_id in self._credits else None
+
+
+    def _on_reply(self, svc_id, generation, header : dict, received : float):
+        """
+        Control frames peers write back besides clock pongs: credit grants.
+        """
+        credit = flowControl.parse(header)
+        if credit is None or credit[0] != flowControl.GRANT:
+            logging.warning(f"[FLOW] Ignored an unknown control frame from {svc_id}")
+            return
+        window = self._credits.get(svc_id)
+        if window is not None and window.grant(generation, credit[1], flowControl.consumed(header)):
+            self._flow_changed()
+            self._kick(svc_id)
+
+
+    def _compression_for(self, peer : dict):
+        spec = self._compression.get(peer['name'], self._compression.get('*'))
+        if spec is not None and spec[0] in payloadCompression.accepted(peer['meta']):
+            return spec
+        return None
+
+
+    def _frame_for(self, task : dict, svc_id, peer : dict) -> tuple:
+        """
+        Frame of ``task`` in the header format, codec and compression ``peer`` can
+        read, built on first use and shared with every peer reading the same.
+        Returns (frame, uncompressed content bytes, content bytes on the wire).
+        """
+        binary = self.binary_header and frameHeader.peer_supports_binary(peer['meta'])
+        accepted = codecRegistry.accepted(peer['meta'])
+        codec = next((c for c in task['contents'] if c in accepted), None)
+        if codec is None:
+            # e.g. a legacy peer and a typed payload: pickle a copy for it
+            codec = codecRegistry.PICKLE
+            start = time.perf_counter()
+            task['contents'][codec] = codecRegistry.get(codec).encode(task['payload'], self.zero_copy)
+            metrics.ENCODE_SECONDS.observe(time.perf_counter() - start, codec=codecRegistry.get(codec).name)
+        content = task['contents'][codec]
+        raw_nbytes = sum(memoryview(segment).nbytes for segment in content)
+        compression = self._compression_for(peer) if raw_nbytes >= self.compress_threshold else None
+        key = (binary, codec, compression)
+        entry = task['frames'].get(key)
+        if entry is None:
+            spec = None
+            if compression is not None:
+                packed = task['packed'].get((codec, compression), False)
+                if packed is False:
+                    start = time.thread_time()
+                    packed = payloadCompression.compress(*compression, content)
+                    self._count_link(svc_id, compress_s=time.thread_time() - start)
+                    # None: did not shrink enough, the frame goes out as is
+                    task['packed'][(codec, compression)] = packed
+                if packed is not None:
+                    content, spec = packed
+            header = SendMessageHandler.render_header(
+                content, binary, sent_ts=task['created_at'], codec=codec, compression=spec,
+                deadline=task.get('deadline'),
+                **({'seq': task['seq'], 'trace_id': task['trace_id']} if binary else {})
+            )
+            wire_nbytes = sum(memoryview(segment).nbytes for segment in content)
+            entry = task['frames'][key] = ((header, *content), raw_nbytes, wire_nbytes)
+        return entry
+
+
+    def _count_link(self, svc_id, **counts):
+        with self._links_lock:
+            link = self._links.setdefault(svc_id, {
+                'frames': 0, 'compressed_frames': 0, 'chunked_frames': 0, 'chunks': 0, 'stream_restarts': 0, 'shm_frames': 0,
+                'raw_bytes': 0, 'wire_bytes': 0, 'compress_s': 0.0,
+            })
+            for name, value in counts.items():
+                link[name] += value
+
+
+    def _sent(self, svc_id, task : dict, raw_nbytes : int, wire_nbytes : int, generation : int = None):
+        self._count_link(svc_id, frames=1, compressed_frames=int(wire_nbytes != raw_nbytes),
+                         raw_bytes=raw_nbytes, wire_bytes=wire_nbytes)
+        metrics.DISPATCH_SECONDS.observe(time.time() - task['created_at'], peer=self._peer_label(svc_id))
+        breaker = self._breakers.get(svc_id)
+        if breaker is not None and breaker.success():
+            logging.info(f"[CLIENT] {self._peer_label(svc_id)} ({svc_id}) reachable again")
+        window = self._credits.get(svc_id)
+        if window is not None:
+            window.spend(generation)
+            self._flow_changed()
+
+
+    def _peer_label(self, svc_id) -> str:
+        with self._peers_lock:
+            peer = self._peers.get(svc_id)
+        return peer['name'] if peer else str(svc_id)
+
+
+    def _matches_target(self, name : str, tags : list) -> bool:
+        return any(r in tags for r in self.target_roles) or name in self.target_roles
+
+
+    def _consul_blocking_get(self, path : str, index : int):
+        """
+        Consul blocking query: returns (result, new_index) as soon as the result
+        changes past ``index``, or after self._watch_wait seconds otherwise.
+        """
+        resp = requests.get(
+            f"{self.consul_url}{path}",
+            params={"index": index, "wait": f"{self._watch_wait}s"},
+            timeout=self._watch_wait + 10,
+        )
+        resp.raise_for_status()
+        new_index = int(resp.headers.get("X-Consul-Index", 0))
+        # Consul's rules: restart from 0 if the index went backwards, never block on 0
+        if new_index < index:
+            new_index = 0
+        elif new_index < 1:
+            new_index = 1
+        return resp.json(), new_index
+
+
+    def _watch_catalog(self):
+        """
+        Watch the service catalog and keep one _watch_service thread per service
+        whose name or tags match target_roles.
+        """
+        index = 0
         while True:
             try:
-                resp = requests.get(f"{self.consul_url}/v1/agent/services")
-                resp.raise_for_status()
-                services = resp.json()
+                services, index = self._consul_blocking_get("/v1/catalog/services", index)
             except Exception as e:
-                logging.error(f"[DISCOVERY] Consul lookup failed: {e}")
+                logging.error(f"[DISCOVERY] Consul catalog watch failed: {e}")
+                index = 0
                 time.sleep(self._poll_interval)
                 continue
 
-            # Collect matching peers
-            peers = []
-            for svc_id, svc in services.items():
-                if svc_id == self.container_id:
+            wanted = {name for name, tags in services.items() if self._matches_target(name, tags or [])}
+            with self._peers_lock:
+                started = wanted - self._watched_services.keys()
+                stopped = self._watched_services.keys() - wanted
+                for name in stopped:
+                    del self._watched_services[name]
+                for name in started:
+                    self._watched_services[name] = object()
+                tokens = {name: self._watched_services[name] for name in started}
+
+            for name in stopped:
+                logging.info(f"[DISCOVERY] service {name} left the catalog")
+                self._update_peers(name, [])
+            for name, token in tokens.items():
+                logging.info(f"[DISCOVERY] watching service {name}")
+                threading.Thread(target=self._watch_service, args=(name, token), daemon=True).start()
+
+
+    def _watch_service(self, name : str, token):
+        """
+        Follow the instances of one service with blocking queries on
+        /v1/health/service/<name>. Exits once the catalog watch drops ``token``.
+        """
+        index = 0
+        while True:
+            try:
+                entries, index = self._consul_blocking_get(f"/v1/health/service/{name}", index)
+            except Exception as e:
+                logging.error(f"[DISCOVERY] Consul watch on {name} failed: {e}")
+                index = 0
+                time.sleep(self._poll_interval)
+                entries = None
+            with self._peers_lock:
+                if self._watched_services.get(name) is not token:
+                    return
+            if entries is not None:
+                self._update_peers(name, entries)
+
+
+    def _update_peers(self, name : str, entries : list):
+        """
+        Replace the peer-table rows of service ``name`` with the instances in
+        ``entries`` (a /v1/health/service response) and serve the newcomers.
+        """
+        found = {}
+        for entry in entries:
+            svc = entry["Service"]
+            if svc["ID"] == self.container_id:
+                continue
+            if not self._matches_target(svc["Service"], svc.get("Tags") or []):
+                continue
+            found[svc["ID"]] = {
+                'name': svc["Service"],
+                'address': svc.get("Address") or entry["Node"]["Address"],
+                'port': svc["Port"],
+                'tags': svc.get("Tags") or [],
+                'meta': svc.get("Meta") or {},
+                'status': healthCheck.entry_status(entry),
+            }
+
+        with self._peers_lock:
+            previous = {svc_id for svc_id, peer in self._peers.items() if peer['name'] == name}
+            # instances whose check passes again get the deliveries held for them
+            ready_again = {svc_id for svc_id in previous & found.keys()
+                           if self._peers[svc_id].get('status') != healthCheck.PASSING
+                           and found[svc_id]['status'] == healthCheck.PASSING}
+            for svc_id in previous - found.keys():
+                del self._peers[svc_id]
+            self._peers.update(found)
+            current = set(self._peers)
+        joined = {svc_id: peer for svc_id, peer in found.items() if svc_id not in previous}
+        left = previous - found.keys()
+
+        if left:
+            logging.info(f"[DISCOVERY] peers left: {sorted(left)}")
+            # Close pooled streams to peers that left the registry
+            self._pool.retain(current)
+            # Tasks only they were missing are complete now, except those routed to
+            # them as one instance of an anycast target: another instance gets them
+            for svc_id in left:
+                self._credits.pop(svc_id, None)
+                self._breakers.pop(svc_id, None)
+                for other in self._pending.remove_peer(svc_id, self._reassigner(svc_id)):
+                    self._kick(other)
+            self._flow_changed()
+        if joined:
+            logging.info(f"[DISCOVERY] peers joined: {sorted(joined)}")
+            for svc_id, peer in joined.items():
+                self._breakers[svc_id] = circuitBreaker.CircuitBreaker(
+                    self.breaker_threshold, self.breaker_backoff, self.breaker_max_backoff)
+                if flowControl.peer_supports(peer['meta']):
+                    self._credits[svc_id] = flowControl.CreditWindow()
+                self._pending.add_peer(svc_id, self._accepts(svc_id, peer))
+                self._kick(svc_id)
+        if ready_again:
+            logging.info(f"[HEALTH] peers passing their check again: {sorted(ready_again)}")
+            for svc_id in ready_again:
+                self._kick(svc_id)
+            self._flow_changed()
+
+
+    def _accepts(self, svc_id, peer : dict):
+        """
+        Filter of the pending tasks a joining peer gets: all of them, unless it is an
+        instance of an anycast target, then those not routed to an instance yet.
+        """
+        group = self._router.group_of(peer)
+        if group is None:
+            return None
+
+        def accepts(task):
+            routes = task.setdefault('routes', {})
+            if routes.get(group) is None:
+                routes[group] = svc_id
+                metrics.ROUTED.inc(target=group, peer=peer['name'])
+                return True
+            return False
+        return accepts
+
+
+    def _reassigner(self, gone):
+        """
+        For PendingStore.remove_peer: route the tasks that were routed to ``gone``
+        to another instance of the same target, if one is left.
+        """
+        members = {}
+        peers = self._peer_snapshot()
+        for svc_id, peer in peers.items():
+            group = self._router.group_of(peer)
+            if group is not None:
+                members.setdefault(group, []).append(svc_id)
+        for group, svc_ids in members.items():
+            members[group] = [svc_id for svc_id in svc_ids if self._preferred(svc_id)] or svc_ids
+        loads = dict(self._pending.stats()['peers'])
+
+        def reassign(task):
+            routes = task.get('routes', {})
+            for group, svc_id in routes.items():
+                if svc_id != gone:
                     continue
-                tags = svc.get("Tags", [])
-                name = svc.get("Service")
-                if any(r in tags for r in self.target_roles) or name in self.target_roles:
-                    peers.append((svc_id, svc['Address'], svc['Port']))
-
-            # Dispatch each pending payload to new peers
-            for task in list(self._pending):
-                for svc_id, ip, port in peers:
-                    if svc_id in task['sent_peers']:
-                        continue
-                    threading.Thread(
-                        target=self._dispatch_to_peer,
-                        args=(svc_id, ip, port, task),
-                        daemon=True
-                    ).start()
-                time.sleep(0)
+                other = None
+                if members.get(group):
+                    other = self._router.choose(group, task['payload'], members[group], lambda s: loads.get(s, 0))
+                    loads[other] = loads.get(other, 0) + 1
+                    metrics.ROUTED.inc(target=group, peer=peers[other]['name'])
+                    logging.info(f"[ROUTING] task {task['seq']} rerouted from {gone} to {other}")
+                routes[group] = other
+                return other
+            return None
+        return reassign
+
+
+    def _peer_snapshot(self) -> dict:
+        with self._peers_lock:
+            return dict(self._peers)
+
+
+    def peers(self) -> dict:
+        """
+        Current peer table: { svc_id : {'name', 'address', 'port', 'tags', 'meta', 'status'} },
+        'status' being the Consul check status of the instance.
+        """
+        return self._peer_snapshot()
+
+
+    def _kick(self, svc_id):
+        """
+        Start delivering to ``svc_id`` unless it has nothing pending, is already being
+        served, its Consul check is not passing or its circuit breaker is open.
+        """
+        if not self._passing(svc_id):
+            return
+        breaker = self._breakers.get(svc_id)
+        if breaker is not None and not breaker.allow():
+            return
+        if self._pending.begin_drain(svc_id):
+            self._schedule_drain(svc_id)
+
+
+    def _reachable(self, svc_id) -> bool:
+        breaker = self._breakers.get(svc_id)
+        return breaker is None or breaker.state == circuitBreaker.CLOSED
+
+
+    def _passing(self, svc_id) -> bool:
+        """
+        Whether the Consul check of ``svc_id`` passes: an instance that is starting,
+        not ready or saturated reports "warning" (see Node.health).
+        """
+        with self._peers_lock:
+            peer = self._peers.get(svc_id)
+        return peer is None or peer.get('status', healthCheck.PASSING) == healthCheck.PASSING
+
+
+    def _preferred(self, svc_id) -> bool:
+        """
+        Instances anycast targets are routed to when the target has any.
+        """
+        return self._passing(svc_id) and self._reachable(svc_id)
+
 
+    def _retry_pending(self):
+        """
+        Background thread applying the pending-store retention and restarting
+        deliveries that failed. Discovery does not depend on it: new peers are
+        served as soon as their watch event arrives.
+        """
+        while True:
             time.sleep(self._poll_interval)
+            self._pending.prune()
+            for svc_id in self._peer_snapshot():
+                self._kick(svc_id)
+
+
+    def _schedule_drain(self, svc_id):
+        self._dispatcher.submit(self._drain_peer, svc_id)
+
 
-    def _dispatch_to_peer(self, svc_id, ip: str, port: int, task: dict):
+    def _sync_clocks(self):
         """
-        Connect and send one payload to one peer, record when done.
+        Background thread pinging every peer that answers clock pings, over its open
+        stream (no stream is opened for it): once per clock_sync_interval, and as soon
+        as the stream was reopened, since the peer keeps the estimate per stream.
         """
-        try:
-            sock = self._connect_to_one_peer(ip, port)
-            if not sock:
-                raise RuntimeError(f"connect failed to {ip}:{port}")
-            handler = SendMessageHandler(sock, (ip, port), task['payload'])
-            handler.send_all_messages()
-            # logging.info(f"[CLIENT] sent keys {list(task['payload'].keys()).remove('container_creds_xxx')} to {ip}:{port}")
-            task['sent_peers'].add(svc_id)
-        except Exception:
-            logging.exception(f"[CLIENT] error sending to {ip}:{port}")
+        while True:
+            time.sleep(min(self.clock_sync_interval, 1.0))
+            peers = self._peer_snapshot()
+            for svc_id in list(self._clocks):
+                if svc_id not in peers:
+                    del self._clocks[svc_id]
+            for svc_id, peer in peers.items():
+                if not clockSync.peer_supports(peer['meta']):
+                    continue
+                generation = self._pool.generation(svc_id)
+                if generation is None:
+                    continue
+                clock = self._clocks.setdefault(svc_id, clockSync.ClockEstimate())
+                now = time.monotonic()
+                if (clock.generation == generation and clock.attempted_at is not None
+                        and now - clock.attempted_at < self.clock_sync_interval):
+                    continue
+                clock.generation, clock.attempted_at = generation, now
+                try:
+                    self._sync_clock(svc_id, clock)
+                except Exception:
+                    logging.exception(f"[CLOCK] ping to {svc_id} failed")
+
+
+    def _clock_request(self, svc_id, clock : clockSync.ClockEstimate):
+        return self._pool.request(svc_id, clock.ping, clock.is_reply)
+
+
+    def _sync_clock(self, svc_id, clock : clockSync.ClockEstimate):
+        reply = self._clock_request(svc_id, clock)
+        if reply is None:
+            logging.warning(f"[CLOCK] no answer from {svc_id} to a clock ping")
+            return
+        header, received, clock.generation = reply
+        rtt, offset = clock.update(header, received)
+        peer = self._peer_label(svc_id)
+        metrics.CLOCK_OFFSET_SECONDS.set(clock.offset, peer=peer)
+        metrics.RTT_SECONDS.observe(rtt, peer=peer)
+        logging.info(f"[CLOCK] {peer} ({svc_id}): rtt {rtt * 1e3:.3f} ms (smoothed {clock.rtt * 1e3:.3f} ms), "
+                     f"clock offset {clock.offset * 1e3:+.3f} ms (sample {offset * 1e3:+.3f} ms)")
+
+
+    def _chunk_assembler(self):
+        return chunkStream.ChunkAssembler(self.chunk_spill_bytes, self.chunk_spill_dir)
+
+
+    def _next_delivery(self, svc_id, streams : deque):
+        """
+        One step of a delivery loop: (next task or None, peer or None). The task is
+        None when the loop has nothing new to start (it then ended unless ``streams``
+        are still being sent); the peer is None when it is gone (the loop then ended).
+        """
+        task = None
+        if len(streams) < self.max_streams and self._has_credit(svc_id):
+            task = self._pending.next_for(svc_id, skip=[stream.task['id'] for stream in streams])
+        elif not streams:
+            # Out of credits: the loop ends here and the next grant starts it again
+            self._pending.end_drain(svc_id)
+            if self._has_credit(svc_id):
+                # granted in the meantime
+                self._kick(svc_id)
+            return None, None
+        if task is None and not streams:
+            return None, None
+        with self._peers_lock:
+            peer = self._peers.get(svc_id)
+        if peer is None:
+            self._pending.end_drain(svc_id)
+        return task, peer
+
+
+    def _outstanding(self, svc_id) -> int:
+        """
+        Payloads given to ``svc_id`` and not processed yet (least_outstanding routing):
+        those still queued here, plus the frames sent to it that it has not reported
+        consumed, for a peer granting credits.
+        """
+        outstanding = self._pending.pending_for(svc_id)
+        window = self._credits.get(svc_id)
+        if window is not None:
+            outstanding += window.in_flight(self._pool.generation(svc_id)) or 0
+        return outstanding
+
+
+    def _has_credit(self, svc_id) -> bool:
+        window = self._credits.get(svc_id)
+        return window is None or window.available(self._pool.generation(svc_id)) > 0
+
+
+    def _stream_for(self, task : dict, svc_id, peer : dict):
+        """
+        Frame of ``task`` for ``peer``, as (frame, raw bytes, wire bytes), or as an
+        OutboundStream when it is to be sent in chunks. For a peer on the same host
+        the frame is a descriptor of a shared-memory copy; if it is not sent, that
+        copy must be removed with shmTransport.release().
+        """
+        frame, raw_nbytes, wire_nbytes = self._frame_for(task, svc_id, peer)
+        size = sum(memoryview(segment).nbytes for segment in frame[1:])
+        binary = self.binary_header and frameHeader.peer_supports_binary(peer['meta'])
+        if (binary and self.shm_threshold is not None and size >= self.shm_threshold
+                and shmTransport.same_domain(self.shm_domain, peer['meta'])):
+            try:
+                frame = shmTransport.export(frame, task['seq'], task['created_at'], task['trace_id'])
+                self._count_link(svc_id, shm_frames=1)
+                return frame, raw_nbytes, wire_nbytes
+            except OSError as e:
+                logging.warning(f"[SHM] could not write a {size} byte frame for {svc_id} ({e}); sending it over the socket")
+        if (binary and self.chunk_threshold is not None and size >= self.chunk_threshold
+                and chunkStream.peer_supports(peer['meta'])):
+            return chunkStream.OutboundStream(task, frame, self.chunk_size, raw_nbytes, wire_nbytes)
+        return frame, raw_nbytes, wire_nbytes
+
+
+    def _streamed(self, svc_id, streams : deque, generation):
+        """
+        Book-keeping after the head of ``streams`` was handed a chunk: None for a
+        StreamReset (start the frame over), else the connection generation.
+        """
+        stream = streams[0]
+        if generation is None:
+            stream.restart()
+            self._count_link(svc_id, stream_restarts=1)
+            logging.warning(f"[CLIENT] stream to {svc_id} was reopened; restarting chunked frame {stream.task['seq']}")
+            return
+        stream.generation = generation
+        self._count_link(svc_id, chunks=1)
+        if stream.done:
+            streams.popleft()
+            self._pending.mark_delivered(stream.task, svc_id)
+            self._count_link(svc_id, chunked_frames=1)
+            self._sent(svc_id, stream.task, stream.raw_nbytes, stream.wire_nbytes, generation)
+        else:
+            # round robin between the streams in progress
+            streams.rotate(-1)
+
+
+    def _drain_peer(self, svc_id):
+        """
+        Send ``svc_id`` its pending payloads, oldest first, over its pooled stream.
+        Large frames go out in chunks, one per pass, between the frames queued
+        behind them. Stops when none is left or on the first failure (_retry_pending
+        restarts it; frames only partly streamed are then sent again from the start).
+        """
+        streams = deque()   # OutboundStream being sent to this peer
+        while True:
+            task, peer = self._next_delivery(svc_id, streams)
+            if peer is None:
+                return
+            addr = self._peer_addr(peer)
+            try:
+                if task is not None:
+                    out = self._stream_for(task, svc_id, peer)
+                    if isinstance(out, chunkStream.OutboundStream):
+                        streams.append(out)
+                    else:
+                        frame, raw_nbytes, wire_nbytes = out
+                        try:
+                            generation = self._pool.send(svc_id, addr, frame, task['variables'])
+                        except Exception:
+                            shmTransport.release(frame)
+                            raise
+                        self._pending.mark_delivered(task, svc_id)
+                        self._sent(svc_id, task, raw_nbytes, wire_nbytes, generation)
+                if streams:
+                    stream = streams[0]
+                    try:
+                        generation = self._pool.send(svc_id, addr, stream.next_chunk(),
+                                                     stream.task['variables'] if stream.last else (),
+                                                     stream.generation)
+                    except StreamReset:
+                        generation = None
+                    self._streamed(svc_id, streams, generation)
+            except Exception:
+                logging.exception(f"[CLIENT] error sending to {peer['address']}:{peer['port']}")
+                self._delivery_failed(svc_id)
+                return
+
+
+    def pool_stats(self) -> dict:
+        """
+        Counters of the per-peer connection pool (connects, reuses, reconnects,
+        evictions, failures) plus the state of every pooled stream.
+        """
+        return self._pool.stats()
+
+
+    def link_stats(self) -> dict:
+        """
+        Per-peer payload counters: frames sent (how many compressed, how many streamed
+        in chunks, the chunks written and the streams started over, how many written
+        to shared memory), content bytes
+        before and after compression, bytes saved, and the CPU seconds spent
+        compressing for that peer (a frame shared by several peers is compressed once).
+        """
+        with self._links_lock:
+            links = {svc_id: dict(link) for svc_id, link in self._links.items()}
+        for link in links.values():
+            link['saved_bytes'] = link['raw_bytes'] - link['wire_bytes']
+        return links
+
+
+    def clock_stats(self) -> dict:
+        """
+        Per-peer clock estimates from the pings: offset of the peer's clock (its
+        clock minus ours), smoothed and last RTT, and the exchanges completed.
+        """
+        return {svc_id: clock.stats() for svc_id, clock in list(self._clocks.items())}
+
+
+    def flow_stats(self) -> dict:
+        """
+        Per-peer credit windows of the peers granting credits: frame limit and frames
+        sent on the current stream, credits available, grants received, probes sent.
+        """
+        return {svc_id: window.stats() for svc_id, window in list(self._credits.items())}
+
+
+    def breaker_stats(self) -> dict:
+        """
+        Per-peer circuit breaker state ("closed", "open" or "half_open"), consecutive
+        failures, times opened, seconds before the next probe and last success/failure times.
+        """
+        return {svc_id: breaker.stats() for svc_id, breaker in list(self._breakers.items())}
+
+
+    def pending_stats(self) -> dict:
+        """
+        State of the pending store: tasks and bytes held, tasks still owed to each
+        peer, and how many were added, retired, expired and evicted.
+        """
+        return self._pending.stats()
+
+
+    def executor_stats(self) -> dict:
+        """
+        Queue depth, active workers and job counters of the outbound dispatch and
+        inbound on_receive executors ('blocked' counts submissions that waited).
+        """
+        return {
+            'dispatch': self._dispatcher.stats(),
+            'on_receive': self._callbacks.stats(),
+        }
+
+
+    def set_ready(self, ready : bool = True, reason : str = None):
+        """
+        Mark the node (not) ready to take work, e.g. while a model is (re)loaded;
+        the health check reports it as "warning" with ``reason`` until ready again.
+        """
+        self._ready = (bool(ready), reason)
+
+
+    def _readiness(self) -> tuple:
+        ready, reason = self._ready
+        if ready and self.readiness is not None:
+            try:
+                result = self.readiness()
+            except Exception as e:
+                result = (False, f"readiness check raised {e!r}")
+            ready, reason = result if isinstance(result, tuple) else (bool(result), None)
+        return ready, reason
+
+
+    def health(self) -> tuple:
+        """
+        Readiness report behind the Consul check: (check status, details). Only reads
+        counters; never touches the sockets. Details hold 'status' ("ready", "starting",
+        "not_ready" or "saturated"), the executor queue depths and fill, the pending
+        tasks, the known peers (how many have an open circuit breaker, how many do not
+        pass their check) and the uptime.
+        """
+        details = {'status': "ready", 'uptime_s': round(time.time() - self._started_at, 1)}
+        if not self._started:
+            details['status'] = "starting"
+            return healthCheck.WARNING, details
+        executors = self.executor_stats()
+        fill = healthCheck.queue_fill(executors)
+        details['queues'] = {name: {'queued': stats['queued'], 'max_queue': stats['max_queue'],
+                                    'active': stats['active'], 'fill': round(fill[name], 3)}
+                             for name, stats in executors.items()}
+        details['pending_tasks'] = self.pending_stats()['tasks']
+        details['peers'] = len(self._peer_snapshot())
+        details['unreachable_peers'] = sum(not self._reachable(svc_id) for svc_id in list(self._breakers))
+        details['unready_peers'] = sum(not self._passing(svc_id) for svc_id in self._peer_snapshot())
+        ready, reason = self._readiness()
+        if not ready:
+            details['status'] = "not_ready"
+        elif max(fill.values()) >= healthCheck.SATURATED:
+            details['status'] = "saturated"
+            reason = "on_receive or dispatch queue nearly full"
+        if reason:
+            details['reason'] = reason
+        return (healthCheck.PASSING if details['status'] == "ready" else healthCheck.WARNING), details
+
+
+    def _health_response(self) -> tuple:
+        status, details = self.health()
+        return healthCheck.HTTP_STATUS[status], details
+
+
+    def _collect_metrics(self):
+        """
+        Metric families for /metrics built from the stats above at scrape time,
+        as (name, type, help, [(labels, value)]).
+        """
+        if not self._started:
+            return
+        pending = self.pending_stats()
+        yield ("autter_pending_tasks", "gauge", "Payloads held for peers that have not received them.",
+               [({}, pending['tasks'])])
+        yield ("autter_pending_bytes", "gauge", "Encoded bytes held by the pending store.",
+               [({}, pending['bytes'])])
+        yield ("autter_pending_peer_tasks", "gauge", "Payloads still owed to each peer.",
+               [({'peer': self._peer_label(svc_id)}, n) for svc_id, n in pending['peers'].items()])
+        yield ("autter_pending_dropped_total", "counter", "Undelivered payloads dropped by the pending store.",
+               [({'reason': reason}, pending[reason]) for reason in ('expired', 'evicted', 'coalesced')])
+        yield ("autter_flow_credits_available", "gauge", "Frames each peer granting credits may still be sent.",
+               [({'peer': self._peer_label(svc_id)}, window['available']) for svc_id, window in self.flow_stats().items()])
+        yield ("autter_circuit_open", "gauge", "1 while deliveries to a peer are suspended (open or half-open breaker).",
+               [({'peer': self._peer_label(svc_id)}, int(b['state'] != circuitBreaker.CLOSED))
+                for svc_id, b in self.breaker_stats().items()])
+
+        executors = self.executor_stats()
+        for name, help_text, key in (
+            ("autter_executor_workers", "Worker threads.", 'workers'),
+            ("autter_executor_active", "Workers running a job.", 'active'),
+            ("autter_executor_queued", "Jobs waiting for a worker.", 'queued'),
+            ("autter_executor_queue_capacity", "Jobs that may wait before submitters block.", 'max_queue'),
+        ):
+            yield (name, "gauge", help_text, [({'executor': e}, s[key]) for e, s in executors.items()])
+        for name, help_text, key in (
+            ("autter_executor_jobs_total", "Jobs submitted.", 'submitted'),
+            ("autter_executor_failed_total", "Jobs that raised.", 'failed'),
+            ("autter_executor_blocked_total", "Submissions that waited for queue space (saturation).", 'blocked'),
+        ):
+            yield (name, "counter", help_text, [({'executor': e}, s[key]) for e, s in executors.items()])
+        yield ("autter_threads", "gauge", "Live threads in the process.", [({}, threading.active_count())])
+
+        pool = self.pool_stats()
+        yield ("autter_connections_open", "gauge", "Open outbound streams.", [({}, pool['open'])])
+        yield ("autter_connection_events_total", "counter", "Outbound stream events.",
+               [({'event': event}, pool[event]) for event in ('connects', 'reconnects', 'evictions', 'failures')])
+
+        links = {self._peer_label(svc_id): link for svc_id, link in self.link_stats().items()}
+        for name, kind, help_text, key in (
+            ("autter_frames_sent_total", "counter", "Frames written, per peer.", 'frames'),
+            ("autter_bytes_sent_total", "counter", "Payload bytes written (after compression), per peer.", 'wire_bytes'),
+            ("autter_bytes_sent_uncompressed_total", "counter", "Payload bytes before compression, per peer.", 'raw_bytes'),
+            ("autter_compress_seconds_total", "counter", "CPU seconds spent compressing, per peer.", 'compress_s'),
+            ("autter_chunks_sent_total", "counter", "Chunks of large frames written, per peer.", 'chunks'),
+            ("autter_shm_frames_total", "counter", "Frames handed over through shared memory, per peer.", 'shm_frames'),
+        ):
+            yield (name, kind, help_text, [({'peer': peer}, link[key]) for peer, link in links.items()])
 
 
     # def _send_to_peer(self, service, payload : dict):
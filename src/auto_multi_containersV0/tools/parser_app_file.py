@@ -14,11 +14,10 @@ APP_TEMPLATE = """\
 import time
 import logging
 import numpy as np
-from node import Node
-from queue import Queue
+{node_import}
 from itertools import count as _count
 
-# If there’s a custom Content in add_files/<module>.py, we’ll import it below
+{worker_import}# If there’s a custom Content in add_files/<module>.py, we’ll import it below
 {custom_import}
 
 if __name__ == "__main__":
@@ -31,29 +30,7 @@ if __name__ == "__main__":
     
     # --- Instantiate your custom logic (if any) ---
 {content_init}
-    in_q = Queue()
-
-    def handle_msg(creds, var_name, msg, node_obj):
-        # push into our local queue
-        in_q.put((creds, var_name, msg))
-        # if content wants data, wait until at least one batch is in
-        if content.requires_data:
-            while in_q.empty():
-                time.sleep(0.1)
-            _, _, latest = None, None, None
-            while not in_q.empty():
-                _, _, latest = in_q.get()
-            out = content.run(latest)
-        else:
-            out = content.run()
-
-        # send the result right away
-        idx = next(_var_counter)
-        send_payload = {{"var_handle_msg{{}}".format(idx): out}}
-        node_obj.send_data_to_peers(send_payload)
-        # reset sent_peers so we can re-send if needed:
-        # node_obj.sent_peers.clear()
-
+{handle_msg}
     # --- Build the Node, give it your role, device, etc. ---
     if content.requires_data :
         receive_logic = {receive_logic}
@@ -61,7 +38,7 @@ if __name__ == "__main__":
         receive_logic=None
     # receive_logic=None
 
-    node = Node(
+    node = {node_class}(
         5000,
         log_file_path=log_file_path,
         container_name="{module}",
@@ -70,6 +47,10 @@ if __name__ == "__main__":
         consul_url=CONSUL_URL,
         target_roles={targets},
         on_receive=receive_logic,
+        compression={compression!r},
+        routing={routing!r},
+        conflate={conflate!r},
+        message_ttl={ttl!r},
     )
 
     # --- Decide if we wait for incoming data before running ---
@@ -86,11 +67,107 @@ if __name__ == "__main__":
 #     time.sleep(30)
 # """
 
+# Received messages are computed by long-lived inference workers owning the content, and the
+# results are sent by a single output thread, so the model never waits on the network
+OUTPUT_STAGE = """\
+    output = BoundedExecutor("output", workers=1, max_queue=64)
+
+    def publish(out, node_obj):
+        idx = next(_var_counter)
+        node_obj.send_data_to_peers({{"var_handle_msg{{}}".format(idx): out}}{send_options})
+"""
+
+HANDLE_MSG = """
+    # The workers block on their input queue; only the newest message queued is computed,
+    # and only the latest result matters downstream (it replaces any earlier one not sent yet)
+    worker = InferenceWorker(
+        lambda msg: content.run(msg) if content.requires_data else content.run(),
+        lambda out, node_obj: output.submit(publish, out, node_obj),
+        workers={workers}, latest_only=True, name="{module}",
+    )
+
+    def handle_msg(creds, var_name, msg, node_obj):
+        # returns at once unless the input queue is full, which holds back the sender
+        worker.submit(msg, node_obj)
+"""
+
+# "Batch" modules: every received message is one input of a micro-batch; a single inference
+# worker calls content.run_batch(inputs) (inputs are the messages, or None for contents that
+# do not require data) and each output is sent on as the result of its own message
+HANDLE_MSG_BATCHED = """
+    if hasattr(content, "run_batch"):
+        run_batch = content.run_batch
+    else:
+        logging.warning("Content has no run_batch(); running its inputs one by one")
+        run_batch = lambda inputs: [content.run(x) if content.requires_data else content.run() for x in inputs]
+    batcher = MicroBatcher(run_batch, max_batch={max_batch}, max_wait={max_wait!r}, name="{module}")
+
+    def hand_over(future, node_obj):
+        if future.exception() is None:
+            output.submit(publish, future.result(), node_obj)
+
+    def handle_msg(creds, var_name, msg, node_obj):
+        # blocks while the batcher's queue is full, which holds back the sender
+        future = batcher.submit(msg if content.requires_data else None)
+        future.add_done_callback(lambda f: hand_over(f, node_obj))
+"""
+
+
+def parse_batch(batch):
+    """
+    "Batch" of a module: true, a max batch size, or {"Size": int, "Wait_ms": float}.
+    Returns (max batch size, max wait in seconds), or None when batching is off.
+    """
+    if not batch:
+        return None
+    if batch is True:
+        batch = {}
+    elif isinstance(batch, int):
+        batch = {"Size": batch}
+    return int(batch.get("Size", 8)), float(batch.get("Wait_ms", 5)) / 1000
+
+
+def parse_send_to(send_to):
+    """
+    Split the Send_to entries of a module into the target names and the
+    routing policies of the targets that are not broadcast to.
+    """
+    targets, routing = [], {}
+    for entry in send_to:
+        if isinstance(entry, str):
+            targets.append(entry)
+            continue
+        target = entry["Role"]
+        targets.append(target)
+        policy = entry.get("Policy", "broadcast")
+        if policy == "hash":
+            policy = f"hash:{entry['Key']}"
+        if policy != "broadcast":
+            routing[target] = policy
+    return targets, routing
+
+
 def generate_app_file(module, modules_dir, add_files_dir):
     name    = module["Name"]
     role    = module.get("Role", "default_role")
     device  = module.get("Device", "CPU")
-    targets = module.get("Send_to", [])
+    # Entries are role / service names (every instance gets every payload), or
+    # {"Role": ..., "Policy": "round_robin" | "least_outstanding" | "hash", "Key": ...}
+    # to spread the payloads over the instances of that target instead
+    targets, routing = parse_send_to(module.get("Send_to", []))
+    # "threads" (Node) or "asyncio" (AsyncNode: single event loop, same contract)
+    engine  = module.get("Engine", "threads")
+    # e.g. "zlib", "lz4:1" or {"c2": "zstd", "*": "zlib"}; None sends uncompressed
+    compression = module.get("Compression")
+    # Variables only the latest value of matters, and seconds after which a payload is
+    # not worth delivering (None: no deadline)
+    conflate = module.get("Conflate")
+    ttl = module.get("TTL")
+    # Gather received messages into content.run_batch() calls: true, a max batch size,
+    # or {"Size": 8, "Wait_ms": 5}
+    batch = parse_batch(module.get("Batch"))
+    # Inference worker threads (one: the model is never called concurrently)
+    workers = int(module.get("Workers", 1))
 
     module_dir  = os.path.join(modules_dir, name)
     out_path    = os.path.join(module_dir, f"app_{name}.py")
@@ -189,6 +266,22 @@ for i in range(10):
         else:
             print(f"Warning: Dockerfile not found for module {name}, cannot add requirements step.")
 
+    handle_msg = worker_import = ""
+    if batch and content_init:
+        max_batch, max_wait = batch
+        handle_msg = (OUTPUT_STAGE.format(send_options="")
+                      + HANDLE_MSG_BATCHED.format(max_batch=max_batch, max_wait=max_wait, module=name))
+        worker_import = "from workerPool import BoundedExecutor\nfrom microBatcher import MicroBatcher\n"
+    elif content_init:
+        handle_msg = (OUTPUT_STAGE.format(send_options=', conflate="handle_msg"')
+                      + HANDLE_MSG.format(workers=workers, module=name))
+        worker_import = "from workerPool import BoundedExecutor\nfrom inferenceWorker import InferenceWorker\n"
+
+    if engine == "asyncio":
+        node_import, node_class = "from asyncNode import AsyncNode", "AsyncNode"
+    else:
+        node_import, node_class = "from node import Node", "Node"
+
     # 3) Render & write the app_<name>.py
     app_py = APP_TEMPLATE.format(
         custom_import=custom_import,
@@ -199,7 +292,15 @@ for i in range(10):
         targets=targets,
         run_block=run_block,
         CONSUL_URL=CONSUL_URL,
-        receive_logic=receive_logic
+        receive_logic=receive_logic,
+        node_import=node_import,
+        node_class=node_class,
+        compression=compression,
+        routing=routing,
+        conflate=conflate,
+        ttl=ttl,
+        handle_msg=handle_msg,
+        worker_import=worker_import,
     )
 
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
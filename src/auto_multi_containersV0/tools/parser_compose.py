@@ -101,6 +101,7 @@ import json
 import os
 import subprocess
 import sys
+import socket
 import yaml
 
 def build_image(module_name):
@@ -150,7 +151,8 @@ def generate_compose(config, network_name, mode):
         
         # Ports: Map container port 5000 to a host port derived from index (e.g., 5001, 5002, etc.).
         host_port = 5000 + (i + 1)
-        service_def["ports"] = [f"{host_port}:5000"]
+        # and the Prometheus /metrics and Consul /health endpoint (METRICS_PORT) to 9100 + index
+        service_def["ports"] = [f"{host_port}:5000", f"{9100 + (i + 1)}:9100"]
         
         # Networks: Attach to the given network.
         service_def["networks"] = [network_name]
@@ -160,7 +162,7 @@ def generate_compose(config, network_name, mode):
             "MODULE_NAME": module_name,
             "DEVICE": module.get("Device", "").upper(),
             "ROLE": module.get("Role", ""),
-            "SEND_TO": ",".join(module.get("Send_to", [])),
+            "SEND_TO": ",".join(t if isinstance(t, str) else t["Role"] for t in module.get("Send_to", [])),
             "SERVICE_NAME": f'multi_app_stack_{module_name}_service',
             "CONSUL_URL" : "http://consul:8500"
         }
@@ -178,7 +180,27 @@ def generate_compose(config, network_name, mode):
                 f"./{module_name}:/app",
                 "./node.py:/app/node.py",
                 "./receiveMessageHandler.py:/app/receiveMessageHandler.py",
-                "./sendMessageHandler.py:/app/sendMessageHandler.py"
+                "./sendMessageHandler.py:/app/sendMessageHandler.py",
+                "./connectionPool.py:/app/connectionPool.py",
+                "./asyncNode.py:/app/asyncNode.py",
+                "./pendingStore.py:/app/pendingStore.py",
+                "./workerPool.py:/app/workerPool.py",
+                "./frameHeader.py:/app/frameHeader.py",
+                "./codecRegistry.py:/app/codecRegistry.py",
+                "./payloadCompression.py:/app/payloadCompression.py",
+                "./chunkStream.py:/app/chunkStream.py",
+                "./shmTransport.py:/app/shmTransport.py",
+                "./metrics.py:/app/metrics.py",
+                "./clockSync.py:/app/clockSync.py",
+                "./logPipeline.py:/app/logPipeline.py",
+                "./routingPolicy.py:/app/routingPolicy.py",
+                "./flowControl.py:/app/flowControl.py",
+                "./healthCheck.py:/app/healthCheck.py",
+                "./circuitBreaker.py:/app/circuitBreaker.py",
+                "./microBatcher.py:/app/microBatcher.py",
+                "./inferenceWorker.py:/app/inferenceWorker.py",
+                # Unix domain sockets of the containers (see Node._peer_addr)
+                "./uds:/run/autter"
             ]
             
             service_def["build"] = {
@@ -186,11 +208,27 @@ def generate_compose(config, network_name, mode):
                 "dockerfile": f"Dockerfile.{module_name}"
             }
             service_def["container_name"] = module_name
+
+            # Every container joins the IPC namespace (and so the /dev/shm) of the first one,
+            # and SHM_DOMAIN tells their Nodes to pass large payloads through shared memory
+            if i == 0:
+                service_def["ipc"] = "shareable"
+                service_def["shm_size"] = config.get("Shm_size", "1gb")
+            else:
+                service_def["ipc"] = f"service:{modules[0].get('Name')}_service"
+            env_vars["SHM_DOMAIN"] = f"single-{network_name}"
+            env_vars["HOST_ID"] = socket.gethostname()
+            env_vars["UDS_DIR"] = "/run/autter"
             
         # For multi-host (stack) mode, build the image first and add an 'image' reference.
         elif mode == "multi":
             # image_name = build_image(module_name)
             service_def["image"] = f"157.159.160.197:5000/demo_{module_name}:latest"
+            # A local named volume exists once per swarm node, so only the tasks placed on
+            # the same node share their Unix domain sockets
+            service_def["volumes"] = ["autter_uds:/run/autter"]
+            env_vars["HOST_ID"] = "{{.Node.ID}}"
+            env_vars["UDS_DIR"] = "/run/autter"
             # Do not restart completed tasks
             service_def["deploy"] = {
                 "restart_policy": {"condition" : "none"},
@@ -231,6 +269,7 @@ def generate_compose(config, network_name, mode):
     }
 
     if mode=='multi':
+        volumes["autter_uds"] = {}
         compose_dict['volumes'] = volumes
     return compose_dict
 
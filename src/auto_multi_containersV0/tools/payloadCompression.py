@@ -0,0 +1,150 @@
+import zlib
+import logging
+
+try:
+    import lz4.frame as _lz4
+except ImportError:
+    _lz4 = None
+
+try:
+    import zstandard as _zstd
+except ImportError:
+    _zstd = None
+
+####################################################################################################
+# Optional compression of frame segments (content and out-of-band buffers, each on its own).
+# The header then carries [algorithm id, [original length of each segment]]: "compression" in the
+# JSON header, extension EXT_COMPRESSION of the binary one. Receivers advertise the algorithms they
+# can decompress in their Consul service Meta (META_KEY); zlib is always there, lz4 and zstd when
+# their packages are installed. A frame is only sent compressed if it shrank by MIN_SAVING.
+####################################################################################################
+
+ZLIB = 1
+LZ4 = 2
+ZSTD = 3
+
+META_KEY = "compression"
+
+# Below this fraction saved, the frame goes out uncompressed (e.g. noisy float data)
+MIN_SAVING = 0.05
+
+
+class _Zlib:
+    algo_id = ZLIB
+    name = "zlib"
+    default_level = 1   # bandwidth-bound links still want cheap CPU
+
+    def compress(self, data, level):
+        return zlib.compress(data, level)
+
+    def decompress(self, data, size):
+        d = zlib.decompressobj()
+        # max_length=0 would mean unbounded
+        out = d.decompress(data, max(size, 1))
+        if d.unconsumed_tail:
+            raise ValueError("zlib segment larger than announced.")
+        return out
+
+
+class _Lz4:
+    algo_id = LZ4
+    name = "lz4"
+    default_level = 0
+
+    def compress(self, data, level):
+        return _lz4.compress(data, compression_level=level, store_size=True)
+
+    def decompress(self, data, size):
+        return _lz4.decompress(data)
+
+
+class _Zstd:
+    algo_id = ZSTD
+    name = "zstd"
+    default_level = 3
+
+    def compress(self, data, level):
+        return _zstd.ZstdCompressor(level=level).compress(data)
+
+    def decompress(self, data, size):
+        return _zstd.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+_algorithms = {}
+
+
+def register(algorithm):
+    _algorithms[algorithm.algo_id] = algorithm
+
+
+def available() -> list:
+    return [a.name for a in _algorithms.values()]
+
+
+def parse(spec : str):
+    """
+    "zlib", "lz4", "zstd", optionally with a level ("zlib:6"). Returns (algo id, level),
+    or None for None / "none" and for algorithms not installed here (with a warning).
+    """
+    if not spec or spec == "none":
+        return None
+    name, _, level = spec.partition(":")
+    for algorithm in _algorithms.values():
+        if algorithm.name == name:
+            return algorithm.algo_id, int(level) if level else algorithm.default_level
+    logging.warning(f"[COMPRESSION] '{name}' is not available here ({available()}); sending uncompressed")
+    return None
+
+
+def accepted(meta : dict) -> set:
+    """
+    Algorithm ids a peer can decompress, from its Consul service Meta.
+    """
+    names = (meta or {}).get(META_KEY, "").split(",")
+    return {a.algo_id for a in _algorithms.values() if a.name in names}
+
+
+def compress(algo_id : int, level : int, segments : tuple):
+    """
+    Compress every segment. Returns (segments, [algo id, original lengths]) or
+    None when the frame would not shrink by MIN_SAVING.
+    """
+    algorithm = _algorithms[algo_id]
+    lengths = [memoryview(segment).nbytes for segment in segments]
+    packed = tuple(algorithm.compress(segment, level) for segment in segments)
+    if sum(len(p) for p in packed) > (1 - MIN_SAVING) * sum(lengths):
+        return None
+    return packed, [algo_id, lengths]
+
+
+def decompress(spec : list, content, buffers) -> tuple:
+    """
+    Undo compress() on a received frame. Buffers come back as bytearrays, so
+    arrays rebuilt over them stay writable.
+    """
+    algo_id, lengths = spec
+    algorithm = _algorithms.get(algo_id)
+    if algorithm is None:
+        raise ValueError(f"Unknown compression algorithm {algo_id}.")
+    segments = [content, *(buffers or [])]
+    if len(segments) != len(lengths):
+        raise ValueError("Compressed segment count does not match the header.")
+    out = []
+    for segment, size in zip(segments, lengths):
+        try:
+            data = algorithm.decompress(segment, size)
+        except ValueError:
+            raise
+        except Exception as e:
+            raise ValueError(f"Corrupt {algorithm.name} segment: {e}")
+        if len(data) != size:
+            raise ValueError("Decompressed segment size does not match the header.")
+        out.append(data)
+    return out[0], [bytearray(b) for b in out[1:]]
+
+
+register(_Zlib())
+if _lz4 is not None:
+    register(_Lz4())
+if _zstd is not None:
+    register(_Zstd())
@@ -0,0 +1,237 @@
+import threading
+import logging
+import time
+from collections import OrderedDict
+from itertools import count
+
+
+class PendingStore:
+    def __init__(self, max_age : float = 300.0, max_bytes : int = 256 * 1024 * 1024):
+        """
+        Pending deliveries of the payloads enqueued by send_data_to_peers().
+        :param max_age: Seconds a task is kept for peers that have not received it
+                        yet (late joiners, unreachable peers). None keeps it forever.
+        :param max_bytes: Upper bound on the encoded bytes held; the oldest tasks are
+                          evicted first. None disables the bound.
+
+        A task is a dict holding at least 'nbytes' and 'created_at'; the store adds 'id',
+        'targets' (peers it must reach) and 'delivered'. Tasks are indexed per peer, so
+        finding the next delivery for a peer never scans the whole backlog, and a task
+        is retired as soon as every current target has it, unless its optional 'routes'
+        ({target : peer routed to}) still has a target routed to no peer (None). A task
+        with a 'deadline' (time.time() value) is dropped once it passed, delivered or not.
+        """
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        self._tasks = OrderedDict()     # { task id : task }, oldest first
+        self._by_peer = {}              # { svc_id : OrderedDict({ task id : task }) } still to deliver
+        self._draining = set()          # peers with a delivery loop running
+        self.nbytes = 0
+        self._counters = {
+            'added': 0,
+            'retired': 0,
+            'expired': 0,
+            'evicted': 0,
+            'coalesced': 0,
+        }
+
+
+    def add(self, task : dict, peers):
+        """
+        Store a new task and index it for every peer in ``peers``.
+        """
+        with self._lock:
+            task['id'] = next(self._ids)
+            task['targets'] = set(peers)
+            task['delivered'] = set()
+            self._tasks[task['id']] = task
+            self.nbytes += task['nbytes']
+            self._counters['added'] += 1
+            for svc_id in task['targets']:
+                self._by_peer.setdefault(svc_id, OrderedDict())[task['id']] = task
+            self._prune_locked(time.time())
+
+
+    def add_peer(self, svc_id, accepts=None) -> int:
+        """
+        A peer joined: index every live task it has not received yet, or only
+        those for which accepts(task) holds (called with the store locked).
+        Returns the number of tasks now pending for it.
+        """
+        with self._lock:
+            index = self._by_peer.setdefault(svc_id, OrderedDict())
+            for task_id, task in self._tasks.items():
+                if svc_id not in task['delivered'] and (accepts is None or accepts(task)):
+                    task['targets'].add(svc_id)
+                    index[task_id] = task
+            return len(index)
+
+
+    def remove_peer(self, svc_id, reassign=None) -> set:
+        """
+        A peer left: forget its deliveries and retire the tasks it was holding back.
+        With ``reassign``, each live task it had not received is first handed to
+        reassign(task) (called with the store locked), the peer to deliver it to
+        instead or None. Returns the peers that were handed tasks.
+        """
+        handed = set()
+        with self._lock:
+            self._by_peer.pop(svc_id, None)
+            self._draining.discard(svc_id)
+            for task in list(self._tasks.values()):
+                if svc_id in task['targets']:
+                    task['targets'].discard(svc_id)
+                    if reassign is not None and svc_id not in task['delivered']:
+                        other = reassign(task)
+                        if other is not None and other not in task['delivered']:
+                            task['targets'].add(other)
+                            self._by_peer.setdefault(other, OrderedDict())[task['id']] = task
+                            handed.add(other)
+                    self._maybe_retire_locked(task)
+        return handed
+
+
+    def supersede(self, task : dict, svc_id, key=None) -> int:
+        """
+        Latest-wins delivery to ``svc_id``: forget the older tasks still queued for it
+        (only those whose 'conflate' entry is ``key``, if given), ``task`` replacing
+        them. A task left waiting for nobody is dropped. Returns the number of tasks
+        superseded.
+        """
+        superseded = 0
+        with self._lock:
+            index = self._by_peer.get(svc_id)
+            if not index:
+                return 0
+            for task_id, old in list(index.items()):
+                if task_id >= task['id'] or (key is not None and old.get('conflate') != key):
+                    continue
+                del index[task_id]
+                old['targets'].discard(svc_id)
+                superseded += 1
+                if old['targets'] or None in old.get('routes', {}).values():
+                    self._maybe_retire_locked(old)
+                else:
+                    self._drop_locked(old)
+            self._counters['coalesced'] += superseded
+        return superseded
+
+
+    def begin_drain(self, svc_id) -> bool:
+        """
+        True if the caller should start a delivery loop for ``svc_id``: something is
+        pending for it and no loop is running yet.
+        """
+        with self._lock:
+            if svc_id in self._draining or not self._by_peer.get(svc_id):
+                return False
+            self._draining.add(svc_id)
+            return True
+
+
+    def next_for(self, svc_id, skip=()):
+        """
+        Oldest task still to deliver to ``svc_id``, leaving out the ids in ``skip``
+        (frames the loop is already streaming); tasks past their deadline are dropped
+        on the way. Returns None once there is nothing left, and then ends the
+        delivery loop in the same step unless ``skip`` is set.
+        """
+        with self._lock:
+            index = self._by_peer.get(svc_id)
+            if index:
+                now = time.time()
+                for task_id, task in list(index.items()):
+                    if task_id in skip:
+                        continue
+                    if task.get('deadline') is not None and task['deadline'] < now:
+                        self._expire_locked(task)
+                        continue
+                    return task
+            if not skip:
+                self._draining.discard(svc_id)
+            return None
+
+
+    def end_drain(self, svc_id):
+        """
+        Stop the delivery loop of ``svc_id`` early (send failure, peer gone).
+        """
+        with self._lock:
+            self._draining.discard(svc_id)
+
+
+    def mark_delivered(self, task : dict, svc_id):
+        with self._lock:
+            index = self._by_peer.get(svc_id)
+            if index is not None:
+                index.pop(task['id'], None)
+            task['delivered'].add(svc_id)
+            self._maybe_retire_locked(task)
+
+
+    def pending_for(self, svc_id) -> int:
+        with self._lock:
+            return len(self._by_peer.get(svc_id, ()))
+
+
+    def prune(self):
+        """
+        Apply the max-age / max-bytes retention now.
+        """
+        with self._lock:
+            now = time.time()
+            for task in [t for t in self._tasks.values() if t.get('deadline') is not None and t['deadline'] < now]:
+                self._expire_locked(task)
+            self._prune_locked(now)
+
+
+    def _maybe_retire_locked(self, task : dict):
+        # A task nobody was targeted for yet keeps waiting for a first peer (or max_age),
+        # and so does one routed to an anycast target that has no instance yet
+        if (task['id'] in self._tasks and task['targets'] and task['targets'] <= task['delivered']
+                and None not in task.get('routes', {}).values()):
+            self._drop_locked(task)
+            self._counters['retired'] += 1
+
+
+    def _drop_locked(self, task : dict):
+        del self._tasks[task['id']]
+        self.nbytes -= task['nbytes']
+        for svc_id in task['targets'] - task['delivered']:
+            index = self._by_peer.get(svc_id)
+            if index is not None:
+                index.pop(task['id'], None)
+
+
+    def _expire_locked(self, task : dict):
+        self._drop_locked(task)
+        self._counters['expired'] += 1
+
+
+    def _prune_locked(self, now : float):
+        expired = evicted = 0
+        while self._tasks:
+            oldest = next(iter(self._tasks.values()))
+            if self.max_age is not None and now - oldest['created_at'] > self.max_age:
+                expired += 1
+            # the newest task is always kept, even if it alone exceeds max_bytes
+            elif self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._tasks) > 1:
+                evicted += 1
+            else:
+                break
+            self._drop_locked(oldest)
+        if expired or evicted:
+            self._counters['expired'] += expired
+            self._counters['evicted'] += evicted
+            logging.warning(f"[PENDING] dropped {expired} expired and {evicted} over-budget undelivered task(s)")
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['tasks'] = len(self._tasks)
+            stats['bytes'] = self.nbytes
+            stats['peers'] = {svc_id: len(index) for svc_id, index in self._by_peer.items()}
+        return stats
@@ -1,10 +1,17 @@
 import socket
-import pickle
 import logging
 import struct
 import json
-import io
 import time
+import threading
+import frameHeader
+import codecRegistry
+import payloadCompression
+from chunkStream import ChunkAssembler
+import shmTransport
+import clockSync
+import flowControl
+import metrics
 
 
 # class ReceiveMessageHandler:
@@ -76,30 +83,144 @@ import time
 #         return messages
 
 
+class RecvBuffer:
+    """
+    Growable receive buffer filled with recv_into(). Unread bytes live in one
+    bytearray between a read and a write position: consuming a header or a frame
+    just moves the read position, and space is reclaimed by compacting the unread
+    tail to the front, so receiving a frame costs O(n) instead of the O(n²) of
+    re-slicing a bytes object on every step.
+    """
+    # Once drained, a buffer grown past this for a large frame is given back
+    SHRINK_ABOVE = 8 * 1024 * 1024
+
+    def __init__(self, size : int = 64 * 1024):
+        self._size = size
+        self._buf = bytearray(size)
+        self._start = 0     # first unread byte
+        self._end = 0       # one past the last received byte
+
+
+    def __len__(self):
+        return self._end - self._start
+
+
+    def reserve(self, n : int):
+        """
+        Make sure ``n`` unread bytes fit after the read position. Called with the
+        header's content-length so a large frame grows the buffer once, up front.
+        """
+        if self._start + n <= len(self._buf):
+            return
+        unread = len(self)
+        if n <= len(self._buf):
+            # compact: move the unread tail to the front
+            self._buf[:unread] = self._buf[self._start:self._end]
+        else:
+            new_buf = bytearray(max(n, 2 * len(self._buf)))
+            new_buf[:unread] = memoryview(self._buf)[self._start:self._end]
+            self._buf = new_buf
+        self._start, self._end = 0, unread
+
+
+    def recv_from(self, sock : socket.socket, max_bytes : int = None) -> int:
+        """
+        recv_into() the free space after the unread data, at most ``max_bytes``.
+        Returns the number of bytes received (0 when the peer closed);
+        BlockingIOError propagates on a non-blocking socket with nothing to read.
+        """
+        if self._end == len(self._buf):
+            self.reserve(len(self) + 64 * 1024)
+        limit = len(self._buf) if max_bytes is None else min(len(self._buf), self._end + max_bytes)
+        n = sock.recv_into(memoryview(self._buf)[self._end:limit])
+        self._end += n
+        return n
+
+
+    def view(self, n : int) -> memoryview:
+        """
+        Zero-copy view of the next ``n`` unread bytes. It must be released (or
+        dropped) before more data is received, which may move the bytes.
+        """
+        return memoryview(self._buf)[self._start:self._start + n]
+
+
+    def consume(self, n : int):
+        self._start += n
+        if self._start == self._end:
+            # empty: rewind for free instead of compacting later
+            self._start = self._end = 0
+            if len(self._buf) > self.SHRINK_ABOVE:
+                self._buf = bytearray(self._size)
+
+
+    def take_into(self, dest : memoryview) -> int:
+        """
+        Move up to len(dest) unread bytes into ``dest``. Returns the count.
+        """
+        n = min(len(dest), len(self))
+        dest[:n] = memoryview(self._buf)[self._start:self._start + n]
+        self.consume(n)
+        return n
+
+
+class FrameExpired(ValueError):
+    """
+    The frame's deadline passed before it could be decoded.
+    """
+
+
 class ReceiveMessageHandler:
     
-    def __init__(self, sock : socket.socket, addr):
+    def __init__(self, sock : socket.socket, addr, allow_pickle : bool = True, chunks : ChunkAssembler = None,
+                 credits : flowControl.CreditGrant = None):
         self.sock = sock
         self.sock.setblocking(False)
         self.addr = addr
-        self._recv_buffer = b""
+        # Off: frames encoded with pickle are dropped (typed codec only)
+        self.allow_pickle = allow_pickle
+        # Reassembly of the large frames the peer streams in chunks
+        self.chunks = chunks or ChunkAssembler()
+        # The sender's clock offset, from its pings, to correct frame latencies
+        self.clock = clockSync.PeerClock()
+        # Credits granted to the sender as its frames are consumed (see flowControl)
+        self.credits = credits
+        if credits is not None:
+            credits.send = self.reply
+        # Control frames are written back from this thread and from on_receive workers
+        self._send_lock = threading.Lock()
+        self._recv_buffer = RecvBuffer()
+        # Header bytes still to read after the prefix: the JSON header, or the buffer
+        # lengths and extensions following the fixed part of a binary header
         self._jsonheader_len = None
+        self._binary_header = None
+        # Decoded header of the current frame, as a dict whatever the wire format
         self.jsonheader = None
         self.msg = None
+        # Current frame: encoded content and its out-of-band buffers
+        self._content = None
+        self._oob_buffers = None
+        self._oob_index = 0
+        self._oob_offset = 0
+        # Set once the peer closed its end; connections are long-lived now so the
+        # caller needs to know when to stop reading.
+        self.closed = False
     
     
-    def _read(self):
+    def _read(self, max_bytes : int = None) -> bool:
+        """
+        Receive what the socket has (at most max_bytes) into the buffer.
+        Returns False when nothing was available.
+        """
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            n = self._recv_buffer.recv_from(self.sock, max_bytes)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
-            pass
-        else:
-            if data:
-                self._recv_buffer += data
-            else:
-                raise RuntimeError("Peer closed.")
+            return False
+        if n == 0:
+            raise RuntimeError("Peer closed.")
+        return True
     
 
     def _json_encode(self, obj, encoding):
@@ -107,101 +228,278 @@ class ReceiveMessageHandler:
 
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(
-            io.BytesIO(json_bytes), encoding=encoding, newline=""
-        )
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        return json.loads(json_bytes.decode(encoding))
     
 
-    def _pickle_decode(self, pkl_bytes):
-        return pickle.loads(pkl_bytes)
+    @classmethod
+    def decode_frame(cls, jsonheader : dict, content, buffers=None, allow_pickle : bool = True,
+                     clock_offset : float = None) -> list:
+        """
+        Turn one complete frame into [(creds, latency), (variable_name, value), ...].
+        Shared by this handler and the asyncio engine (AsyncNode). Raises ValueError
+        for a codec or compression that is unknown, or pickle when allow_pickle is off,
+        and FrameExpired, before decompressing anything, past the frame's deadline.
+        ``clock_offset`` (our clock minus the sender's, see clockSync) corrects the
+        latency and the deadline for clock skew.
+        """
+        #compute the latency
+        sent_ts = jsonheader.get("sent-ts")
+        recv_ts = time.time()
+        latency = (recv_ts - sent_ts) if sent_ts is not None else None
+        if latency is not None and clock_offset is not None:
+            latency -= clock_offset
+
+        deadline = jsonheader.get("deadline")
+        if deadline is not None:
+            # the deadline is in the sender's clock
+            late = recv_ts - (clock_offset or 0.0) - deadline
+            if late > 0:
+                metrics.FRAMES_EXPIRED.inc()
+                raise FrameExpired(f"deadline passed {late:.3f} s ago")
+
+        start = time.perf_counter()
+        codec = jsonheader.get("codec", codecRegistry.PICKLE)
+        compression = jsonheader.get("compression")
+        if compression:
+            content, buffers = payloadCompression.decompress(compression, content, buffers)
+        data_dict = codecRegistry.decode(codec, content, buffers, allow_pickle)
+        metrics.DECODE_SECONDS.observe(time.perf_counter() - start, codec=codecRegistry.get(codec).name)
+
+        creds = data_dict['container_creds_xxx']
+        peer = creds[0] if isinstance(creds, (tuple, list)) and creds else creds
+        metrics.FRAMES_RECEIVED.inc(peer=peer)
+        metrics.BYTES_RECEIVED.inc(jsonheader.get("content-length", len(content)) + sum(jsonheader.get("buffers", ())), peer=peer)
+        if latency is not None:
+            # uncorrected, negative when the sender's clock is ahead
+            metrics.FRAME_LATENCY_SECONDS.observe(max(latency, 0.0), peer=peer,
+                                                  corrected=str(clock_offset is not None).lower())
+
+        messages = [(creds, latency)]
+        for var_name, value in data_dict.items():
+            if var_name=='container_creds_xxx':
+                continue
+            messages.append((var_name, value))
+        return messages
+
+
+    def reply(self, frame : tuple):
+        """
+        Write a control frame back on the stream. Replies are small enough for the
+        socket buffer; if one does not fit, it is dropped (a clock request times
+        out, the sender probes for credits).
+        """
+        try:
+            with self._send_lock:
+                self.sock.send(b"".join(frame))
+        except OSError as e:
+            logging.warning(f"[SERVER] Could not answer a control frame from {self.addr}: {e}")
+
+
+    def _control(self, header : dict):
+        """
+        Answer a control frame on the same stream: the clock pings of clockSync, the
+        HELLO of a sender asking for credits (flowControl).
+        """
+        credit = flowControl.parse(header)
+        if credit is not None and credit[0] == flowControl.HELLO:
+            if self.credits is not None:
+                self.credits.hello()
+            return
+        reply = self.clock.reply(header)
+        if reply is None:
+            logging.warning(f"[SERVER] Ignored an unknown control frame from {self.addr}")
+            return
+        self.reply(reply)
+
+
+    def _fill_oob(self) -> bool:
+        """
+        Fill the out-of-band buffers announced by the JSON header. Bytes already
+        read past the content are moved over first; the rest is received straight
+        into the preallocated buffers with recv_into(), so array data is never
+        copied in user space. Returns True once every buffer is complete.
+        """
+        while self._oob_index < len(self._oob_buffers):
+            buf = self._oob_buffers[self._oob_index]
+            if self._oob_offset == len(buf):
+                self._oob_index += 1
+                self._oob_offset = 0
+                continue
+            view = memoryview(buf)[self._oob_offset:]
+            if len(self._recv_buffer):
+                n = self._recv_buffer.take_into(view)
+            else:
+                if self.closed:
+                    return False
+                try:
+                    n = self.sock.recv_into(view)
+                except BlockingIOError:
+                    return False
+                if n == 0:
+                    self.closed = True
+                    return False
+            self._oob_offset += n
+        return True
         
     
     def process_protoheader(self):
-        hdrlen = 2
-        if len(self._recv_buffer) >= hdrlen:
+        hdrlen = frameHeader.LEGACY_PREFIX
+        if len(self._recv_buffer) < hdrlen:
+            return
+        if frameHeader.is_binary(self._recv_buffer.view(hdrlen)):
+            hdrlen = frameHeader.FIXED.size
+            if len(self._recv_buffer) >= hdrlen:
+                self._binary_header, self._jsonheader_len = frameHeader.parse_fixed(
+                    self._recv_buffer.view(hdrlen)
+                )
+                self._recv_buffer.consume(hdrlen)
+        else:
             self._jsonheader_len = struct.unpack(
-                ">H", self._recv_buffer[:hdrlen]
+                ">H", self._recv_buffer.view(hdrlen)
             )[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._recv_buffer.consume(hdrlen)
     
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(
-                self._recv_buffer[:hdrlen], "utf-8"
-            )
-            self._recv_buffer = self._recv_buffer[hdrlen:]
-            for reqhdr in (
-                "byteorder",
-                "content-length",
-                "sent-ts"
-            ):
-                if reqhdr not in self.jsonheader:
-                    raise ValueError(f"Missing required header '{reqhdr}'.")
+            header_bytes = self._recv_buffer.view(hdrlen).tobytes()
+            self._recv_buffer.consume(hdrlen)
+            if self._binary_header is not None:
+                self.jsonheader = frameHeader.parse_variable(self._binary_header, header_bytes)
+                self._binary_header = None
+            else:
+                self.jsonheader = self._json_decode(header_bytes, "utf-8")
+                self.validate_jsonheader(self.jsonheader)
+            # Size the buffer for the whole content now rather than growing per read
+            self._recv_buffer.reserve(self.jsonheader["content-length"])
+
+
+    @staticmethod
+    def validate_jsonheader(jsonheader : dict):
+        for reqhdr in (
+            "byteorder",
+            "content-length",
+            "sent-ts"
+        ):
+            if reqhdr not in jsonheader:
+                raise ValueError(f"Missing required header '{reqhdr}'.")
+
+
+    def _missing(self) -> int:
+        """
+        Bytes still needed in the buffer before the next parsing step can run.
+        """
+        if self._jsonheader_len is None:
+            return 2 - len(self._recv_buffer)
+        if self.jsonheader is None:
+            return self._jsonheader_len - len(self._recv_buffer)
+        return self.jsonheader["content-length"] - len(self._recv_buffer)
 
 
     def recv_all_messages(self):
         messages = []
-        i = 1
-        try:
-            while True:
-                # Read any available data.
-                self._read()
-                # if not self._read():
-                #     # If _read() returns False, the connection is closed.
-                #     print(f"[SERVER] Connection closed by peer {self.addr}")
-                #     break
-                # If we don't yet have the proto header, try to process it.
-                if self._jsonheader_len is None and len(self._recv_buffer) >= 2:
-                    self.process_protoheader()
-
-                # Process JSON header if possible.
-                if self._jsonheader_len is not None and self.jsonheader is None:
-                    if len(self._recv_buffer) >= self._jsonheader_len:
-                        self.process_jsonheader()
-
-                # If we have a JSON header, check if the full message is available.
-                if self.jsonheader is not None:
-                    content_len = self.jsonheader["content-length"]
-                    sent_ts = self.jsonheader.get("sent-ts")
-                    total_expected = content_len
-                    if len(self._recv_buffer) < total_expected:
-                        # Not enough data yet for a complete message.
-                        break
-                    
-                    #compute the latency
-                    recv_ts = time.time()
-                    latency = (recv_ts - sent_ts) if sent_ts is not None else None
-
-                    content_bytes = self._recv_buffer[:content_len]
-                    self._recv_buffer = self._recv_buffer[content_len:]
-                    data_dict = self._pickle_decode(content_bytes)
-
-
-                    messages.append((data_dict['container_creds_xxx'], latency))
-                    for var_name, value in data_dict.items():
-                        if var_name=='container_creds_xxx':
-                            continue
-                        messages.append((var_name, value))
-                    # for variable_name, content in data_dict.items():
-                    #     messages.append((variable_name, content))
+        while True:
+            # If we don't yet have the proto header, try to process it.
+            if self._jsonheader_len is None and len(self._recv_buffer) >= 2:
+                self.process_protoheader()
+
+            # Process JSON header if possible.
+            if self._jsonheader_len is not None and self.jsonheader is None:
+                if len(self._recv_buffer) >= self._jsonheader_len:
+                    self.process_jsonheader()
+
+            # If we have a JSON header, check if the full message is available.
+            # Control frames (no payload) are answered here and not handed out
+            if (self.jsonheader is not None and self.jsonheader.get("flags", 0) & frameHeader.FLAG_CONTROL
+                    and self._missing() <= 0):
+                self._control(self.jsonheader)
+                self._recv_buffer.consume(self.jsonheader["content-length"])
+                self._jsonheader_len = None
+                self.jsonheader = None
+                continue
+
+            if self.jsonheader is not None and (self._oob_buffers is not None or self._missing() <= 0):
+                chunk = self.jsonheader.get("flags", 0) & frameHeader.FLAG_CHUNK
+                if self._oob_buffers is None:
+                    self._oob_index = 0
+                    self._oob_offset = 0
+                    if chunk:
+                        # The chunk's data is received straight into the frame being reassembled
+                        self._oob_buffers = [self.chunks.receive(self.jsonheader)]
+                    else:
+                        self._oob_buffers = [bytearray(n) for n in self.jsonheader.get("buffers", [])]
+                    if self._oob_buffers and not chunk:
+                        # The buffers follow the content: set the (small, metadata
+                        # only) encoded content aside so they can be filled.
+                        content_len = self.jsonheader["content-length"]
+                        self._content = self._recv_buffer.view(content_len).tobytes()
+                        self._recv_buffer.consume(content_len)
+
+                if not self._fill_oob():
+                    # Array buffers still incomplete.
+                    break
 
+                content_len = self.jsonheader["content-length"]
+                try:
+                    if chunk:
+                        frame = self.chunks.complete(self.jsonheader)
+                        if frame is not None:
+                            messages = self.decode_frame(*frame, allow_pickle=self.allow_pickle,
+                                                         clock_offset=self.clock.offset)
+                        elif self.jsonheader.get("frame_dropped") and self.credits is not None:
+                            # the frame will never complete: it is consumed as far as credits go
+                            self.credits.drop()
+                    elif self.jsonheader.get("flags", 0) & frameHeader.FLAG_SHM:
+                        # Same-host peer: the frame is in a shared-memory segment
+                        messages = self.decode_frame(*shmTransport.attach(self.jsonheader), allow_pickle=self.allow_pickle,
+                                                     clock_offset=self.clock.offset)
+                    elif self._content is not None:
+                        # Arrays are rebuilt directly over their out-of-band buffers
+                        messages = self.decode_frame(self.jsonheader, self._content, self._oob_buffers, self.allow_pickle,
+                                                     self.clock.offset)
+                    else:
+                        # The content is decoded straight from the receive buffer
+                        with self._recv_buffer.view(content_len) as content:
+                            messages = self.decode_frame(self.jsonheader, content, allow_pickle=self.allow_pickle,
+                                                         clock_offset=self.clock.offset)
+                except ValueError as e:
+                    # Refused or unknown codec, or out of date: skip this frame, keep the stream
+                    if not isinstance(e, FrameExpired):
+                        logging.error(f"[SERVER] Dropped a frame from {self.addr}: {e}")
+                        metrics.FRAMES_DROPPED.inc()
+                    if self.credits is not None:
+                        self.credits.drop()
+                finally:
+                    if self._content is None:
+                        self._recv_buffer.consume(content_len)
                     # Reset header info so that we can process the next message.
                     self._jsonheader_len = None
                     self.jsonheader = None
-                    i+=1
-                else:
+                    self._content = None
+                    self._oob_buffers = None
+                # One frame per call: on a long-lived connection the next frame may
+                # already be buffered, and the caller expects a single creds entry.
+                if messages:
                     break
-        except RuntimeError as e:
-        # When the peer closes the connection, _read() will raise a RuntimeError.
-            if str(e) == "Peer closed.":
-                # print(f"[SERVER] Connection closed by peer {self.addr}")
-                pass
-            else:
-                raise
+                continue
+
+            # Not enough buffered for the next step: read more, unless the peer
+            # already closed its end (buffered frames are still handed out first).
+            if self.closed:
+                break
+            # Frames with out-of-band buffers: stop at the end of the content so
+            # the array bytes go straight into their own buffers.
+            max_bytes = self._missing() if self.jsonheader is not None and self.jsonheader.get("buffers") else None
+            try:
+                if not self._read(max_bytes):
+                    break
+            except RuntimeError as e:
+                # When the peer closes the connection, _read() will raise a RuntimeError.
+                if str(e) == "Peer closed.":
+                    # print(f"[SERVER] Connection closed by peer {self.addr}")
+                    self.closed = True
+                else:
+                    raise
 
-        return messages
\ No newline at end of file
+        return messages
@@ -0,0 +1,116 @@
+import hashlib
+import itertools
+import logging
+import threading
+
+####################################################################################################
+# Routing of payloads among the instances of a target (a role or service name of target_roles).
+#
+#   broadcast           every instance gets every payload (the default)
+#   round_robin         one instance per payload, in turn
+#   least_outstanding   one instance per payload: the one with the fewest payloads assigned to it
+#                       and not yet processed (queued for it, or sent and not reported consumed
+#                       by its credit grants)
+#   hash:<key>          one instance per payload, chosen by rendezvous hashing of payload[<key>]:
+#                       equal keys go to the same instance, and only the keys of an instance that
+#                       joins or leaves move
+#
+# With one of the last three (anycast), a payload is assigned when it is sent, or to the first
+# instance that appears if there is none yet (it is kept until then, up to pending_max_age); if
+# its instance leaves before receiving it, it is assigned again among the remaining ones.
+####################################################################################################
+
+BROADCAST = "broadcast"
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+HASH = "hash"
+
+POLICIES = (BROADCAST, ROUND_ROBIN, LEAST_OUTSTANDING, HASH)
+
+
+def parse(spec : str) -> tuple:
+    """
+    "round_robin", "least_outstanding", "hash:<payload key>" or "broadcast"
+    (also None). Returns (policy, key or None).
+    """
+    if not spec:
+        return BROADCAST, None
+    policy, _, key = spec.partition(":")
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown routing policy '{policy}' (expected one of {POLICIES}).")
+    if policy == HASH and not key:
+        raise ValueError("The hash routing policy needs a payload key: 'hash:<key>'.")
+    return policy, key or None
+
+
+def _score(svc_id, value : bytes) -> bytes:
+    return hashlib.blake2b(str(svc_id).encode() + b"\0" + value, digest_size=8).digest()
+
+
+class Router:
+    def __init__(self, routing : dict = None):
+        """
+        :param routing: { target : policy spec (see parse) }; targets left out are broadcast.
+        """
+        self.policies = {}
+        for target, spec in (routing or {}).items():
+            policy = parse(spec)
+            if policy[0] != BROADCAST:
+                self.policies[target] = policy
+        self._turns = {target: itertools.count() for target in self.policies}
+        self._lock = threading.Lock()
+
+
+    def group_of(self, peer : dict):
+        """
+        Anycast target ``peer`` is an instance of (by service name, then tags), or None.
+        """
+        for target in self.policies:
+            if target == peer['name'] or target in peer['tags']:
+                return target
+        return None
+
+
+    def route(self, payload : dict, peers : dict, outstanding, reachable=None) -> tuple:
+        """
+        Peers a new payload goes to: every broadcast peer plus one instance of each
+        anycast target. Returns (svc_ids, {target : chosen svc_id}), None standing
+        for targets without instances yet (the payload waits for the first one).
+        :param outstanding: Callable svc_id -> payloads assigned to it and not processed yet.
+        :param reachable: Callable svc_id -> bool; instances for which it is False are
+                          only chosen when a target has no other.
+        """
+        groups = {}
+        targets = set()
+        for svc_id, peer in peers.items():
+            group = self.group_of(peer)
+            if group is None:
+                targets.add(svc_id)
+            else:
+                groups.setdefault(group, []).append(svc_id)
+        routes = dict.fromkeys(self.policies)
+        for group, members in groups.items():
+            if reachable is not None:
+                members = [svc_id for svc_id in members if reachable(svc_id)] or members
+            routes[group] = self.choose(group, payload, members, outstanding)
+            targets.add(routes[group])
+        return targets, routes
+
+
+    def choose(self, group, payload : dict, members : list, outstanding) -> object:
+        members = sorted(members, key=str)
+        policy, key = self.policies[group]
+        if policy == HASH:
+            if key in payload:
+                value = repr(payload[key]).encode()
+                return max(members, key=lambda svc_id: _score(svc_id, value))
+            logging.warning(f"[ROUTING] payload has no '{key}' to hash for {group}; using round robin")
+            policy = ROUND_ROBIN
+        with self._lock:
+            turn = next(self._turns[group])
+        if policy == LEAST_OUTSTANDING:
+            loads = {svc_id: outstanding(svc_id) for svc_id in members}
+            least = min(loads.values())
+            # ties are taken in turn
+            members = [svc_id for svc_id in members if loads[svc_id] == least]
+        return members[turn % len(members)]
@@ -1,10 +1,15 @@
 import socket
-import pickle
-import struct
 import sys
-import json
 import logging
 import time
+from collections import deque
+import frameHeader
+import codecRegistry
+import logPipeline
+
+# Upper bound on the number of segments handed to one sendmsg() call (Linux IOV_MAX)
+_IOV_MAX = 1024
+
 
 # class SendMessageHandler:
 #     def __init__(self, sock: socket.socket, peer_addr, send_data: dict):
@@ -62,12 +67,14 @@ import time
 
 
 class SendMessageHandler:
-    def __init__(self, sock: socket.socket, peer_addr, send_data: dict):
+    def __init__(self, sock: socket.socket, peer_addr, send_data: dict = None):
         """
         :param sock: Socket connection to the peer.
         :param peer_addr: The address (or identifier) of the peer.
         :param send_data: A dict containing the variables to send to the peer.
                           Format: { "variable_name": message_content, ... }
+                          May be omitted when the handler wraps a pooled stream
+                          and payloads are passed to send_all_messages() instead.
         """
         self.sock = sock
         self.peer_addr = peer_addr
@@ -76,50 +83,122 @@ class SendMessageHandler:
         self.sock.setblocking(True)
 
 
-    def _create_message(self, msg_obj) -> bytes:
+    @staticmethod
+    def encode_content(msg_obj, zero_copy: bool = False) -> tuple:
+        """
+        Serialise a payload with pickle into the segments that follow the header:
+        the pickled content, then (zero-copy mode only) its out-of-band buffers.
+        See codecRegistry for the other codecs.
+
+        With zero_copy, pickle protocol 5 keeps the data of NumPy arrays and CPU
+        torch tensors out of band: the segments are views over the caller's
+        arrays, which therefore must not be modified until the frame is sent.
+        """
+        return codecRegistry.get(codecRegistry.PICKLE).encode(msg_obj, zero_copy)
+
+
+    @staticmethod
+    def render_header(content : tuple, binary: bool = False, sent_ts: float = None,
+                      codec: int = codecRegistry.PICKLE, compression: list = None, deadline: float = None,
+                      **fields) -> bytes:
+        """
+        Header for the content segments of a frame: the legacy 2-byte length +
+        JSON header, or the fixed binary header (see frameHeader) with the extra
+        ``fields`` (seq, trace_id, flags, extensions). ``compression`` is the
+        spec returned by payloadCompression.compress() for compressed segments,
+        ``deadline`` the time after which receivers drop the frame undecoded.
+        """
+        content_length = memoryview(content[0]).nbytes
+        buffer_lengths = [memoryview(buf).nbytes for buf in content[1:]]
+        if sent_ts is None:
+            sent_ts = time.time()
+        if binary:
+            return frameHeader.render_binary(content_length, buffer_lengths, sent_ts, codec=codec,
+                                             compression=compression, deadline=deadline, **fields)
+        return frameHeader.render_json(content_length, buffer_lengths, sent_ts, codec=codec,
+                                       compression=compression, deadline=deadline)
+
+
+    @classmethod
+    def encode_frame(cls, msg_obj, zero_copy: bool = False, binary: bool = False,
+                     codec: int = codecRegistry.PICKLE, **fields) -> tuple:
         """
         Constructs a full message according to our protocol:
-          - First 2 bytes: length of JSON header (big-endian)
-          - JSON header: contains keys "byteorder", "content-length", "variable-name-length"
-          - Optional variable name bytes (UTF-8)
-          - Pickled message content
+          - Header: 2-byte length + JSON header ("byteorder", "content-length",
+            "sent-ts" [, "buffers": out-of-band buffer lengths]), or the binary
+            header when ``binary`` is set
+          - Message content, encoded with ``codec`` (pickle by default)
+          - Out-of-band buffers, back to back (zero-copy mode and typed codec)
+        The frame is returned as a tuple of segments to be written with one
+        scatter-gather sendmsg(), so the pickled bytes are never concatenated
+        with the header. It is independent of the peer, so a payload fanned out
+        to N peers is serialised once and the same segments written N times.
         """
-        # Serialize the message content
-        msg_bytes = pickle.dumps(msg_obj)
-        content_length = len(msg_bytes)
+        codec, content = codecRegistry.encode(msg_obj, codec, zero_copy)
+        return (cls.render_header(content, binary, codec=codec, **fields), *content)
 
-        # Build the JSON header
-        json_header = {
-            "byteorder": sys.byteorder,
-            "content-length": content_length,
-            "sent-ts" : time.time(),
-        }
-        json_header_bytes = json.dumps(json_header).encode("utf-8")
-        json_header_length = len(json_header_bytes)
 
-        # Pack the length of the JSON header as 2 bytes (big-endian)
-        proto_header = struct.pack(">H", json_header_length)
+    def _create_message(self, msg_obj) -> tuple:
+        return self.encode_frame(msg_obj)
 
-        # Concatenate all parts: proto header + JSON header + variable name + content
-        full_message = proto_header + json_header_bytes + msg_bytes
-        return full_message
+
+    def _sendmsg_all(self, segments):
+        """
+        sendall() for a list of buffers: scatter-gather writes straight from each
+        segment, resuming after partial writes without joining them.
+        """
+        if not hasattr(self.sock, "sendmsg"):
+            # e.g. Windows: one sendall per segment, still without joining them
+            for segment in segments:
+                self.sock.sendall(segment)
+            return
+        views = deque(memoryview(segment).cast("B") for segment in segments)
+        while views:
+            sent = self.sock.sendmsg(list(views)[:_IOV_MAX])
+            while sent:
+                head = views[0]
+                if sent >= head.nbytes:
+                    sent -= head.nbytes
+                    views.popleft()
+                else:
+                    views[0] = head[sent:]
+                    sent = 0
+            # drop empty segments (e.g. zero-length arrays) left at the front
+            while views and views[0].nbytes == 0:
+                views.popleft()
 
 
-    def send_all_messages(self):
+    def send_frame(self, frame: tuple, variables=()):
         """
-        Sends the full batch in one go, then logs each variable as before.
+        Writes an already encoded frame (see encode_frame) to the peer, then logs
+        each variable it carries. Socket errors are logged and re-raised so the
+        caller can reconnect.
         """
-        full_message = self._create_message(self.send_data)
         try:
-            self.sock.sendall(full_message)
+            self._sendmsg_all(frame)
             # Emit one log per variable to match your existing logging style
-            for variable_name in self.send_data:
+            for variable_name in variables:
                 if variable_name=='container_creds_xxx':
                     continue
-                msg = f"[CLIENT] Sent message for variable '{variable_name}' to {self.peer_addr}"
+                skipped = logPipeline.allow("sent")
+                if skipped is None:
+                    continue
+                msg = f"[CLIENT] Sent message for variable '{variable_name}' to {self.peer_addr}{logPipeline.suppressed(skipped)}"
                 # print(msg)
                 logging.info(msg)
         except Exception as e:
             err = f"[CLIENT] Error sending batch payload to {self.peer_addr}: {e}"
             print(err, file=sys.stderr)
-            logging.error(err)
\ No newline at end of file
+            logging.error(err)
+            raise
+
+
+    def send_all_messages(self, send_data: dict = None):
+        """
+        Sends the full batch in one go, then logs each variable as before.
+        Passing send_data replaces the payload, so the same handler can be reused
+        for every frame written on a long-lived connection.
+        """
+        if send_data is not None:
+            self.send_data = send_data
+        self.send_frame(self._create_message(self.send_data), self.send_data)
@@ -0,0 +1,125 @@
+import logging
+import mmap
+import os
+import re
+import struct
+import frameHeader
+
+####################################################################################################
+# Shared-memory transport between containers sharing an IPC namespace (single-host mode: see
+# parser_compose, which also sets SHM_DOMAIN). Instead of the frame, the socket carries a small
+# descriptor: a binary header flagged FLAG_SHM whose EXT_SHM extension names a file in /dev/shm
+# holding the frame's segments back to back, followed by the frame's own binary header.
+#
+# The sender writes one file per frame and peer; the receiver maps it, unlinks it at once and
+# rebuilds the payload over the mapping, so the arrays it hands out are the shared pages
+# themselves and the memory is freed when they are. Files are written with os.write rather than
+# through a mapping: a full /dev/shm then fails the write (and the frame goes over TCP) instead
+# of raising SIGBUS. Peers advertise their domain in their Consul service Meta (META_KEY); the
+# files of a descriptor that could not be sent are removed by the sender.
+####################################################################################################
+
+META_KEY = "shm"
+SHM_DIR = "/dev/shm"
+
+_PREFIX = "autter-"
+_NAME = re.compile(r"^autter-[0-9a-f]+-[0-9a-f]+-[0-9a-f]+$")
+
+
+def available(shm_dir : str = SHM_DIR) -> bool:
+    return os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK)
+
+
+def same_domain(domain : str, meta : dict) -> bool:
+    return bool(domain) and (meta or {}).get(META_KEY) == domain
+
+
+def export(frame : tuple, seq : int, sent_ts : float, trace_id : bytes, shm_dir : str = SHM_DIR) -> tuple:
+    """
+    Write the segments of ``frame`` (whose header must be binary) to a new file in
+    ``shm_dir``. Returns the descriptor frame to send in its place. Raises OSError
+    when the file cannot be written (e.g. /dev/shm is full); nothing is left behind.
+    """
+    name = f"{_PREFIX}{os.getpid():x}-{seq:x}-{os.urandom(8).hex()}"
+    path = os.path.join(shm_dir, name)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        for segment in frame[1:]:
+            view = memoryview(segment).cast("B")
+            while view:
+                view = view[os.write(fd, view):]
+    except OSError:
+        os.unlink(path)
+        raise
+    finally:
+        os.close(fd)
+    encoded = name.encode("ascii")
+    value = struct.pack("!B", len(encoded)) + encoded + bytes(frame[0])
+    header = frameHeader.render_binary(
+        0, [], sent_ts, seq=seq, trace_id=trace_id, flags=frameHeader.FLAG_SHM,
+        extensions={frameHeader.EXT_SHM: value},
+    )
+    return (header,)
+
+
+def _parse(header : dict) -> tuple:
+    value = header["ext"][frameHeader.EXT_SHM]
+    name = value[1:1 + value[0]].decode("ascii")
+    if not _NAME.match(name):
+        raise ValueError(f"Invalid shared-memory segment name {name!r}.")
+    inner = value[1 + value[0]:]
+    frame_header, n = frameHeader.parse_fixed(inner[:frameHeader.FIXED.size])
+    frame_header = frameHeader.parse_variable(frame_header, inner[frameHeader.FIXED.size:][:n])
+    return name, frame_header
+
+
+def release(frame : tuple, shm_dir : str = SHM_DIR):
+    """
+    Remove the file behind a descriptor frame that was not delivered. No-op for other frames.
+    """
+    header = frame[0]
+    if not frameHeader.is_binary(header):
+        return
+    fixed, n = frameHeader.parse_fixed(header[:frameHeader.FIXED.size])
+    if not fixed["flags"] & frameHeader.FLAG_SHM:
+        return
+    name, _ = _parse(frameHeader.parse_variable(fixed, header[frameHeader.FIXED.size:][:n]))
+    try:
+        os.unlink(os.path.join(shm_dir, name))
+    except FileNotFoundError:
+        pass
+
+
+def attach(header : dict, shm_dir : str = SHM_DIR) -> tuple:
+    """
+    Receiver side: map and unlink the file a descriptor names.
+    Returns (frame header, content, buffers), as views over the mapping.
+    """
+    try:
+        name, frame_header = _parse(header)
+    except (KeyError, IndexError, UnicodeDecodeError, struct.error) as e:
+        raise ValueError(f"Malformed shared-memory descriptor: {e}")
+    lengths = [frame_header["content-length"], *frame_header["buffers"]]
+    total = sum(lengths)
+    path = os.path.join(shm_dir, name)
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError as e:
+        raise ValueError(f"Shared-memory segment {name} is gone: {e}")
+    try:
+        os.unlink(path)
+        # Touching pages past the end of the file would raise SIGBUS
+        if os.fstat(fd).st_size < total:
+            raise ValueError(f"Shared-memory segment {name} is shorter than announced.")
+        region = memoryview(mmap.mmap(fd, total)) if total else memoryview(bytearray())
+    except OSError as e:
+        raise ValueError(f"Shared-memory segment {name} could not be mapped: {e}")
+    finally:
+        os.close(fd)
+    segments, offset = [], 0
+    for n in lengths:
+        segments.append(region[offset:offset + n])
+        offset += n
+    logging.debug(f"[SHM] attached {name} ({total} bytes)")
+    content, *buffers = segments
+    return frame_header, content, buffers
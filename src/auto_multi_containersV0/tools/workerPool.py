@@ -0,0 +1,109 @@
+import threading
+import logging
+import queue
+
+
+class _Executor:
+    def __init__(self, name : str, queues : list):
+        """
+        Fixed set of worker threads, one per queue in ``queues`` for keyed
+        executors or all sharing a single queue. Jobs are (fn, args) tuples.
+        """
+        self.name = name
+        self._queues = queues
+        self._lock = threading.Lock()
+        self._active = 0
+        self._counters = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'blocked': 0,   # submissions that had to wait for room in a full queue
+        }
+
+
+    def _start(self, workers : int):
+        self.workers = workers
+        for i in range(workers):
+            q = self._queues[i % len(self._queues)]
+            threading.Thread(target=self._run, args=(q,), name=f"{self.name}-{i}", daemon=True).start()
+
+
+    def _put(self, q : queue.Queue, job : tuple):
+        with self._lock:
+            self._counters['submitted'] += 1
+        try:
+            q.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._counters['blocked'] += 1
+            # Saturated: hold the caller (and whatever feeds it) instead of growing
+            q.put(job)
+
+
+    def _run(self, q : queue.Queue):
+        while True:
+            fn, args = q.get()
+            with self._lock:
+                self._active += 1
+            try:
+                fn(*args)
+                outcome = 'completed'
+            except Exception:
+                logging.exception(f"[WORKERS] {self.name}: job {getattr(fn, '__name__', fn)} failed")
+                outcome = 'failed'
+            with self._lock:
+                self._active -= 1
+                self._counters[outcome] += 1
+
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats['active'] = self._active
+        stats['workers'] = self.workers
+        stats['queued'] = sum(q.qsize() for q in self._queues)
+        stats['max_queue'] = self._queues[0].maxsize
+        return stats
+
+
+class BoundedExecutor(_Executor):
+    def __init__(self, name : str, workers : int = 8, max_queue : int = 1024):
+        """
+        ``workers`` threads taking jobs from one queue of at most ``max_queue``
+        entries; submit() blocks while the queue is full.
+        """
+        super().__init__(name, [queue.Queue(max_queue)])
+        self._start(workers)
+
+
+    def submit(self, fn, *args):
+        self._put(self._queues[0], (fn, args))
+
+
+class KeyedExecutor(_Executor):
+    def __init__(self, name : str, workers : int = 4, max_queue : int = 256):
+        """
+        ``workers`` single-threaded stripes, each with its own queue of at most
+        ``max_queue`` entries. Jobs with the same key always land on the same
+        stripe, so they run one at a time and in submission order.
+        """
+        super().__init__(name, [queue.Queue(max_queue) for _ in range(workers)])
+        self._start(workers)
+
+
+    def submit(self, key, fn, *args):
+        self._put(self._queues[hash(key) % len(self._queues)], (fn, args))
+
+
+    def free(self, key) -> int:
+        """
+        Jobs that can be submitted under ``key`` before submit() blocks.
+        """
+        q = self._queues[hash(key) % len(self._queues)]
+        return max(q.maxsize - q.qsize(), 0)
+
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['per_stripe'] = [q.qsize() for q in self._queues]
+        return stats